@@ -1,147 +1,90 @@
-import streamlit as st
-import json
-import tempfile
-from extractor import extract_with_gemini
-from chronological_event import chronological_events
-from deduction_engine import analyze_event_against_clauses
-from laytime_agent import extract_metadata_from_docs
-from laytime_agent import LaytimeCalculator
-from excel_exporter import generate_excel_from_extracted_data
+import time
+import threading
 
-from datetime import datetime, timedelta, time
-from dateutil import parser
+import streamlit as st
+from streamlit.runtime.scriptrunner import RerunException, StopException, get_script_run_ctx
+from pipeline import run_voyage
+from store import VoyageStore
+from upload_spool import SessionScratch, sweep_stale
+from result_export import export_result, MIME_TYPES
+from sensitivity import sensitivity_from_result
+from deadlines import POLL_SECONDS, RunBudget, Cancelled
+from service_client import ServiceClient, SERVICE_URL
 
-import re
-import pandas as pd
+from datetime import datetime
 
 
 st.set_page_config(page_title="Gemini Laytime Analyzer", layout="wide")
 st.title("📄 Gemini Laytime Multi-Document Processor")
 
-REQUIRED_DOCUMENTS = ["Contract", "SoF"]
-OPTIONAL_DOCUMENTS = ["LoP", "NOR", "PumpingLog"]
-ALL_EXPECTED = REQUIRED_DOCUMENTS + OPTIONAL_DOCUMENTS
 
-def extract_nor_delay_hours(clause_text: str) -> int:
+@st.cache_resource
+def get_store() -> VoyageStore:
+    # One store (and background writer) per app server
+    return VoyageStore()
+
+
+@st.cache_resource
+def startup_sweep() -> int:
+    # Crash recovery: drop scratch dirs left by servers that died mid-run
+    return sweep_stale()
+
+
+startup_sweep()
+
+
+@st.cache_resource
+def live_runs() -> dict:
+    # session id -> RunBudget of its latest run, kept until the run has ended and its model calls have exited
+    return {}
+
+
+def forget_finished_runs():
+    runs = live_runs()
+    for session_id, budget in list(runs.items()):
+        if budget.cancelled() and not budget.busy():
+            runs.pop(session_id, None)
+
+
+forget_finished_runs()
+
+
+def request_stop():
+    """Stop button callback: cancel this session's run, including model calls it left running."""
+    ctx = get_script_run_ctx()
+    budget = live_runs().get(ctx.session_id if ctx else None)
+    if budget is not None:
+        budget.cancel()
+    st.session_state["run_stopped"] = True
+
+
+def rerun_check(interrupted: list):
     """
-    Parse “<N> hours after” from the NOR clause text.
+    RunBudget check that gives Streamlit a yield point while the pipeline
+    waits on model calls. Streamlit raises a Stop click (or any other rerun)
+    at the script's next element update; here that update is an empty
+    placeholder, and the request becomes a cancellation. The Streamlit
+    exception goes into `interrupted`, to be re-raised once the run unwinds.
     """
-    pattern = r'(\d+)(?:\s*\([^)]*\))?\s*hours?(\s+after|later)?'
-    m = re.search(pattern, clause_text, re.IGNORECASE)
-    return int(m.group(1)) if m else 0
-
-def split_nor_period(df: pd.DataFrame, laytime_commencement: str) -> pd.DataFrame:
-    d = df.copy()
-    d['start_time'] = pd.to_datetime(d['start_time'])
-    d['end_time']   = pd.to_datetime(d['end_time'])
-    d = d.sort_values('start_time').reset_index(drop=True)
-
-    if 'event_phase' in d.columns:
-        mask_nor = (
-            d['event_phase']
-             .str
-             .contains(r'\bNOR tendered\b|\bNotice of Readiness tendered\b', 
-                       case=False, na=False)
-        )
-    else:
-        mask_nor = (
-            d['reason']
-             .str
-             .contains(r'\bNOR tendered\b|\bNotice of Readiness tendered\b', 
-                       case=False, na=False)
-        )
+    heartbeat = st.empty()
+    script_thread = threading.current_thread()
+    last = 0.0
+
+    def check() -> bool:
+        nonlocal last
+        # Only the script thread can take Streamlit's rerun/stop request; one update per poll is enough
+        if threading.current_thread() is not script_thread or time.monotonic() - last < POLL_SECONDS:
+            return False
+        last = time.monotonic()
+        try:
+            heartbeat.empty()
+        except (RerunException, StopException) as e:
+            interrupted.append(e)
+            return True
+        return False
 
-    if mask_nor.any():
-        nor_tender = d.loc[mask_nor, 'start_time'].min()
-    else:
-        # fallback to first timestamp if no explicit NOR found
-        nor_tender = d.loc[0, 'start_time']
-
-    delay_h      = extract_nor_delay_hours(laytime_commencement)
-    default_cut  = nor_tender + timedelta(hours=delay_h)
-
-    # —— new: see if any "Commenced Discharging" happens earlier
-    if "event_phase" in d.columns:
-        mask_commence = (
-            d['event_phase']
-            .str
-            .contains('commenced discharging', case=False, na=False)
-        )
-    else:
-    # no event_phase column → look in 'reason' instead
-        mask_commence = (
-            d["reason"]
-            .str
-            .contains("commenced discharging", case=False, na=False)
-        )
-    if mask_commence.any():
-        first_commence = d.loc[mask_commence, 'start_time'].min()
-        # pick the earlier of (NOR+delay) vs first commencement
-        laytime_start = min(default_cut, first_commence)
-    else:
-        laytime_start = default_cut
-    
-    # synthetic NOR row now spans from tender → actual laytime_start
-    nor_row = {
-        'start_time': nor_tender,
-        'end_time':   laytime_start,
-        'reason':     f'Notice of Readiness period ({delay_h} h)'
-    }
+    return check
 
-    if 'event_phase' in d.columns:
-        nor_row['event_phase'] = 'NOR'
-
-    # clip any row that straddles the new laytime_start
-    mask = (d['start_time'] < laytime_start) & (d['end_time'] > laytime_start)
-    d.loc[mask, 'start_time'] = laytime_start
-
-    # drop everything before laytime_start, then prepend the NOR row
-    d_after = d[d['start_time'] >= laytime_start].reset_index(drop=True)
-    out     = pd.concat([pd.DataFrame([nor_row]), d_after], ignore_index=True)
-
-    # format for display
-    out['start_time'] = out['start_time'].dt.strftime("%Y-%m-%d %H:%M")
-    out['end_time']   = out['end_time'].dt.strftime("%Y-%m-%d %H:%M")
-    return out
-
-
-# Generic function to find any nested time dict without relying on key name
-# def find_time_dict(d):
-#     if isinstance(d, dict):
-#         # check if this dict contains time-like keys
-#         for k in d.keys():
-#             if re.search(r"(Monday to Friday|mon_fri|norHours|workingHours|Saturday)", k, re.IGNORECASE):
-#                 return d
-#         for k,v in d.items():
-#             if re.search(r"(Monday to Friday|mon_fri|norHours|workingHours|Saturday)", k, re.IGNORECASE):
-#                 return d
-#         # recurse
-#         for v in d.values():
-#             found = find_time_dict(v)
-#             if found:
-#                 return found
-#     elif isinstance(d, list):
-#         for item in d:
-#             found = find_time_dict(item)
-#             if found:
-#                 return found
-#     return None
-
-# Function to get working hours for a given datetime
-# def get_working_hours(dt):
-#     default = {"mon_fri": ("09:00", "17:00"), "sat": ("09:00", "13:00")}
-#     hours = st.session_state.get("working_hours", default)
-#     weekday = dt.weekday()
-#     if weekday < 5:
-#         start_str, end_str = hours["mon_fri"]
-#     elif weekday == 5:
-#         start_str, end_str = hours["sat"]
-#     else:
-#         return None, None
-    
-#     start = datetime.combine(dt.date(), datetime.strptime(start_str, "%H:%M").time())
-#     end   = datetime.combine(dt.date(), datetime.strptime(end_str, "%H:%M").time())
-#     return start, end
 
 # Upload section
 st.header("Upload Documents")
@@ -151,489 +94,208 @@ uploaded_files = st.file_uploader(
     type=["pdf", "docx"]
 )
 
-if st.button("Extract and Analyze") and uploaded_files:
-    uploaded_doc_types = []
-    clause_texts = []
-    metadata = {}
-    laytime_commencement = ""
-    extracted_data = {}
-    all_events = []
-    # st.session_state.pop("working_hours", None)
 
-    for uploaded_file in uploaded_files:
-        file_name = uploaded_file.name
 
-        # Save to temp path
-        with tempfile.NamedTemporaryFile(delete=False, suffix=".pdf") as tmp:
-            tmp.write(uploaded_file.read())
-            temp_path = tmp.name
-
-        # Run Gemini extraction
-        try:
-            structured_data, _ = extract_with_gemini(temp_path)
-
-            if "error" in structured_data:
-                st.error(f"❌ Gemini extraction failed for {file_name}: {structured_data['error']}")
-                continue
-
-        except Exception as e:
-            st.error(f"❌ Failed to extract from {file_name}: {str(e)}")
-            continue
-
-        doc_type = structured_data.get("document_type")
-
-        # Fallback: infer doc_type from filename
-        if not doc_type:
-            doc_type = next((d for d in ALL_EXPECTED if d.lower() in file_name.lower()), None)
-
-        if not doc_type or doc_type not in ALL_EXPECTED:
-            st.warning(f"⚠️ Skipping unknown or invalid document type for file: {file_name}")
-            continue
-
-        uploaded_doc_types.append(doc_type)
-        extracted_data[doc_type] = structured_data
-        st.markdown(f"**doctype**: {doc_type}")
-        if str(doc_type).strip().lower() == "contract":
-            st.markdown(f"Struc : {structured_data}")
-            laytime_commencement = structured_data.get("laytime_commencement")
-            metadata["LTC AT"] = structured_data.get("laytime_commencement")
-            metadata["DEMMURAGE"] = structured_data.get("demurrage")
-            metadata["DESPATCH"] = structured_data.get("despatch")
-            metadata["DISRATE"] = structured_data.get("disrate")
-            metadata["TERMS"] = structured_data.get("terms")
-         
-            # work_hours = {"mon_fri": None, "sat": None}
-         
-            # working_hour = structured_data.get("working_hours")
-            # time_dict = find_time_dict(working_hour)
-            # if time_dict:
-            #     # parse all entries in that dict
-            #     for k, v in time_dict.items():
-            #         if isinstance(v, str):
-            #             times = re.findall(r"(\d{2}:\d{2})", v)
-            #             if len(times) == 2:
-            #                 if re.search(r"(Monday to Friday|mon_fri)", k, re.IGNORECASE):
-            #                     work_hours["mon_fri"] = (times[0], times[1])
-            #                     found_mf = True
-            #                 elif re.search(r"(saturday|sat)", k, re.IGNORECASE):
-            #                     work_hours["sat"] = (times[0], times[1])
-            #                     found_sat = True
-
-            raw_secs = (
-                structured_data.get("Sections")
-                or structured_data.get("sections")
-                or structured_data.get("Agreement", {}).get("sections", [])
+def show_service_job(client: ServiceClient, job: dict):
+    """Render a finished service job: warnings, deductions and downloads."""
+    if job["state"] != "done":
+        st.error(f"❌ Job {job['state']}: {job.get('error') or 'no result'}")
+        return
+    info = job.get("summary") or {}
+    for d in info.get("degraded") or []:
+        st.warning(f"⏱️ {d['stage']}: {d['action']}")
+    summary = info.get("summary") or {}
+    if summary:
+        st.header("🧮 Laytime Calculation Summary")
+        st.markdown(f"- **Total Working-Hour Blocks:** {summary.get('total_hours', 0):.2f} hrs")
+        st.markdown(f"- **Total Deductions:**          {summary.get('deduction_hours', 0):.2f} hrs")
+        st.markdown(f"- **Net Laytime Used:**         {summary.get('net_hours', 0):.2f} hrs")
+
+    for row in client.result(job["id"]).get("rows", []):
+        color = "green" if row["deduct"] else "orange"
+        with st.expander(f"Event: {(row.get('remark') or 'N/A')[:70]}..."):
+            st.markdown(f"**Matched Clause:** {row.get('clause') or 'N/A'}")
+            st.markdown(f"**Confidence Score:** `{row.get('confidence_score') or 0.0:.2f}`")
+            st.markdown(f"**Deduct from Laytime:** :{color}[{'Yes' if row['deduct'] else 'No'}]")
+            st.markdown(f"**Reason:** {row.get('reason') or 'N/A'}")
+            st.markdown(f"**From:** `{row.get('start_time')}` | **To:** `{row.get('end_time')}`")
+
+    downloads = job.get("downloads") or {}
+    cols = st.columns(max(len(downloads), 1))
+    for col, fmt in zip(cols, downloads):
+        with col:
+            st.download_button(
+                label=f"📥 Download {fmt.upper()}",
+                data=client.download(job["id"], fmt),
+                file_name=f"Laytime_{job['id'][:8]}.{'csv' if fmt == 'sensitivity' else fmt}",
+                mime=MIME_TYPES.get(fmt, "text/csv"),
+                key=f"dl_{job['id']}_{fmt}",
             )
 
-            if isinstance(raw_secs, dict):
-                sections = [
-                    {"heading": sec_title, "body": sec_body} for sec_title, sec_body in raw_secs.items()
-                ]
-            else:
-                sections = raw_secs
-
-            for section in sections:
-
-                heading = section.get("heading", "") or section.get("title", "")
-                body    = section.get("body", {}) or section.get("content", "")
-
-                norm_heading = re.sub(r'[^a-zA-Z0-9]+', '_', heading.lower()).strip('_')
-
-                if isinstance(body, dict):
-                    for key, val in body.items():
-                        # normalize sub-key
-                        entry_key = re.sub(r'[^a-zA-Z0-9]+', '_', key.lower()).strip('_')
-                        
-                        # append each subclause as a separate dict-string
-                        if isinstance(val, dict):
-                            clause_texts.append(f"{entry_key}: {val}")
-                        elif isinstance(val, list):
-                            for item in val:
-                                clause_texts.append(f"{entry_key}: {item}")
-                        else:
-                            clause_texts.append(f"{entry_key}: {val}")
-                elif isinstance(body, list):
-                    # body is a list of items
-                    for idx, item in enumerate(body, start=1):
-                        entry_key = f"{idx}"
-                        clause_texts.append(f"{entry_key}: {item}")
-                else:
-                    # single non-dict, non-list value
-                    clause_texts.append(f"{norm_heading}: {body}")
-            
-            # st.session_state["working_hours"] = work_hours
-            
-        # SoF and others: collect chronological events
-        else:
-            st.markdown(f"Struc : {structured_data}")
-            events = structured_data.get("Chronological Events", []) or structured_data.get("chronological_events", [])
-            for e in events:
-                if e.get("Date & Time"):
-                    try:
-                        ts = datetime.strptime(e.get("Date & Time"), "%Y-%m-%d %H:%M")
-                        all_events.append({
-                            "timestamp": ts,
-                            "event": e.get("Event"),
-                            "remarks": e.get("Remarks")
-                        })
-                    except:
-                        continue
-
-                # Case 2: split fields (date, day, start_time, end_time)
-                elif e.get("Date") or e.get("date"):
-                    date_val   = e.get("Date") or e.get("date")
-                    day_val    = e.get("Day")  or e.get("day")
-                    start_val  = e.get("start_time") or e.get("Start_Time")
-                    end_val    = e.get("end_time")   or e.get("End_Time")
-                    remarks_val= e.get("Remarks")    or e.get("remarks")
-
-                    ev = {
-                        "date":       date_val,
-                        "day":        day_val,
-                        "start_time": start_val,
-                        "end_time":   end_val,
-                        "remarks":    remarks_val
-                    }
-
-                else:
-                    # neither format recognized
-                    continue
-
-                all_events.append(ev)
-                
-            if any("timestamp" in ev for ev in all_events):
-                all_events.sort(key=lambda x: x["timestamp"])
-
-    # Step 2: Ensure required documents exist
-    if not all(req in uploaded_doc_types for req in REQUIRED_DOCUMENTS):
-        st.error("❌ Please upload both Contract and SoF files. They are required for clause–remark matching.")
+
+def keep_last_run(result: dict) -> dict:
+    """
+    Everything the results section needs, computed once and kept in session
+    state: a download click reruns the script, and the results and the other
+    downloads must still be there afterwards.
+    """
+    return {
+        "result": result,
+        "stamp": datetime.now().strftime('%Y%m%d_%H%M%S'),
+        # ✅ Serialize every format in memory from one pass over the rows
+        "exports": export_result(result) if result["workbook"] is not None else {},
+        "grid": sensitivity_from_result(result),
+    }
+
+
+def show_last_run(last_run: dict):
+    """Render the kept run: deductions, pumping stoppages, downloads and the what-if grid."""
+    result = last_run["result"]
+    deductions = result["deductions"]
+    recomputed = result.get("recomputed") or [True] * len(deductions)
+
+    if result.get("revision"):
+        rev = result["revision"]
+        st.info(
+            f"🔁 Revised SoF: {rev['recomputed_rows']} of {rev['total_rows']} rows recomputed "
+            "(marked 🔁); the others reuse the previous version's decisions."
+        )
+
+    # ✅ Display deductions
+    for i, d in enumerate(deductions):
+        is_deducted = d.get("deduct", False)
+        confidence = d.get("confidence_score", 0.0)
+        color = "green" if is_deducted else "orange"
+
+        marker = "🔁 " if result.get("revision") and recomputed[i] else ""
+        title = f"{marker}Event: {d.get('Remark', 'N/A')[:70]}..."
+
+        with st.expander(title):
+            st.markdown(f"**Matched Clause:** {d.get('Clause', 'N/A')}")
+            st.markdown(f"**Confidence Score:** `{confidence:.2f}`")
+            st.markdown(f"**Deduct from Laytime:** :{color}[{'Yes' if is_deducted else 'No'}]")
+            st.markdown(f"**Reason:** {d.get('reason', 'N/A')}")
+            st.markdown(f"**From:** `{d.get('deducted_from', 'N/A')}` | **To:** `{d.get('deducted_to', 'N/A')}`")
+            st.markdown(f"**Hours:** `{d.get('total_hours', 0.0)}`")
+            if d.get("evidence"):
+                st.markdown(f"**Pumping Log:** `{d['evidence']}`")
+
+    # 🛢️ Pumping-log stoppages and rate shortfalls, with their evidence
+    pumping = result.get("pumping")
+    if pumping and pumping["candidates"]:
+        st.header("🛢️ Pumping Log Stoppages")
+        st.caption(
+            f"Mean rate {pumping['summary']['mean_rate']:g}/h vs "
+            f"{pumping['summary']['required_rate'] or 'n/a'}/h required (DISRATE / 24)."
+        )
+        st.dataframe([
+            {"from": c["from"], "to": c["to"], "kind": c["kind"],
+             "reported_in_sof": c not in pumping["unreported"], **c["evidence"]}
+            for c in pumping["candidates"]
+        ])
+
+    stamp = last_run["stamp"]
+    exports = last_run["exports"]
+    if exports:
+        cols = st.columns(len(exports))
+        for col, (fmt, data) in zip(cols, exports.items()):
+            with col:
+                st.download_button(
+                    label=f"📥 Download {fmt.upper()}",
+                    data=data,
+                    file_name=f"Laytime_Metadata_{stamp}.{fmt}",
+                    mime=MIME_TYPES[fmt],
+                    key=f"dl_{stamp}_{fmt}",
+                )
+
+    # 📊 What-if grid: NOR delay × disrate × rates × toggled deductions
+    grid = last_run["grid"]
+    if grid is not None:
+        import altair as alt
+
+        st.header("📊 What-if Sensitivity")
+        st.caption(
+            f"{grid.amount.size:,} scenarios. Positive = demurrage payable, negative = despatch earned "
+            "(contract demurrage/despatch rates, deductions as analysed)."
+        )
+        heat = grid.heatmap(
+            demurrage_idx=len(grid.demurrage_rates) // 2, despatch_idx=len(grid.despatch_rates) // 2
+        ).stack().rename("amount").reset_index()
+        st.altair_chart(
+            alt.Chart(heat).mark_rect().encode(
+                x="disrate:O", y="nor_delay_h:O",
+                color=alt.Color("amount:Q", scale=alt.Scale(scheme="redblue", reverse=True, domainMid=0)),
+                tooltip=["nor_delay_h", "disrate", alt.Tooltip("amount:Q", format=",.0f")],
+            ),
+            use_container_width=True,
+        )
+        st.dataframe(grid.to_frame())
+        st.download_button(
+            label="📥 Download Sensitivity CSV",
+            data=grid.to_csv_bytes(),
+            file_name=f"Laytime_Sensitivity_{stamp}.csv",
+            mime=MIME_TYPES["csv"],
+            key=f"dl_{stamp}_sensitivity",
+        )
+
+
+if SERVICE_URL:
+    # Thin client: the voyage runs in the service's worker pool, not in this script run
+    client = ServiceClient(SERVICE_URL)
+    if st.button("Extract and Analyze") and uploaded_files:
+        st.session_state["job_id"] = client.submit_files([(f.name, f.getvalue()) for f in uploaded_files])
+
+    job_id = st.session_state.get("job_id")
+    if job_id:
+        status = st.empty()
+        job = client.wait(
+            job_id,
+            on_update=lambda j: status.info(
+                f"⏳ Job `{j['id'][:8]}`: {j['state']}"
+                + (f" (position {j['position']} in queue)" if j.get("position") else "")
+            ),
+        )
+        status.empty()
+        show_service_job(client, job)
     else:
-        st.success("✅ Required documents uploaded and processed successfully.")
-       
-        # Step 2.5: Club Events by Working Hours
-        st.header("🗓️ Chronological Events")
-
-        def build_event_blocks(events):
-            blocks = []
-            ranges = []
-            # 1) Turn each raw event into a (start, end, label, reason) tuple
-            for idx, e in enumerate(events):
-                # Case A: split-fields event
-                if e.get("date") and (e.get("start_time") or e.get("time")):
-                    # parse with dayfirst=True for “DD/MM/YYYY”
-                    start_time = e.get("start_time") or e.get("time")
-                    end_dt = None
-                    date_str = e["date"]
-                    day_str  = e.get("day", "")
-                    start_dt = parser.parse(f"{date_str} {start_time}", dayfirst=True)
-                    if e.get("end_time"):
-                        end_dt = parser.parse(f"{date_str} {e['end_time']}", dayfirst=True)
-                    label  = e.get("Event", "")
-                    reason = e.get("Remarks") or e.get("remarks") or ""
-                    ranges.append((date_str, day_str, start_dt, end_dt, label, reason))
-
-                # Case B: timestamped events to be paired
-                elif e.get("timestamp") and idx + 1 < len(events) and events[idx+1].get("timestamp"):
-                    start_dt = e["timestamp"]
-                    end_dt   = events[idx+1]["timestamp"]
-                    label    = e.get("event", "")
-                    reason   = e.get("remarks", "")
-                    ranges.append(("", "", start_dt, end_dt, label, reason))
-
-            # # 2) For each (start, end), slice into working-hour blocks
-            for date_str, day_str, start_dt, end_dt, label, reason in ranges:
-                if end_dt is None:
-                    blk = {
-                        "date":        date_str,
-                        "day":         day_str,
-                        "start_time":  start_dt.strftime("%Y-%m-%d %H:%M"),
-                        "end_time":    None,
-                        "reason":      reason
-                    }
-                    if label:
-                        blk["event_phase"] = label
-                    blocks.append(blk)
-                    continue
-                else:
-                    blk = {
-                        "date":        date_str,
-                        "day":         day_str,
-                        "start_time":  start_dt.strftime("%Y-%m-%d %H:%M"),
-                        "end_time":    end_dt.strftime("%Y-%m-%d %H:%M"),
-                        "reason":      reason
-                    }
-                    if label:
-                        blk["event_phase"] = label
-                    blocks.append(blk)
-
-            return blocks
-                # curr = start_dt
-                # while curr < end_dt:
-            #         ws, we = get_working_hours(curr)
-            #         if ws and we:
-            #             seg_start = max(curr, ws)
-            #             seg_end   = min(end_dt, we)
-            #             if seg_start < seg_end:
-            #                 blk = {
-            #                     "date" : date_str,
-            #                     "day" : day_str,
-            #                     "start_time": seg_start.strftime("%Y-%m-%d %H:%M"),
-            #                     "end_time":   seg_end.strftime("%Y-%m-%d %H:%M"),
-            #                     "reason":     reason
-            #                 }
-            #                 if label:
-            #                     blk["event_phase"] = label
-            #                 blocks.append(blk)
-            #         else:
-            #             blk = {
-            #                     "date" : date_str,
-            #                     "day" : day_str,
-            #                     "start_time": curr.strftime("%Y-%m-%d %H:%M"),
-            #                     "end_time":   end_dt.strftime("%Y-%m-%d %H:%M"),
-            #                     "reason":     reason
-            #                 }
-            #             if label:
-            #                 blk["event_phase"] = label
-            #             blocks.append(blk)
-            #         # bump to next calendar day midnight
-            #         curr = (curr + timedelta(days=1)).replace(hour=0, minute=0)
-            # return ranges
-            
-            
-
-        # …later…
-        blocks = build_event_blocks(all_events)
-
-        # Step 2.5: Insert NOR split 
-
-        nor_df = split_nor_period(pd.DataFrame(blocks), metadata["LTC AT"])
-
-        # adjusted_nor_df = nor_df.copy()
-
-        # # Ensure 'date' is a proper date (not datetime) for grouping
-        # adjusted_nor_df['date'] = pd.to_datetime(
-        #     adjusted_nor_df['date'],
-        #     dayfirst=True
-        # ).dt.date
-
-        # # 1) NATIONAL HOLIDAYS
-        # # Identify dates where reason mentions 'holiday'
-        # holiday_dates = adjusted_nor_df[
-        #     adjusted_nor_df['reason'].str.contains('holiday', case=False, na=False)
-        # ]['date'].unique()
-
-        # # Build one full-day row per holiday date
-        # holiday_rows = pd.DataFrame({
-        #     'date':    holiday_dates,
-        #     'day':     [pd.to_datetime(d).day_name() for d in holiday_dates],
-        #     'start_time': ['00:00'] * len(holiday_dates),
-        #     'end_time':   ['23:59'] * len(holiday_dates),
-        #     'reason': ['National Holiday'] * len(holiday_dates)
-        # })
-
-        # # 2) SUNDAYS
-        # # Identify all Sundays in the data
-        # sunday_mask = pd.to_datetime(adjusted_nor_df['date']).dt.dayofweek == 6  # Monday=0 … Sunday=6
-        # sunday_dates = adjusted_nor_df[sunday_mask]['date'].unique()
-
-        # # Build one full-day row per Sunday
-        # sunday_rows = pd.DataFrame({
-        #     'date':    sunday_dates,
-        #     'day':     ['Sunday'] * len(sunday_dates),
-        #     'start_time': ['00:00'] * len(sunday_dates),
-        #     'end_time':   ['23:59'] * len(sunday_dates),
-        #     'reason': ['Sunday'] * len(sunday_dates)
-        # })
-
-        # # 3) FILTER OUT original holiday/Sunday events
-        # filtered = adjusted_nor_df[
-        #     ~(
-        #         adjusted_nor_df['date'].isin(holiday_dates) |
-        #         pd.to_datetime(adjusted_nor_df['date']).dt.dayofweek.eq(6)
-        #     )
-        # ]
-
-        # # 4) CONCATENATE & SORT
-        # adjusted_nor_df = pd.concat([filtered, holiday_rows, sunday_rows], ignore_index=True)
-        # adjusted_nor_df = adjusted_nor_df.sort_values(['date', 'start_time']).reset_index(drop=True)
-
-        # # 5) Reorder columns
-        # cols = ['date', 'day', 'start_time', 'end_time', 'reason']
-        # adjusted_nor_df = adjusted_nor_df[cols]
-
-        # # 6) Move Notice of Readiness row(s) to the very top
-        # nor_mask = adjusted_nor_df['reason'].str.contains('notice of readiness period', case=False, na=False)
-        # nor_rows   = adjusted_nor_df[nor_mask]
-        # other_rows = adjusted_nor_df[~nor_mask]
-
-        # adjusted_nor_df = pd.concat([nor_rows, other_rows], ignore_index=True)
-
-        # # 7) Display
-        # st.dataframe(adjusted_nor_df)
-
-        # --- NEW LOGIC FOR GAP FILLING AND FINAL RECORDS using Gemini ---
-        # st.header("✨ Refining Chronological Events with Gemini (Gap Filling)")
-        st.dataframe(nor_df)
-        # Prepare data for Gemini prompt
-        # Ensure date, start_time, end_time columns are strings before sending to Gemini
-        nor_df['date'] = nor_df['date'].astype(str)
-        nor_df['start_time'] = nor_df['start_time'].astype(str)
-        nor_df['end_time'] = nor_df['end_time'].astype(str) # Convert to string, NaNs become "nan"
-
-        events_for_gemini = nor_df.to_dict(orient='records')
-        events_json_string = json.dumps(events_for_gemini, indent=2)
-
-        final_records, _ = chronological_events(events_json_string, blocks)
-        st.markdown(f"final_records:{final_records}")
-
-        # Convert date/time strings in final_records to proper Python objects for sorting
-        # This step is crucial for robust sorting and avoiding ParserErrors.
-        for record in final_records:
-            # Ensure date and time strings are not empty or "nan" or "None" before parsing
-            date_str = str(record.get('date', '')).strip()
-            if date_str.lower() in ['none', 'nan']: date_str = ''
-
-            start_time_str = str(record.get('start_time', '')).strip()
-            if start_time_str.lower() in ['none', 'nan']: start_time_str = ''
-
-            end_time_str = str(record.get('end_time', '')).strip()
-            if end_time_str.lower() in ['none', 'nan']: end_time_str = ''
-
-            record['start_dt_obj'] = None
-            if date_str and start_time_str:
-                try:
-                    # Combine date and time to create full datetime objects for accurate parsing and sorting
-                    record['start_dt_obj'] = parser.parse(f"{date_str} {start_time_str}", dayfirst=True)
-                except Exception as e:
-                    st.warning(f"Could not parse start_datetime for sorting: '{date_str} {start_time_str}'. Error: {e}")
-                    record['start_dt_obj'] = datetime.min # Fallback for sorting
-
-            record['end_dt_obj'] = None
-            if date_str and end_time_str: # This condition is now more reliable
-                try:
-                    record['end_dt_obj'] = parser.parse(f"{date_str} {end_time_str}", dayfirst=True)
-                except Exception as e:
-                    st.warning(f"Could not parse end_datetime for sorting: '{date_str} {end_time_str}'. Error: {e}")
-                    record['end_dt_obj'] = record['start_dt_obj'] if record['start_dt_obj'] else datetime.min # Fallback
-            else: # If end_time_str is empty, default end_dt_obj to start_dt_obj
-                record['end_dt_obj'] = record['start_dt_obj'] if record['start_dt_obj'] else datetime.min
-
-            # If start_dt_obj is still None, assign datetime.min for sorting
-            if record['start_dt_obj'] is None:
-                record['start_dt_obj'] = datetime.min
-
-            # Ensure end_dt_obj is not None for sorting
-            if record['end_dt_obj'] is None:
-                record['end_dt_obj'] = record['start_dt_obj'] # Default to start time if still None
-
-
-        # Sort the final_records by the datetime objects
-        final_records.sort(key=lambda x: x['start_dt_obj'])
-        
-        # Clean up temporary datetime objects and ensure string formats are consistent
-        for record in final_records:
-            record['start_time'] = record['start_dt_obj'].strftime("%Y-%m-%d %H:%M")
-            record['end_time'] = record['end_dt_obj'].strftime("%Y-%m-%d %H:%M")
-            record['date'] = record['start_dt_obj'].strftime("%d/%m/%Y")
-            record['day'] = record['start_dt_obj'].strftime("%A")
-            del record['start_dt_obj']
-            del record['end_dt_obj']
-
-        st.dataframe(final_records)
-  
-        # # Step 4: Deduction Engine (Gemini-powered)
-        st.header("Laytime Deductions (via Gemini)")
-        
-        #records = final_records.to_dict("records")
-        records = final_records
-        deductions = []
-        if 'clause_texts' in locals() and 'records' in locals() and clause_texts and records:
-            st.info(f"Analyzing {len(records)} events against {len(clause_texts)} clauses...")
-
-            for event_record in records:
-                # Prepare the event object for the deduction engine
-                event_obj = {
-                    "date": event_record.get("date"),
-                    "day": event_record.get("day"),
-                    "start_time": event_record.get("start_time"),
-                    "end_time": event_record.get("end_time"),
-                    "reason": event_record.get("reason") or event_record.get("event_phase") or "No reason provided",
-                }
-
-                # Skip events without a clear reason or time range
-                if not event_obj["reason"] or not event_obj["start_time"] or not event_obj["end_time"]:
-                    continue
-
-                # Call the new deduction engine function
-                deduction_result = analyze_event_against_clauses(event_obj, clause_texts)
-
-                # Append result for display and further calculation
-                deductions.append(deduction_result)
-
-            # ✅ Display deductions
-            # st.subheader("🔎 Final Deductions")
-
-            if not deductions:
-                st.warning("⚠️ No valid deductions could be analyzed.")
-            else:
-                for i, d in enumerate(deductions):
-                    is_deducted = d.get("deduct", False)
-                    confidence = d.get("confidence_score", 0.0)
-                    color = "green" if is_deducted else "orange"
-                
-                    title = f"Event: {d.get('Remark', 'N/A')[:70]}..."
-
-                    with st.expander(title):
-                        st.markdown(f"**Matched Clause:** {d.get('Clause', 'N/A')}")
-                        st.markdown(f"**Confidence Score:** `{confidence:.2f}`")
-                        st.markdown(f"**Deduct from Laytime:** :{color}[{'Yes' if is_deducted else 'No'}]")
-                        st.markdown(f"**Reason:** {d.get('reason', 'N/A')}")
-                        st.markdown(f"**From:** `{d.get('deducted_from', 'N/A')}` | **To:** `{d.get('deducted_to', 'N/A')}`")
-                        st.markdown(f"**Hours:** `{d.get('total_hours', 0.0)}`")
-
-        else:
-            st.warning("⚠️ Cannot run deduction engine. Clause texts or event records are missing.")
-
-        # Step 5: Final Laytime Summary
-        if records and deductions:
-            calc = LaytimeCalculator(records, deductions)
-            total = calc.total_block_hours()
-            deduc = calc.total_deduction_hours()
-            net   = calc.net_laytime_hours()
-
-            st.header("🧮 Laytime Calculation Summary")
-            st.markdown(f"- **Total Working-Hour Blocks:** {total:.2f} hrs")
-            st.markdown(f"- **Total Deductions:**          {deduc:.2f} hrs")
-            st.markdown(f"- **Net Laytime Used:**         {net:.2f} hrs")
-
-        # Final block: generate Excel if both Contract and SoF were extracted
-        if "Contract" in extracted_data and "SoF" in extracted_data:
-            contract_raw = extracted_data["Contract"]
-            sof_raw = extracted_data["SoF"]
-
-            # 🔄 Extract structured metadata + events using Gemini
-            metadata_response, raw_response = extract_metadata_from_docs(contract_raw, sof_raw)
-
-            for k, v in metadata.items():
-                if v is not None: 
-                    metadata_response[k] = v
-
-            # ✅ Build Excel workbook using new format
-            net_laytime_used_hours = net if 'net' in locals() else 0.0
-            excel_wb = generate_excel_from_extracted_data(metadata_response, deductions, net_laytime_used_hours)
-            excel_filename = f"Laytime_Metadata_{datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx"
-
-            # ✅ Save Excel to temp file
-            with tempfile.NamedTemporaryFile(delete=False, suffix=".xlsx") as tmp_xlsx:
-                excel_wb.save(tmp_xlsx.name)
-                tmp_xlsx.seek(0)
-                with open(tmp_xlsx.name, "rb") as f:
-                    st.download_button(
-                        label="📥 Download Laytime Metadata Report",
-                        data=f.read(),
-                        file_name=excel_filename,
-                        mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
-                    )
-
-else:
-    st.info("📎 Please upload required documents and click 'Extract and Analyze' to continue.")
\ No newline at end of file
+        st.info("📎 Please upload required documents and click 'Extract and Analyze' to continue.")
+
+elif st.button("Extract and Analyze") and uploaded_files:
+    st.session_state.pop("last_run", None)
+    ctx = get_script_run_ctx()
+    session_id = ctx.session_id if ctx else None
+    # Everything written for this run lives in the session's scratch dir and is removed when the run ends
+    with SessionScratch(session_id) as scratch:
+        files = [(f.name, scratch.spool(f, f.name)) for f in uploaded_files]
+
+        # A Stop click interrupts the run at its next budget check; the budget stays
+        # registered for the Stop callback until the run's model calls have exited
+        interrupted = []
+        budget = RunBudget(checks=[rerun_check(interrupted)])
+        live_runs()[session_id] = budget
+        st.button("⏹️ Stop", on_click=request_stop)
+        try:
+            result = run_voyage(files, ui=st, store=get_store(), budget=budget)
+        except Cancelled:
+            if interrupted:
+                # Hand the rerun (and the Stop callback) back to Streamlit
+                raise interrupted[0]
+            result = None
+            st.warning("⏹️ Run stopped; in-flight model calls were abandoned.")
+        finally:
+            # Nothing this run started should keep going once it has ended
+            budget.cancel()
+            forget_finished_runs()
+
+        if result is not None:
+            st.session_state["last_run"] = keep_last_run(result)
+
+elif st.session_state.pop("run_stopped", False):
+    st.warning("⏹️ Run stopped; in-flight model calls were abandoned.")
+
+elif not st.session_state.get("last_run"):
+    st.info("📎 Please upload required documents and click 'Extract and Analyze' to continue.")
+
+if not SERVICE_URL and st.session_state.get("last_run"):
+    show_last_run(st.session_state["last_run"])
+
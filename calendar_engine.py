@@ -0,0 +1,198 @@
+# calendar_engine.py
+
+import re
+from datetime import date, timedelta
+from typing import Iterable, Optional
+
+import numpy as np
+
+from event_model import EPOCH, Timeline, format_minutes
+
+# ---------- CONFIG ----------
+DAY = 24 * 60
+PADDING_DAYS = 7          # extra days precomputed around a query range
+MAX_GROW_STEPS = 64       # give up advancing through a calendar with no working time
+WEEKDAY_KEYS = [
+    (r"monday\s*(to|-|–)\s*friday|mon_?fri|weekdays?", range(0, 5)),
+    (r"saturday|\bsat\b", [5]),
+    (r"sunday|\bsun\b", [6]),
+]
+WEEKDAY_NAMES = ["Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday"]
+
+
+def _hhmm(s: str) -> int:
+    h, m = s.split(":")
+    return int(h) * 60 + int(m)
+
+
+def parse_working_hours(data) -> dict:
+    """
+    Find the working-hours entries the contract prompt asks for
+    ("'Monday to Friday' : 'HH:MM to HH:MM'", "'Saturday' : ...") anywhere in
+    the extracted JSON. Returns {weekday: [(start_min, end_min), ...]}.
+    """
+    hours = {}
+
+    def visit(node):
+        if isinstance(node, dict):
+            for k, v in node.items():
+                if isinstance(v, str):
+                    times = re.findall(r"(\d{1,2}:\d{2})", v)
+                    if len(times) >= 2:
+                        for pattern, weekdays in WEEKDAY_KEYS:
+                            if re.search(pattern, str(k), re.IGNORECASE):
+                                # "08:00 to 12:00 and 13:00 to 17:00" → two windows
+                                windows = [(_hhmm(a), _hhmm(b)) for a, b in zip(times[::2], times[1::2]) if _hhmm(b) > _hhmm(a)]
+                                for wd in weekdays:
+                                    hours.setdefault(wd, windows)
+                                break
+                visit(v)
+        elif isinstance(node, list):
+            for item in node:
+                visit(item)
+
+    visit(data)
+    return hours
+
+
+def holiday_days(tl: Timeline) -> list[date]:
+    """Dates of rows the SoF marks as holidays."""
+    mask = tl.matches(r"holiday")
+    return sorted({(EPOCH + timedelta(days=int(m // DAY))).date() for m in tl.start[mask]})
+
+
+class WorkingCalendar:
+    """
+    Counted time for one voyage as a sorted array of working windows (epoch
+    minutes) with a prefix sum of window lengths. Sundays, holidays and
+    out-of-hours time are simply gaps between windows, so every query is a
+    binary search rather than a walk over days.
+    """
+
+    def __init__(self, hours: Optional[dict] = None, holidays: Iterable[date] = (), exclude_sundays: bool = True):
+        self.hours = hours or {}              # weekday -> [(start_min, end_min)]; missing weekday counts in full
+        self.holidays = {(d - EPOCH.date()).days for d in holidays}
+        self.exclude_sundays = exclude_sundays
+        self.first_day = self.last_day = None
+        self.starts = np.empty(0, dtype=np.int64)
+        self.ends = np.empty(0, dtype=np.int64)
+        self.cum = np.zeros(1, dtype=np.int64)
+
+    @classmethod
+    def from_contract(cls, contract_data: dict, terms: str = "", holidays: Iterable[date] = ()) -> "WorkingCalendar":
+        """
+        SHINC (Sundays and holidays included) counts every day; any other
+        terms string (SHEX, ...) excepts Sundays and holidays. Without terms
+        every day counts, as it did before the calendar existed.
+        """
+        terms = str(terms or "").strip().upper()
+        excepted = bool(terms) and "SHINC" not in terms
+        return cls(parse_working_hours(contract_data), holidays if excepted else (), exclude_sundays=excepted)
+
+    # ---------- Precompute ----------
+    def is_excepted(self, day: int) -> bool:
+        weekday = (day + 3) % 7  # 1970-01-01 was a Thursday
+        return day in self.holidays or (self.exclude_sundays and weekday == 6)
+
+    def _build(self, first_day: int, last_day: int):
+        starts, ends = [], []
+        for day in range(first_day, last_day + 1):
+            if self.is_excepted(day):
+                continue
+            for a, b in self.hours.get((day + 3) % 7, [(0, DAY)]):
+                a, b = day * DAY + a, day * DAY + b
+                if ends and ends[-1] == a:
+                    ends[-1] = b         # merge windows that touch across midnight
+                else:
+                    starts.append(a)
+                    ends.append(b)
+        self.first_day, self.last_day = first_day, last_day
+        self.starts = np.array(starts, dtype=np.int64)
+        self.ends = np.array(ends, dtype=np.int64)
+        self.cum = np.concatenate([[0], np.cumsum(self.ends - self.starts)]).astype(np.int64)
+
+    def precompute(self, t0: int, t1: int) -> "WorkingCalendar":
+        """Make sure windows exist for [t0, t1]; grows the range if needed."""
+        d0, d1 = int(t0) // DAY, int(t1) // DAY
+        if self.first_day is None or d0 < self.first_day or d1 > self.last_day:
+            lo = d0 - PADDING_DAYS if self.first_day is None else min(d0 - PADDING_DAYS, self.first_day)
+            hi = d1 + PADDING_DAYS if self.last_day is None else max(d1 + PADDING_DAYS, self.last_day)
+            self._build(lo, hi)
+        return self
+
+    # ---------- Queries ----------
+    def cumulative(self, t):
+        """Counted minutes from the start of the precomputed range up to `t` (scalar or array)."""
+        t = np.asarray(t, dtype=np.int64)
+        if not len(self.starts):
+            return np.zeros_like(t)
+        i = np.searchsorted(self.starts, t, side="right") - 1
+        j = np.maximum(i, 0)
+        inside = np.clip(t - self.starts[j], 0, self.ends[j] - self.starts[j])
+        return np.where(i >= 0, self.cum[j] + inside, 0)
+
+    def counted_minutes(self, t0, t1):
+        """Counted minutes between t0 and t1; works element-wise on arrays."""
+        t0 = np.asarray(t0, dtype=np.int64)
+        t1 = np.maximum(np.asarray(t1, dtype=np.int64), t0)
+        if t0.size:
+            self.precompute(t0.min(), t1.max())
+        out = self.cumulative(t1) - self.cumulative(t0)
+        return int(out) if out.ndim == 0 else out
+
+    def advance(self, t0: int, minutes: int) -> int:
+        """The instant at which `minutes` of counted time have elapsed after t0."""
+        t0, minutes = int(t0), int(minutes)
+        if minutes <= 0:
+            return t0
+        self.precompute(t0, t0)
+        for _ in range(MAX_GROW_STEPS):
+            target = int(self.cumulative(t0)) + minutes
+            if len(self.cum) > 1 and self.cum[-1] >= target:
+                break
+            # not enough working time precomputed yet; grow the range
+            self.precompute(t0, (self.last_day + max(PADDING_DAYS, minutes // DAY + 1)) * DAY)
+        else:
+            raise ValueError("Calendar has no working time to advance into")
+        k = int(np.searchsorted(self.cum, target, side="left")) - 1
+        return int(self.starts[k] + (target - self.cum[k]))
+
+    def split(self, t0: int, t1: int) -> list[tuple[int, int, bool]]:
+        """Split [t0, t1) into (start, end, counted) segments along working windows."""
+        t0, t1 = int(t0), int(t1)
+        if t1 <= t0:
+            return []
+        self.precompute(t0, t1)
+        i0 = np.searchsorted(self.ends, t0, side="right")
+        i1 = np.searchsorted(self.starts, t1, side="left")
+        out, cur = [], t0
+        for a, b in zip(self.starts[i0:i1].tolist(), self.ends[i0:i1].tolist()):
+            a, b = max(a, t0), min(b, t1)
+            if cur < a:
+                out.append((cur, a, False))
+            if a < b:
+                out.append((a, b, True))
+                cur = b
+        if cur < t1:
+            out.append((cur, t1, False))
+        return out
+
+    def excepted_days(self, t0: int, t1: int) -> list[tuple[str, str]]:
+        """(DD/MM/YYYY, label) for each Sunday/holiday between t0 and t1."""
+        out = []
+        for day in range(int(t0) // DAY, int(t1) // DAY + 1):
+            if self.is_excepted(day):
+                label = "National Holiday" if day in self.holidays else "Sunday"
+                out.append((format_minutes(day * DAY, "%d/%m/%Y"), label))
+        return out
+
+    def describe(self) -> str:
+        """Working hours as text for prompts."""
+        if not self.hours:
+            return "All hours count on working days."
+        parts = []
+        for wd in range(7):
+            if wd in self.hours:
+                windows = ", ".join(f"{a // 60:02d}:{a % 60:02d}-{b // 60:02d}:{b % 60:02d}" for a, b in self.hours[wd])
+                parts.append(f"{WEEKDAY_NAMES[wd]} {windows}")
+        return "; ".join(parts)
@@ -0,0 +1,158 @@
+# cassette.py
+
+import os
+import gzip
+import json
+import time
+import atexit
+import hashlib
+import threading
+from collections import defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Optional
+
+# ---------- CONFIG ----------
+# LAYTIME_CASSETTE=run.cassette.gz LAYTIME_CASSETTE_MODE=record|replay [LAYTIME_REPLAY_LATENCY=1]
+CASSETTE_PATH = os.getenv("LAYTIME_CASSETTE")
+CASSETTE_MODE = os.getenv("LAYTIME_CASSETTE_MODE", "replay" if CASSETTE_PATH and os.path.exists(CASSETTE_PATH) else "record")
+REPLAY_LATENCY = os.getenv("LAYTIME_REPLAY_LATENCY", "0") == "1"
+MODES = ("record", "replay")
+
+
+class CassetteMiss(KeyError):
+    """Replay mode got a request that was never recorded."""
+
+
+def _file_digest(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def request_key(model_name: str, contents, files=(), options: Optional[dict] = None) -> str:
+    """Stable hash of everything that shapes a model response; files count by content, not path."""
+    payload = json.dumps(
+        {
+            "model": model_name,
+            "contents": contents if isinstance(contents, list) else [contents],
+            "files": [_file_digest(p) for p in files],
+            "options": options or {},
+        },
+        sort_keys=True, default=str, separators=(",", ":"),
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class Cassette:
+    """
+    Recorded model interactions in one gzipped JSON-lines file, one entry per
+    call: {key, stage, model, latency_s, text, error}. Identical requests are
+    kept in call order and replayed in the same order.
+    """
+
+    def __init__(self, path: str, mode: str = "replay", replay_latency: bool = False):
+        if mode not in MODES:
+            raise ValueError(f"Unknown cassette mode {mode!r}, expected one of {MODES}")
+        self.path = path
+        self.mode = mode
+        self.replay_latency = replay_latency
+        self._lock = threading.Lock()
+        self._entries = defaultdict(list)
+        self._cursor = defaultdict(int)
+        self._new = 0
+        if os.path.exists(path):
+            with gzip.open(path, "rt", encoding="utf-8") as f:
+                for line in f:
+                    if line.strip():
+                        entry = json.loads(line)
+                        self._entries[entry["key"]].append(entry)
+        elif mode == "replay":
+            raise FileNotFoundError(f"No cassette at {path}")
+
+    def __len__(self):
+        return sum(len(v) for v in self._entries.values())
+
+    def play(self, key: str, **request) -> dict:
+        """
+        Next recorded entry for `key`, sleeping for its latency if asked to.
+        `request` (stage, model_name, contents, files) is only for synthetic
+        players that answer without a recording.
+        """
+        with self._lock:
+            entries = self._entries.get(key)
+            if not entries:
+                raise CassetteMiss(f"Request {key[:12]} is not in cassette {self.path}")
+            i = self._cursor[key]
+            self._cursor[key] = i + 1
+            # More calls than recordings: keep serving the last one
+            entry = entries[min(i, len(entries) - 1)]
+        if self.replay_latency:
+            time.sleep(entry.get("latency_s", 0.0))
+        return entry
+
+    def record(self, key: str, stage: str, model_name: str, latency_s: float,
+               text: Optional[str] = None, error: Optional[str] = None):
+        with self._lock:
+            self._entries[key].append({
+                "key": key, "stage": stage, "model": model_name,
+                "latency_s": round(latency_s, 4), "text": text, "error": error,
+            })
+            self._new += 1
+
+    def save(self):
+        """Write the cassette atomically (temp file + rename)."""
+        with self._lock:
+            if self.mode != "record" or not self._new:
+                return
+            tmp = f"{self.path}.tmp"
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            with gzip.open(tmp, "wt", encoding="utf-8") as f:
+                for entries in self._entries.values():
+                    for entry in entries:
+                        f.write(json.dumps(entry, separators=(",", ":")) + "\n")
+            os.replace(tmp, self.path)
+            self._new = 0
+
+
+# Per context, like the run budget in deadlines.py, so concurrent sessions on threads don't share one
+_active: ContextVar[Optional[Cassette]] = ContextVar("laytime_cassette", default=None)
+_default: Optional[Cassette] = None     # LAYTIME_CASSETTE: every context records/replays
+
+
+def active_cassette() -> Optional[Cassette]:
+    return _active.get() or _default
+
+
+@contextmanager
+def use_cassette(path: str, mode: str = "replay", replay_latency: bool = False):
+    """Record or replay every model call made inside the block (in this context)."""
+    cassette = Cassette(path, mode, replay_latency)
+    token = _active.set(cassette)
+    try:
+        yield cassette
+    finally:
+        cassette.save()
+        _active.reset(token)
+
+
+@contextmanager
+def use_player(player):
+    """
+    Serve every model call made inside the block (in this context) from
+    `player`: any object with mode = "replay" and play(key, **request) ->
+    {"text", "error", "latency_s"}. The load-test harness uses this for its
+    synthetic backend. Threads started inside need contextvars.copy_context().
+    """
+    token = _active.set(player)
+    try:
+        yield player
+    finally:
+        _active.reset(token)
+
+
+if CASSETTE_PATH:
+    _default = Cassette(CASSETTE_PATH, CASSETTE_MODE, REPLAY_LATENCY)
+    atexit.register(_default.save)
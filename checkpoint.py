@@ -0,0 +1,130 @@
+# checkpoint.py
+
+import os
+import gzip
+import json
+import time
+import shutil
+import threading
+import hashlib
+from typing import Iterable
+
+import numpy as np
+
+from event_model import MISSING, Timeline
+
+# ---------- CONFIG ----------
+CHECKPOINT_DIR = os.getenv("LAYTIME_CHECKPOINTS", "laytime_checkpoints")   # "" disables checkpointing
+CHECKPOINT_TTL_SECONDS = 3 * 24 * 3600     # unfinished voyages older than this are pruned
+
+
+def input_key(*parts) -> str:
+    """Stable hash of a stage's inputs."""
+    payload = json.dumps(parts, sort_keys=True, default=str, separators=(",", ":"))
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()[:32]
+
+
+def timeline_to_json(tl: Timeline) -> dict:
+    """Columnar form: much smaller than per-row records."""
+    return {
+        "start": tl.start.tolist(),
+        "end": [None if e == MISSING else int(e) for e in tl.end],
+        "reason": list(tl.reason),
+        "phase": list(tl.phase),
+        "source": list(tl.source),
+    }
+
+
+def timeline_from_json(d: dict) -> Timeline:
+    return Timeline(
+        d["start"],
+        np.array([MISSING if e is None else e for e in d["end"]], dtype=np.int64),
+        d["reason"], d["phase"], d["source"],
+    )
+
+
+class Checkpoints:
+    """
+    Per-voyage stage outputs on disk, one gzipped JSON file per unit
+    (<root>/<voyage key>/<stage>/<input key>.json.gz). Files are written to a
+    temp name, fsynced and renamed, so a crash leaves either the old state or
+    the new one, never a partial file.
+    """
+
+    def __init__(self, voyage_key: str, root: str = CHECKPOINT_DIR):
+        self.voyage_key = voyage_key
+        self.enabled = bool(root)
+        self.path = os.path.join(root, voyage_key) if root else ""
+        self.loaded = 0
+        self.saved = 0
+
+    @classmethod
+    def for_files(cls, file_hashes: Iterable[str], root: str = CHECKPOINT_DIR) -> "Checkpoints":
+        """The voyage is identified by its input documents, in any order."""
+        if root:
+            prune_stale(root)
+        return cls(input_key(sorted(file_hashes)), root)
+
+    def _file(self, stage: str, key: str) -> str:
+        return os.path.join(self.path, stage, f"{key}.json.gz")
+
+    def load(self, stage: str, key: str):
+        if not self.enabled:
+            return None
+        path = self._file(stage, key)
+        try:
+            with gzip.open(path, "rt", encoding="utf-8") as f:
+                value = json.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, EOFError, json.JSONDecodeError) as e:
+            # Unreadable despite the atomic write (disk error): treat as missing
+            print(f"⚠️ Ignoring unreadable checkpoint {path}: {e}")
+            return None
+        self.loaded += 1
+        return value
+
+    def save(self, stage: str, key: str, value):
+        if not self.enabled:
+            return
+        path = self._file(stage, key)
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(tmp, "wb") as raw:
+                with gzip.GzipFile(fileobj=raw, mode="wb", mtime=0) as f:
+                    f.write(json.dumps(value, separators=(",", ":"), default=str).encode("utf-8"))
+                raw.flush()
+                os.fsync(raw.fileno())
+            os.replace(tmp, path)
+        except OSError as e:
+            # A lost checkpoint only costs a redo on resume; never fail the run for it
+            # (e.g. a concurrent run of the same files just cleared the directory)
+            print(f"⚠️ Could not write checkpoint {path}: {e}")
+            return
+        self.saved += 1
+
+    def clear(self):
+        """Drop this voyage's checkpoints once its run has completed."""
+        if self.enabled:
+            shutil.rmtree(self.path, ignore_errors=True)
+
+
+def prune_stale(root: str = CHECKPOINT_DIR, max_age: float = CHECKPOINT_TTL_SECONDS) -> int:
+    """Remove checkpoints of voyages nobody has resumed for `max_age` seconds."""
+    if not root or not os.path.isdir(root):
+        return 0
+    removed = 0
+    now = time.time()
+    for name in os.listdir(root):
+        path = os.path.join(root, name)
+        try:
+            if os.path.isdir(path) and now - os.path.getmtime(path) > max_age:
+                shutil.rmtree(path, ignore_errors=True)
+                removed += 1
+        except OSError:
+            continue
+    return removed
+
+
+NO_CHECKPOINTS = Checkpoints("", root="")     # default for callers outside run_voyage
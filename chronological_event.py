@@ -1,8 +1,11 @@
-import os, json
-import time
+import os
 from google.cloud import aiplatform
 import google.generativeai as genai
 
+from gemini_client import generate_json
+from prompt_codec import squeeze
+from deadlines import BudgetError
+
 # ---------- CONFIG ----------
 PROJECT_ID = "laytimecalculation"
 LOCATION = "global"
@@ -12,17 +15,34 @@ MODEL = "models/gemini-1.5-flash-latest"
 aiplatform.init(project=PROJECT_ID, location=LOCATION)
 genai.configure(api_key=os.getenv("GOOGLE_API_KEY"))
 
-def chronological_events(events_json_string, blocks):
-    model = genai.GenerativeModel(MODEL)
+def calendar_notes(calendar, blocks) -> str:
+    """Working hours and the Sundays/holidays in the voyage, so the model doesn't infer them."""
+    if calendar is None or not len(blocks):
+        return ""
+    days = calendar.excepted_days(int(blocks.start.min()), int(blocks.effective_end().max()))
+    listed = ", ".join(f"{d} ({label})" for d, label in days) or "none"
+    return f"""
+            Voyage calendar (use it for rules 5 and 6):
+            - Working hours: {calendar.describe()}
+            - Sundays/holidays in this voyage: {listed}
+    """
+
+
+def chronological_events(events_json_string, blocks, calendar=None):
+    """
+    Gap-fill a table of events (prompt_codec.events_table: one block per
+    date, "-" for a missing end_time). Returns (records, raw).
+    """
 
     prompt = f"""
         You are an expert maritime assistant.
 
         Given the following chronological list of time blocks (events), your task is to identify and fill any temporal gaps between consecutive events. For each gap identified, you must insert a new event block with an inferred reason, from the "events_json_string" of corresponding date and time.
 
-            Input Events (JSON array):
-            ```json
-            events_json_string: {events_json_string}
+            Input Events (one table per date, columns separated by "|"; end_time "-" means null):
+            ```events
+            events_json_string:
+            {events_json_string}
             ```
 
             Rules for Gap Filling and Reason Assignment:
@@ -46,19 +66,15 @@ def chronological_events(events_json_string, blocks):
             7. **Make sure there is start_time and end_time for every row. 
             8. **The last entry should be of when the discharging has completed at a particular berth. Remove all the events after that. Eg: Completed discharging operations at Vicentin Berth. The end_time of this event should be the same the start_time if the end_time is originally empty.
             Ensure the output is *only* the JSON array, with no additional text or commentary.
-    s"""
+    s""" + calendar_notes(calendar, blocks)
+    prompt = squeeze(prompt)
 
     try:
       
-        response = model.generate_content(prompt)
-        raw = response.text.strip()
-
-        # Extract only JSON part
-        json_start = raw.find("[")
-        json_end = raw.rfind("]") + 1
-        json_clean = raw[json_start:json_end]
-
-        return json.loads(json_clean), raw
+        # Only the JSON array; a cut-off answer is repaired and continued
+        return generate_json(MODEL, prompt, stage="gap_fill", expect="array")
 
+    except BudgetError:
+        raise
     except Exception as e:
-        return {"error": str(e)}, response.text if 'response' in locals() else ""
+        return {"error": str(e)}, ""
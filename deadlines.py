@@ -0,0 +1,244 @@
+# deadlines.py
+
+import os
+import time
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Callable, Iterable, Optional
+
+# ---------- CONFIG ----------
+PIPELINE_BUDGET_SECONDS = float(os.getenv("LAYTIME_BUDGET_SECONDS", "900"))   # whole voyage, 0 = unlimited
+CALL_DEADLINES = {                  # seconds per model call, by stage
+    "extraction": 180,
+    "gap_fill": 180,
+    "metadata": 60,
+    "deduction": 45,
+    "default": 120,
+}
+POLL_SECONDS = 0.2                  # how often a waiting call looks for cancellation
+CALL_WORKERS = 16                   # model calls running at once
+MAX_ABANDONED_CALLS = 16            # calls given up on but still running, on top of CALL_WORKERS
+
+# Every running call holds a live or an abandoned slot, so the pool always has a thread for a live one
+_executor = ThreadPoolExecutor(max_workers=CALL_WORKERS + MAX_ABANDONED_CALLS, thread_name_prefix="model-call")
+_live_slots = threading.BoundedSemaphore(CALL_WORKERS)
+_abandoned_slots = threading.BoundedSemaphore(MAX_ABANDONED_CALLS)
+_current: ContextVar[Optional["RunBudget"]] = ContextVar("laytime_budget", default=None)
+
+
+class DeadlineExceeded(TimeoutError):
+    """A single model call ran past its deadline; handled like any other failed call."""
+
+
+class BudgetError(Exception):
+    """Base for budget / cancellation stops; never swallowed as a model failure."""
+
+
+class BudgetExhausted(BudgetError):
+    """The pipeline's overall time budget is used up."""
+
+
+class Cancelled(BudgetError):
+    """The user stopped or reran the session."""
+
+
+class RunBudget:
+    """
+    Overall time budget and cancellation flag for one pipeline run. `checks`
+    are extra callables polled for cancellation (e.g. Streamlit's stop/rerun
+    request). Degradations taken because of the budget are recorded in
+    `degraded`. Its model calls are tracked until their threads finish, even
+    after they were abandoned (`busy`).
+    """
+
+    def __init__(self, seconds: float = PIPELINE_BUDGET_SECONDS, checks: Iterable[Callable[[], bool]] = ()):
+        self.started = time.monotonic()
+        self.deadline = self.started + seconds if seconds else None
+        self.checks = list(checks)
+        self.degraded = []
+        self._cancel = threading.Event()
+        self._lock = threading.Lock()
+        self._calls = set()
+
+    def cancel(self):
+        self._cancel.set()
+
+    def track(self, future: Future):
+        with self._lock:
+            self._calls.add(future)
+        future.add_done_callback(self._untrack)
+
+    def _untrack(self, future: Future):
+        with self._lock:
+            self._calls.discard(future)
+
+    def busy(self) -> bool:
+        """True while any model call of this run still holds a thread."""
+        with self._lock:
+            return bool(self._calls)
+
+    def cancelled(self) -> bool:
+        if not self._cancel.is_set() and any(check() for check in self.checks):
+            self._cancel.set()
+        return self._cancel.is_set()
+
+    def remaining(self) -> float:
+        return float("inf") if self.deadline is None else max(self.deadline - time.monotonic(), 0.0)
+
+    def expired(self) -> bool:
+        return self.remaining() <= 0
+
+    def elapsed(self) -> float:
+        return time.monotonic() - self.started
+
+    def check(self):
+        """Raise Cancelled or BudgetExhausted; call between units of work."""
+        if self.cancelled():
+            raise Cancelled("Run cancelled")
+        if self.expired():
+            raise BudgetExhausted(f"Time budget exhausted after {self.elapsed():.0f}s")
+
+    def note(self, stage: str, action: str):
+        """Record a fallback taken because of the budget."""
+        self.degraded.append({"stage": stage, "action": action, "at_seconds": round(self.elapsed(), 1)})
+        print(f"⏱️ {stage}: {action}")
+
+
+def current_budget() -> Optional[RunBudget]:
+    return _current.get()
+
+
+@contextmanager
+def run_budget(budget: RunBudget):
+    """Make `budget` the one model calls in this context check against."""
+    token = _current.set(budget)
+    try:
+        yield budget
+    finally:
+        _current.reset(token)
+
+
+def call_timeout(stage: str, budget: Optional[RunBudget] = None) -> float:
+    """Per-call deadline for a stage, never past the end of the run's budget."""
+    budget = budget or current_budget()
+    timeout = float(CALL_DEADLINES.get(stage, CALL_DEADLINES["default"]))
+    return min(timeout, budget.remaining()) if budget is not None else timeout
+
+
+class _Slot:
+    """The pool capacity one call holds: a live slot, traded for an abandoned one when its caller gives up."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._held = _live_slots
+        self._released = False
+
+    def abandon(self):
+        with self._lock:
+            # With no abandoned slot left the call keeps its live one, so live calls can't outgrow the pool
+            if not self._released and self._held is _live_slots and _abandoned_slots.acquire(blocking=False):
+                _live_slots.release()
+                self._held = _abandoned_slots
+
+    def release(self, _future=None):
+        with self._lock:
+            if not self._released:
+                self._released = True
+                self._held.release()
+
+
+def _start(fn: Callable, budget: Optional[RunBudget], wait_until: Optional[float],
+           admit: Optional[Callable[[], bool]] = None) -> Optional[Future]:
+    """
+    Submit `fn` once a live slot is free, checking for cancellation while it
+    waits until `wait_until` (None: don't wait) and, with a slot in hand,
+    only if `admit()` agrees. Returns None if the call wasn't started.
+    """
+    while not _live_slots.acquire(timeout=POLL_SECONDS if wait_until is not None else 0):
+        if wait_until is None or time.monotonic() >= wait_until:
+            return None
+        if budget is not None:
+            budget.check()
+    if admit is not None and not admit():
+        _live_slots.release()
+        return None
+    slot = _Slot()
+    future = _executor.submit(fn)
+    future.slot = slot
+    future.add_done_callback(slot.release)
+    if budget is not None:
+        budget.track(future)
+    return future
+
+
+def call_with_deadline(fn: Callable, stage: str = "default", budget: Optional[RunBudget] = None,
+                       hedge_after: Optional[float] = None, may_hedge: Optional[Callable[[], bool]] = None,
+                       valid: Callable = bool, stats: Optional[dict] = None):
+    """
+    Run a blocking call on a worker thread and wait for it, at most the
+    stage's deadline, checking for cancellation every POLL_SECONDS. A call
+    that is abandoned keeps its thread until its own request timeout fires,
+    but the pipeline moves on immediately; it stops counting against the
+    CALL_WORKERS live calls while there is room for it among the
+    MAX_ABANDONED_CALLS.
+
+    With `hedge_after`, a call still running after that many seconds gets one
+    duplicate (if `may_hedge()` allows it) and the first valid result wins.
+    `stats`, if given, is filled with {"hedged", "hedge_won"}.
+    """
+    budget = budget or current_budget()
+    if budget is not None:
+        budget.check()
+    timeout = call_timeout(stage, budget)
+    started = time.monotonic()
+    end = started + timeout
+    primary = _start(fn, budget, end)
+    if primary is None:
+        raise DeadlineExceeded(f"{stage} call found no free worker within its {timeout:g}s deadline")
+    pending = {primary: "primary"}
+    hedge_at = started + hedge_after if hedge_after is not None and may_hedge is not None else None
+    first_error = None
+    stats = stats if stats is not None else {}
+    stats.update(hedged=False, hedge_won=False)
+
+    def abandon():
+        for f in pending:
+            if not f.cancel():
+                f.slot.abandon()
+
+    while True:
+        now = time.monotonic()
+        wake = min(POLL_SECONDS, max(end - now, 0.0))
+        if hedge_at is not None:
+            wake = min(wake, max(hedge_at - now, 0.0))
+        done, _ = wait(list(pending), timeout=wake, return_when=FIRST_COMPLETED)
+
+        for f in done:
+            label = pending.pop(f)
+            error = f.exception()
+            if error is None and valid(f.result()):
+                abandon()
+                stats["hedge_won"] = label == "hedge"
+                return f.result()
+            first_error = first_error or error or ValueError(f"Invalid {stage} response")
+        if not pending:
+            raise first_error
+
+        if hedge_at is not None and time.monotonic() >= hedge_at:
+            hedge_at = None
+            # A hedge only takes a slot that is free right now
+            hedge = _start(fn, budget, None, admit=may_hedge)
+            if hedge is not None:
+                pending[hedge] = "hedge"
+                stats["hedged"] = True
+
+        if budget is not None and budget.cancelled():
+            abandon()
+            raise Cancelled(f"{stage} call cancelled")
+        if time.monotonic() >= end:
+            abandon()
+            if budget is not None and budget.expired():
+                raise BudgetExhausted(f"Time budget exhausted during {stage} call")
+            raise DeadlineExceeded(f"{stage} call exceeded its {timeout:g}s deadline")
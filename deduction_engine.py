@@ -1,25 +1,36 @@
-import google.generativeai as genai
-import os
 import json
 import re
 from datetime import datetime
-
-# Configure Gemini
-genai.configure(api_key=os.getenv("GOOGLE_API_KEY"))
-model = genai.GenerativeModel("models/gemini-1.5-flash-latest")
+from typing import Optional
+
+from gemini_client import cascade
+from deadlines import BudgetError
+from json_repair import parse_json
+from prompt_codec import clause_list, estimate_tokens, record_savings, squeeze, token_budget
+
+REQUIRED_KEYS = ("Clause", "confidence_score", "deduct", "reason")
+
+# Fallback when there is no time left for the model: first matching rule wins
+FALLBACK_RULES = [
+    (r"notice of readiness|\bNOR\b", True, "Notice of Readiness period does not count"),
+    (r"rain|weather|swell|wind|storm|fog", True, "Weather stoppage"),
+    (r"breakdown|stopp|suspend|interrupt|awaiting|waiting|shifting|strike", True, "Stoppage not attributable to the vessel's cargo work"),
+    (r"discharg|pumping|loading|cargo", False, "Cargo operations count as laytime"),
+]
+FALLBACK_CONFIDENCE = 0.5
+FALLBACK_CLAUSE = "Rule-based fallback (time budget exhausted)"
+ERROR_CLAUSE = "Error during processing"
+CLAUSES = "<<CONTRACT_CLAUSES>>"    # where the clause list goes once the rest of the prompt is sized
 
 def extract_json(text: str) -> dict:
     """
     Extracts and parses a JSON object from a string, which may contain other text.
+    Malformed JSON is repaired; an answer cut off before all the required keys
+    fails schema validation, so the cascade escalates it.
     """
     try:
-        # Use a regex to find the JSON block
-        match = re.search(r"\{[\s\S]*\}", text)
-        if not match:
-            raise ValueError("No JSON object found in the response text.")
-        json_str = match.group(0)
-        return json.loads(json_str)
-    except (json.JSONDecodeError, ValueError) as e:
+        return parse_json(text, "object", stage="deduction")[0]
+    except ValueError as e:
         print(f"❌ Error parsing JSON from response: {e}")
         print(f"📄 Full response text:\n{text}")
         return {
@@ -29,19 +40,34 @@ def extract_json(text: str) -> dict:
         }
 
 
+def decision_confidence(decision: dict) -> Optional[float]:
+    """Confidence of a decision, or None if it doesn't match the expected schema."""
+    if not isinstance(decision, dict) or "error" in decision:
+        return None
+    if any(k not in decision for k in REQUIRED_KEYS) or not isinstance(decision["deduct"], bool):
+        return None
+    try:
+        confidence = float(decision["confidence_score"])
+    except (TypeError, ValueError):
+        return None
+    return confidence if 0.0 <= confidence <= 1.0 else None
+
+
 def analyze_event_against_clauses(event: dict, clause_texts: list[str]) -> dict:
     """
     For a single event, this function asks the Gemini model to find the most relevant
     clause, score the match, and determine if laytime should be deducted.
 
     Args:
-        event (dict): An object with 'reason', 'start_time', and 'end_time'.
+        event (dict): An object with 'reason', 'start_time', and 'end_time' (and
+            'pumping_evidence' when the pumping log covers the event).
         clause_texts (list[str]): A list of all clauses from the contract.
 
     Returns:
         dict: A JSON object with the analysis result.
     """
-    clauses_formatted = "\n".join([f"- {c}" for c in clause_texts])
+    # Hard data from the pumping log for this period, when there is a log
+    evidence_line = f"\n        - **Pumping Log:** {event['pumping_evidence']}" if event.get("pumping_evidence") else ""
 
     prompt = f"""
         You are an expert laytime calculation agent.
@@ -78,24 +104,35 @@ def analyze_event_against_clauses(event: dict, clause_texts: list[str]) -> dict:
         - **Day:** {event.get('day')}
         - **Description:** {event.get('reason')}
         - **Start Time:** {event.get('start_time')}
-        - **End Time:** {event.get('end_time')}
+        - **End Time:** {event.get('end_time')}{evidence_line}
 
         ---
         **Contract Clauses (Find the best match from this list):**
-        {clauses_formatted}
+        {CLAUSES}
         ---
         """
+    verbose = prompt.replace(CLAUSES, "\n".join([f"- {c}" for c in clause_texts]))
+    # Unindented, clauses deduplicated and, if the contract is too long for the budget, the most relevant ones
+    prompt = squeeze(prompt)
+    room = token_budget("deduction") - estimate_tokens(prompt) if token_budget("deduction") else None
+    clauses_formatted, _ = clause_list(clause_texts, event.get("reason") or "", room)
+    prompt = prompt.replace(CLAUSES, clauses_formatted)
+    record_savings("deduction", verbose, prompt)
 
     try:
-        response = model.generate_content(prompt)
-        return extract_json(response.text)
+        # Cheap model first; escalate on low confidence or a malformed answer
+        decision, model_name = cascade("deduction", prompt, extract_json, decision_confidence)
+        decision["model"] = model_name
+        return decision
+    except BudgetError:
+        raise
     except Exception as e:
         print(f"❌ Gemini API call failed: {e}")
         return {
             "Date": event.get('date'),
             "Dau": event.get('day'),
             "Remark": event.get('reason'),
-            "Clause": "Error during processing",
+            "Clause": ERROR_CLAUSE,
             "confidence_score": 0.0,
             "deduct": False,
             "reason": f"Model failed to generate a response: {e}",
@@ -106,3 +143,36 @@ def analyze_event_against_clauses(event: dict, clause_texts: list[str]) -> dict:
 
 
 
+
+
+def rule_based_decision(event: dict, excepted: bool = False) -> dict:
+    """
+    Keyword-rule deduction decision in the same shape as the model's, used
+    when the run's time budget is exhausted. `excepted` marks a row that the
+    working calendar doesn't count at all (Sunday/holiday under SHEX terms).
+    """
+    remark = event.get("reason") or ""
+    if excepted:
+        deduct, why = True, "Excepted period under the working calendar"
+    else:
+        deduct, why = False, "No rule matched; counted as laytime"
+        for pattern, rule_deduct, rule_why in FALLBACK_RULES:
+            if re.search(pattern, remark, re.IGNORECASE):
+                deduct, why = rule_deduct, rule_why
+                break
+
+    start = datetime.strptime(event.get("start_time"), "%Y-%m-%d %H:%M")
+    end = datetime.strptime(event.get("end_time") or event.get("start_time"), "%Y-%m-%d %H:%M")
+    return {
+        "Date": event.get("date"),
+        "Day": event.get("day"),
+        "Remark": remark,
+        "Clause": FALLBACK_CLAUSE,
+        "confidence_score": FALLBACK_CONFIDENCE,
+        "deduct": deduct,
+        "reason": why,
+        "deducted_from": start.strftime("%H:%M"),
+        "deducted_to": end.strftime("%H:%M"),
+        "total_hours": round(max((end - start).total_seconds(), 0) / 3600.0, 4),
+        "fallback": True,
+    }
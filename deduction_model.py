@@ -0,0 +1,292 @@
+# deduction_model.py
+
+import os
+import re
+import sys
+import json
+import time
+import zlib
+import threading
+from typing import Optional
+
+import numpy as np
+
+from metrics import METRICS
+from event_model import format_minutes, parse_minutes
+from template_cache import normalize_text
+from deduction_engine import ERROR_CLAUSE, FALLBACK_CLAUSE
+
+# ---------- CONFIG ----------
+MODEL_PATH = os.getenv("LAYTIME_DEDUCTION_MODEL", "deduction_model.joblib")
+CONFIDENCE_THRESHOLD = float(os.getenv("LAYTIME_LEARNED_THRESHOLD", "0.95"))  # p(deduct) ≥ this or ≤ 1 - this
+MIN_TRAIN_ROWS = 200            # the model answers nothing until it has seen this many decisions
+MIN_HOLDOUT_ACCURACY = 0.9      # and only while its holdout accuracy at the threshold stays above this
+HOLDOUT_SHARE = 0.2             # of each batch of new decisions, kept out of training
+MAX_HOLDOUT = 5000              # rolling holdout buffer (half calibrates, half reports)
+MIN_SOURCE_CONFIDENCE = 0.6     # model decisions below this are too unsure to learn from
+# Decisions made fresh for a voyage. Copies (revision, template cache) and derived ones (pumping log,
+# learned, fallback) are stored again on every voyage and would be learned over and over.
+TRAINING_ORIGINS = ("model", "analyst")
+RETRAIN_MIN_NEW_ROWS = int(os.getenv("LAYTIME_RETRAIN_ROWS", "500"))   # service retrains after this many new decisions
+HASH_FEATURES = 2 ** 18
+LEARNED_CLAUSE_PREFIX = "Learned from past decisions"
+CATEGORY_PATTERNS = [
+    ("nor", r"notice of readiness|\bnor\b"),
+    ("weather", r"rain|weather|swell|wind|storm|fog"),
+    ("holiday", r"sunday|holiday|shex|shinc|excepted"),
+    ("shifting", r"shift"),
+    ("breakdown", r"breakdown|repair|failure|defect"),
+    ("strike", r"strike|labou?r"),
+    ("waiting", r"await|waiting|congestion|berth"),
+    ("cargo", r"discharg|pumping|loading|cargo|laytime"),
+]
+
+
+def clause_category(text: str) -> str:
+    """Coarse clause family from its wording; the same mapping at train and predict time."""
+    text = str(text or "")
+    return next((name for name, pattern in CATEGORY_PATTERNS if re.search(pattern, text, re.IGNORECASE)), "other")
+
+
+def best_clause(remark: str, clause_texts: list[str]) -> str:
+    """The contract clause sharing the most words with the remark ("" if none)."""
+    words = set(normalize_text(remark).split())
+    best, best_overlap = "", 0
+    for clause in clause_texts:
+        overlap = len(words & set(normalize_text(clause).split()))
+        if overlap > best_overlap:
+            best, best_overlap = clause, overlap
+    return best
+
+
+def _documents(remarks, categories, weekdays) -> list[str]:
+    """Remark words plus category and weekday as extra tokens, for one hashing pass."""
+    return [f"{normalize_text(r)} __cat_{c} __dow_{d}" for r, c, d in zip(remarks, categories, weekdays)]
+
+
+class DeductionClassifier:
+    """
+    Predicts `deduct` from remark text, clause category, weekday and duration.
+    A hashing vectorizer keeps features stateless, so an SGD logistic model
+    can be trained incrementally (partial_fit) on each new batch of stored
+    decisions; a Platt scaler fitted on a rolling holdout calibrates its
+    probabilities. Needs scikit-learn; without it load_classifier and
+    retrain return None and every row goes to the LLM as before.
+    """
+
+    def __init__(self):
+        from sklearn.feature_extraction.text import HashingVectorizer
+        from sklearn.linear_model import SGDClassifier
+
+        self.vectorizer = HashingVectorizer(
+            n_features=HASH_FEATURES, ngram_range=(1, 2), alternate_sign=False, norm="l2", token_pattern=r"[a-z_#]+",
+        )
+        self.model = SGDClassifier(loss="log_loss", alpha=1e-5, random_state=0)
+        self.calibration = (1.0, 0.0)        # Platt: p = sigmoid(a * margin + b)
+        self.trained_rows = 0
+        self.watermark = 0                   # last deductions rowid seen
+        self.holdout = []                    # [(remark, category, weekday, hours, label)]
+        self.report = {}
+
+    # ---------- Features ----------
+    def features(self, remarks, categories, weekdays, hours):
+        from scipy.sparse import csr_matrix, hstack
+
+        text = self.vectorizer.transform(_documents(remarks, categories, weekdays))
+        duration = csr_matrix(np.log1p(np.maximum(np.asarray(hours, dtype=float), 0.0))[:, None])
+        return hstack([text, duration], format="csr")
+
+    def _margin(self, X) -> np.ndarray:
+        return self.model.decision_function(X)
+
+    def probabilities(self, X) -> np.ndarray:
+        a, b = self.calibration
+        return 1.0 / (1.0 + np.exp(-(a * self._margin(X) + b)))
+
+    @property
+    def ready(self) -> bool:
+        return self.trained_rows >= MIN_TRAIN_ROWS and self.report.get("accuracy_confident", 0.0) >= MIN_HOLDOUT_ACCURACY
+
+    # ---------- Training ----------
+    def train(self, rows: list[dict]) -> dict:
+        """One incremental step on new stored decisions; returns the holdout report."""
+        usable = [r for r in rows if _learnable(r)]
+        if rows:
+            self.watermark = max(self.watermark, max(r["row_id"] for r in rows))
+        examples = [_example(r) for r in usable]
+        # Stable split: a row lands in the holdout by the hash of its content
+        held = [e for e in examples if zlib.crc32(repr(e).encode()) % 100 < HOLDOUT_SHARE * 100]
+        fit = [e for e in examples if zlib.crc32(repr(e).encode()) % 100 >= HOLDOUT_SHARE * 100]
+
+        if fit:
+            X = self.features(*zip(*[e[:4] for e in fit]))
+            y = np.array([e[4] for e in fit], dtype=int)
+            self.model.partial_fit(X, y, classes=np.array([0, 1]))
+            self.trained_rows += len(fit)
+        self.holdout = (self.holdout + held)[-MAX_HOLDOUT:]
+        if self.trained_rows:
+            self._calibrate()
+            self.report = self._evaluate(new_rows=len(usable))
+        return self.report
+
+    def _calibrate(self):
+        from sklearn.linear_model import LogisticRegression
+
+        cal = self.holdout[0::2]
+        labels = {e[4] for e in cal}
+        if len(cal) < 20 or len(labels) < 2:
+            return
+        margin = self._margin(self.features(*zip(*[e[:4] for e in cal])))
+        platt = LogisticRegression(C=1e4).fit(margin[:, None], [e[4] for e in cal])
+        self.calibration = (float(platt.coef_[0][0]), float(platt.intercept_[0]))
+
+    def _evaluate(self, new_rows: int) -> dict:
+        test = self.holdout[1::2]
+        report = {
+            "trained_rows": self.trained_rows, "new_rows": new_rows, "holdout_rows": len(test),
+            "threshold": CONFIDENCE_THRESHOLD, "watermark": self.watermark,
+        }
+        if not test:
+            return report
+        t0 = time.perf_counter()
+        X = self.features(*zip(*[e[:4] for e in test]))
+        p = self.probabilities(X)
+        per_row = (time.perf_counter() - t0) / len(test)
+        y = np.array([e[4] for e in test], dtype=int)
+        confident = (p >= CONFIDENCE_THRESHOLD) | (p <= 1 - CONFIDENCE_THRESHOLD)
+        report.update({
+            "accuracy": round(float(((p >= 0.5) == y).mean()), 4),
+            "brier": round(float(((p - y) ** 2).mean()), 4),
+            "coverage": round(float(confident.mean()), 4),
+            "accuracy_confident": round(float(((p[confident] >= 0.5) == y[confident]).mean()), 4) if confident.any() else 0.0,
+            "latency_us_per_row": round(per_row * 1e6, 2),
+        })
+        return report
+
+    # ---------- Prediction ----------
+    def predict_timeline(self, timeline, clause_texts: list[str]) -> tuple[np.ndarray, list[str]]:
+        """p(deduct) per timeline row in one batch, and the clause each row was matched to."""
+        remarks = [r or p for r, p in zip(timeline.reason, timeline.phase)]
+        clauses = [best_clause(r, clause_texts) for r in remarks]
+        weekdays = ((timeline.start // 1440 + 3) % 7).tolist()      # 1970-01-01 was a Thursday
+        hours = (timeline.effective_end() - timeline.start) / 60.0
+        t0 = time.perf_counter()
+        p = self.probabilities(self.features(remarks, [clause_category(c) for c in clauses], weekdays, hours))
+        if len(timeline):
+            METRICS.observe("learned.latency_us_per_row", (time.perf_counter() - t0) / len(timeline) * 1e6)
+        return p, clauses
+
+
+def _learnable(row: dict) -> bool:
+    """Fresh model/analyst decisions only: not copies, errors, keyword fallbacks or this model's own answers."""
+    # Rows stored before origins were recorded have none
+    if row.get("origin") is not None and row["origin"] not in TRAINING_ORIGINS:
+        return False
+    clause = row.get("clause") or ""
+    if clause in (ERROR_CLAUSE, FALLBACK_CLAUSE) or clause.startswith(LEARNED_CLAUSE_PREFIX):
+        return False
+    if row.get("deduct") is None or not row.get("remark"):
+        return False
+    return row.get("confidence") is None or row["confidence"] >= MIN_SOURCE_CONFIDENCE
+
+
+def _example(row: dict) -> tuple:
+    start, end = row.get("start_min"), row.get("end_min")
+    weekday = (start // 1440 + 3) % 7 if start is not None else -1
+    hours = (end - start) / 60.0 if start is not None and end is not None else 0.0
+    return (row["remark"], clause_category(row.get("clause")), weekday, hours, int(bool(row["deduct"])))
+
+
+def learned_decision(event: dict, probability: float, clause: str) -> Optional[dict]:
+    """A decision in the model's shape when the classifier is confident, else None."""
+    if CONFIDENCE_THRESHOLD > probability > 1 - CONFIDENCE_THRESHOLD:
+        return None
+    deduct = probability >= 0.5
+    start = parse_minutes(event.get("start_time"))
+    end = parse_minutes(event.get("end_time")) or start
+    return {
+        "Date": event.get("date"),
+        "Day": event.get("day"),
+        "Remark": event.get("reason"),
+        "Clause": f"{LEARNED_CLAUSE_PREFIX}: {clause}" if clause else LEARNED_CLAUSE_PREFIX,
+        "confidence_score": round(float(probability if deduct else 1 - probability), 4),
+        "deduct": bool(deduct),
+        "reason": f"Similar remarks were {'deducted' if deduct else 'counted'} in past voyages (p(deduct) = {probability:.3f})",
+        "deducted_from": format_minutes(start, "%H:%M"),
+        "deducted_to": format_minutes(end, "%H:%M"),
+        "total_hours": round(max(end - start, 0) / 60.0, 4),
+        "model": "learned",
+    }
+
+
+# ---------- Persistence ----------
+_lock = threading.Lock()
+_loaded = {}
+
+
+def load_classifier(path: str = MODEL_PATH) -> Optional[DeductionClassifier]:
+    """The saved classifier if there is one and it is ready to answer (cached per path and mtime)."""
+    try:
+        import joblib
+        mtime = os.path.getmtime(path)
+    except (ImportError, OSError):
+        return None
+    with _lock:
+        cached = _loaded.get(path)
+        if cached is None or cached[0] != mtime:
+            try:
+                cached = (mtime, joblib.load(path))
+            except Exception as e:
+                print(f"⚠️ Could not load deduction classifier {path}: {e}")
+                cached = (mtime, None)
+            _loaded[path] = cached
+    clf = cached[1]
+    return clf if clf is not None and clf.ready else None
+
+
+def retrain(store, path: str = MODEL_PATH) -> Optional[dict]:
+    """
+    Incremental retrain from decisions stored since the last run; the model
+    and its report (path + ".report.json") are replaced atomically. Returns
+    the report, or None when scikit-learn is not installed.
+    """
+    try:
+        import joblib
+        clf = joblib.load(path) if os.path.exists(path) else DeductionClassifier()
+    except ImportError:
+        print("⚠️ scikit-learn/joblib not installed; the learned deduction classifier is disabled.")
+        return None
+    rows = store.training_deductions(after_rowid=clf.watermark)
+    report = clf.train(rows)
+    tmp = f"{path}.tmp"
+    joblib.dump(clf, tmp)
+    os.replace(tmp, path)
+    with open(f"{path}.report.json", "w") as f:
+        json.dump(report, f, indent=2)
+    for key in ("accuracy", "coverage", "accuracy_confident", "latency_us_per_row"):
+        if key in report:
+            METRICS.observe(f"learned.retrain.{key}", report[key])
+    return report
+
+
+def maybe_retrain(store, path: str = MODEL_PATH, min_new: int = RETRAIN_MIN_NEW_ROWS) -> Optional[dict]:
+    """retrain() once `min_new` decisions have been stored since the last one (the service calls this periodically)."""
+    try:
+        with open(f"{path}.report.json") as f:
+            watermark = json.load(f).get("watermark", 0)
+    except (OSError, ValueError):
+        watermark = 0
+    if store.deductions_since(watermark) < min_new:
+        return None
+    return retrain(store, path)
+
+
+if __name__ == "__main__":
+    from store import VoyageStore
+    # Through the module, so the pickled class is deduction_model.DeductionClassifier, not __main__'s
+    from deduction_model import retrain as retrain_model
+
+    with (VoyageStore(sys.argv[1]) if len(sys.argv) > 1 else VoyageStore()) as store:
+        report = retrain_model(store)
+    if report is not None:
+        print(f"🧠 Deduction classifier: {json.dumps(report, indent=2)}")
@@ -0,0 +1,82 @@
+# doc_classifier.py
+
+import re
+
+from metrics import METRICS
+
+# ---------- CONFIG ----------
+DOC_TYPES = ["Contract", "SoF", "LoP", "NOR", "PumpingLog"]
+FIRST_PAGE_CHARS = 4000      # only the head of the first page is scored
+FILENAME_WEIGHT = 4.0        # a telling filename is worth about two strong phrases
+MIN_SCORE = 3.0              # below this the evidence is too thin to pick a type
+MIN_MARGIN = 0.4             # winner must beat the runner-up by this share of its score
+
+FILENAME_PATTERNS = {
+    "Contract":   r"\bcontract\b|\bcp\b|charter\s*party|\bcharter\b|\bfixture\b",
+    "SoF":        r"\bsof\b|statement\s*of\s*facts?",
+    "LoP":        r"\blop\b|\bprotest\b",
+    "NOR":        r"\bnor\b|notice\s*of\s*readiness",
+    "PumpingLog": r"\bpump(ing)?\b|pump\s*log|\bpumplog\b",
+}
+
+# (pattern, weight): distinctive phrases weigh more than words other types share
+KEYWORDS = {
+    "Contract": [
+        (r"charter\s*party|charterparty", 3.0), (r"\bclause\b", 1.0), (r"\bwhereas\b", 1.5),
+        (r"\barbitration\b", 1.5), (r"\bdemurrage\b", 0.5), (r"\bdespatch\b", 0.5),
+        (r"\bshinc\b|\bshex\b", 1.0), (r"\blaytime\b", 0.5), (r"\bowners\b.*\bcharterers\b", 1.5),
+    ],
+    "SoF": [
+        (r"statement\s+of\s+facts?", 4.0), (r"all\s+fast", 1.5), (r"commenced\s+discharg", 1.5),
+        (r"completed\s+discharg", 1.5), (r"pilot\s+on\s+board", 1.0), (r"hoses?\s+(dis)?connected", 1.0),
+        (r"nor\s+tendered", 1.0), (r"anchored|dropped\s+anchor", 1.0),
+    ],
+    "LoP": [
+        (r"letter\s+of\s+protest", 4.0), (r"\bprotest\b", 1.5), (r"hold\s+you\s+(fully\s+)?responsible", 2.0),
+        (r"reserve\s+(the|our)\s+right", 1.5), (r"without\s+prejudice", 1.0),
+    ],
+    "NOR": [
+        (r"notice\s+of\s+readiness", 3.0), (r"ready\s+in\s+all\s+respects", 2.0),
+        (r"hereby\s+(give|tender)", 2.0), (r"\baccepted\b", 0.5), (r"free\s+pratique", 1.0),
+    ],
+    "PumpingLog": [
+        (r"pumping\s+(log|record)", 4.0), (r"m3\s*/\s*h|mt\s*/\s*h|t/h", 1.5), (r"\bpressure\b", 1.0),
+        (r"kg\s*/\s*cm|\bbar\b|\bpsi\b", 1.0), (r"\bmanifold\b", 1.0), (r"\brate\b", 0.5),
+    ],
+}
+
+_FILENAME_RE = {t: re.compile(p, re.IGNORECASE) for t, p in FILENAME_PATTERNS.items()}
+_KEYWORD_RE = {t: [(re.compile(p, re.IGNORECASE), w) for p, w in kws] for t, kws in KEYWORDS.items()}
+
+
+def filename_tokens(file_name: str) -> str:
+    """ "Voyage_12-SoF.final.pdf" -> "voyage 12 sof final" so \\b works around separators."""
+    stem = re.sub(r"\.[A-Za-z0-9]{1,5}$", "", file_name or "")
+    return re.sub(r"[^a-z0-9]+", " ", stem.lower()).strip()
+
+
+def score_document(file_name: str, first_page_text: str) -> dict:
+    """Keyword score per document type from the filename and the first page."""
+    name = filename_tokens(file_name)
+    text = (first_page_text or "")[:FIRST_PAGE_CHARS]
+    scores = {}
+    for doc_type in DOC_TYPES:
+        score = FILENAME_WEIGHT if _FILENAME_RE[doc_type].search(name) else 0.0
+        score += sum(w for pattern, w in _KEYWORD_RE[doc_type] if pattern.search(text))
+        scores[doc_type] = score
+    return scores
+
+
+def classify_document(file_name: str, first_page_text: str = "") -> dict:
+    """
+    Guess the document type before any model call. Returns {"doc_type",
+    "score", "margin", "scores"}; doc_type is None when the evidence is thin
+    or two types are close, and the caller should use the generic prompt.
+    """
+    scores = score_document(file_name, first_page_text)
+    ranked = sorted(scores.items(), key=lambda kv: kv[1], reverse=True)
+    (best, top), (_, second) = ranked[0], ranked[1]
+    margin = (top - second) / top if top else 0.0
+    doc_type = best if top >= MIN_SCORE and margin >= MIN_MARGIN else None
+    METRICS.incr(f"classifier.{doc_type or 'unsure'}")
+    return {"doc_type": doc_type, "score": top, "margin": round(margin, 3), "scores": scores}
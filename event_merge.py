@@ -0,0 +1,110 @@
+# event_merge.py
+
+import heapq
+from collections import defaultdict
+
+from event_model import MISSING, Timeline
+from template_cache import normalize_text
+
+# ---------- CONFIG ----------
+TOLERANCE_MINUTES = 15          # same event if starts (and ends) are this close
+MIN_SIMILARITY = 0.5            # token Jaccard of the normalized remarks
+SOURCE_PRIORITY = ["SoF", "NOR", "LoP", "PumpingLog"]   # whose wording/times win a duplicate
+
+
+def priority(source: str) -> int:
+    return SOURCE_PRIORITY.index(source) if source in SOURCE_PRIORITY else len(SOURCE_PRIORITY)
+
+
+def similarity(a: set, b: set) -> float:
+    if not a or not b:
+        return 0.0
+    return len(a & b) / len(a | b)
+
+
+def _is_point(start: int, end: int) -> bool:
+    # No end, or ends where it starts (a timestamp row paired with a repeat of itself)
+    return end == MISSING or int(end) == int(start)
+
+
+def _ends_close(s1: int, e1: int, s2: int, e2: int, tolerance: int) -> bool:
+    # A point event only has its start to compare
+    return _is_point(s1, e1) or _is_point(s2, e2) or abs(int(e1) - int(e2)) <= tolerance
+
+
+def merge_streams(streams: list[Timeline], tolerance: int = TOLERANCE_MINUTES,
+                  min_similarity: float = MIN_SIMILARITY) -> tuple[Timeline, dict]:
+    """
+    Combine per-document event timelines (each row's `source` names its
+    document) into one. Streams are merged with a heap in O(n log k); an event
+    that was already reported within `tolerance` minutes with a similar
+    remark, by another document or twice by the same one, is folded into it.
+    Kept events are indexed by start // tolerance, so a lookup only checks
+    the neighbouring buckets.
+    The surviving row takes the higher-priority document's times and wording,
+    and its `source` lists every document that reported it ("SoF+PumpingLog").
+    Returns (timeline, stats).
+    """
+    tolerance = max(int(tolerance), 1)
+    streams = sorted((s.sorted() for s in streams if len(s)), key=lambda s: priority(s.source[0]))
+    tokens = [[set(normalize_text(r or p).split()) for r, p in zip(s.reason, s.phase)] for s in streams]
+
+    def rows(k):
+        s = streams[k]
+        return ((int(s.start[i]), k, i) for i in range(len(s)))
+
+    kept = []                        # [stream, row, {streams that reported it}]
+    buckets = defaultdict(list)      # start // tolerance -> indexes into kept
+    duplicates = 0
+    within_stream = 0
+    current = None
+    for start, k, i in heapq.merge(*(rows(k) for k in range(len(streams)))):
+        bucket = start // tolerance
+        if bucket != current:
+            # Merge order is by start, so buckets two behind can never match again
+            for old in [b for b in buckets if b < bucket - 1]:
+                del buckets[old]
+            current = bucket
+
+        match = None
+        for b in (bucket - 1, bucket, bucket + 1):
+            for j in buckets.get(b, ()):
+                kk, ii, _ = kept[j]
+                if abs(int(streams[kk].start[ii]) - start) > tolerance:
+                    continue
+                if not _ends_close(streams[kk].start[ii], streams[kk].end[ii], start, streams[k].end[i], tolerance):
+                    continue
+                if similarity(tokens[kk][ii], tokens[k][i]) >= min_similarity:
+                    match = j
+                    break
+            if match is not None:
+                break
+
+        if match is None:
+            buckets[bucket].append(len(kept))
+            kept.append([k, i, {k}])
+            continue
+        duplicates += 1
+        entry = kept[match]
+        within_stream += k in entry[2]
+        entry[2].add(k)
+        kk, ii = entry[0], entry[1]
+        ours, theirs = priority(streams[k].source[i]), priority(streams[kk].source[ii])
+        # At the same priority, a row with a span beats a point repeat of it
+        spans = _is_point(streams[kk].start[ii], streams[kk].end[ii]) and not _is_point(start, streams[k].end[i])
+        if ours < theirs or (ours == theirs and spans):
+            entry[0], entry[1] = k, i
+
+    merged = Timeline(
+        [streams[k].start[i] for k, i, _ in kept],
+        [streams[k].end[i] for k, i, _ in kept],
+        [streams[k].reason[i] for k, i, _ in kept],
+        [streams[k].phase[i] for k, i, _ in kept],
+        ["+".join(sorted({streams[s].source[0] for s in seen}, key=priority)) for _, _, seen in kept],
+    )
+    stats = {
+        "streams": len(streams), "rows_in": sum(len(s) for s in streams), "rows_out": len(kept),
+        "duplicates": duplicates, "within_stream": within_stream,
+    }
+    # A duplicate can take a later-starting row's times, so re-sort once
+    return merged.sorted(), stats
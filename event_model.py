@@ -0,0 +1,205 @@
+# event_model.py
+
+import re
+import numbers
+import calendar
+from datetime import datetime, timedelta
+from typing import Iterable, Iterator, Optional
+
+import numpy as np
+from dateutil import parser
+
+# ---------- CONFIG ----------
+EPOCH = datetime(1970, 1, 1)
+MISSING = np.iinfo(np.int64).min      # sentinel for an absent end time
+TIME_FORMAT = "%Y-%m-%d %H:%M"
+_TIME_ONLY = re.compile(r"^\d{1,2}:\d{2}(:\d{2})?$")
+
+
+# ---------- Minute conversions ----------
+def to_minutes(dt: datetime) -> int:
+    """Datetime -> integer minutes since 1970-01-01, taking its wall-clock time as UTC."""
+    return calendar.timegm(dt.timetuple()) // 60
+
+
+def from_minutes(m) -> datetime:
+    return EPOCH + timedelta(minutes=int(m))
+
+
+def format_minutes(m, fmt: str = TIME_FORMAT) -> Optional[str]:
+    if m is None or m == MISSING:
+        return None
+    return from_minutes(m).strftime(fmt)
+
+
+def parse_minutes(value, date=None) -> Optional[int]:
+    """
+    Parse whatever the model or the SoF gave us into epoch minutes.
+    Accepts datetimes, UNIX timestamps, "YYYY-MM-DD HH:MM", day-first dates
+    and bare "HH:MM" (combined with `date`). Empty, "nan" and "None" give None.
+    """
+    if value is None:
+        return None
+    if isinstance(value, datetime):
+        return to_minutes(value)
+    if isinstance(value, numbers.Number):
+        if value != value:  # NaN
+            return None
+        # UNIX seconds are UTC; going through local time would shift by the host's offset and DST
+        return int(value // 60)
+
+    s = str(value).strip()
+    if not s or s.lower() in ("nan", "nat", "none", "null"):
+        return None
+    try:
+        return to_minutes(datetime.strptime(s, TIME_FORMAT))
+    except ValueError:
+        pass
+    if date and _TIME_ONLY.match(s):
+        s = f"{date} {s}"
+    return to_minutes(parser.parse(s, dayfirst=True))
+
+
+# ---------- Event record ----------
+class Event:
+    """A single time block. `start`/`end` are epoch minutes; `end` may be None."""
+
+    __slots__ = ("start", "end", "reason", "phase", "source")
+
+    def __init__(self, start: int, end: Optional[int] = None, reason: str = "", phase: str = "", source: str = ""):
+        self.start = int(start)
+        self.end = None if end is None or end == MISSING else int(end)
+        self.reason = reason or ""
+        self.phase = phase or ""
+        self.source = source or ""
+
+    @property
+    def duration(self) -> int:
+        return max(0, self.end - self.start) if self.end is not None else 0
+
+    def to_record(self) -> dict:
+        """Dict form used at the model boundary (prompts, st.dataframe)."""
+        rec = {
+            "date":       format_minutes(self.start, "%d/%m/%Y"),
+            "day":        format_minutes(self.start, "%A"),
+            "start_time": format_minutes(self.start),
+            "end_time":   format_minutes(self.end),
+            "reason":     self.reason,
+        }
+        if self.phase:
+            rec["event_phase"] = self.phase
+        return rec
+
+    def __repr__(self):
+        return f"Event({format_minutes(self.start)!r}, {format_minutes(self.end)!r}, {self.reason!r})"
+
+
+# ---------- Timeline ----------
+class Timeline:
+    """
+    Column-oriented list of events. Times live in int64 epoch-minute arrays,
+    so sorting, masking and duration sums never touch strings.
+    """
+
+    __slots__ = ("start", "end", "reason", "phase", "source")
+
+    def __init__(self, start=None, end=None, reason=None, phase=None, source=None):
+        self.start = np.asarray(start if start is not None else [], dtype=np.int64)
+        self.end = np.asarray(end if end is not None else [], dtype=np.int64)
+        n = len(self.start)
+        self.reason = list(reason) if reason is not None else [""] * n
+        self.phase = list(phase) if phase is not None else [""] * n
+        self.source = list(source) if source is not None else [""] * n
+
+    @classmethod
+    def from_events(cls, events: Iterable[Event]) -> "Timeline":
+        events = list(events)
+        return cls(
+            [e.start for e in events],
+            [MISSING if e.end is None else e.end for e in events],
+            [e.reason for e in events],
+            [e.phase for e in events],
+            [e.source for e in events],
+        )
+
+    @classmethod
+    def from_records(cls, records: list[dict], source: str = "") -> "Timeline":
+        """
+        Build a timeline from model/SoF dicts, whatever their key spelling.
+        Rows whose start cannot be parsed are dropped.
+        """
+        events = []
+        for r in records or []:
+            date = r.get("date") or r.get("Date")
+            start_raw = r.get("start_time") or r.get("Start_Time") or r.get("time") or r.get("timestamp") or r.get("Date & Time")
+            end_raw = r.get("end_time") or r.get("End_Time")
+            try:
+                start = parse_minutes(start_raw, date)
+                end = parse_minutes(end_raw, date)
+            except (ValueError, OverflowError) as e:
+                print(f"⚠️ Skipping event with unparseable time {start_raw!r}/{end_raw!r}: {e}")
+                continue
+            if start is None:
+                continue
+            events.append(Event(
+                start,
+                end,
+                r.get("reason") or r.get("remarks") or r.get("Remarks") or "",
+                r.get("event_phase") or r.get("event") or r.get("Event") or "",
+                r.get("source") or source,
+            ))
+        return cls.from_events(events)
+
+    @classmethod
+    def concat(cls, timelines: Iterable["Timeline"]) -> "Timeline":
+        timelines = list(timelines)
+        if not timelines:
+            return cls()
+        return cls(
+            np.concatenate([t.start for t in timelines]),
+            np.concatenate([t.end for t in timelines]),
+            [x for t in timelines for x in t.reason],
+            [x for t in timelines for x in t.phase],
+            [x for t in timelines for x in t.source],
+        )
+
+    def __len__(self) -> int:
+        return len(self.start)
+
+    def __iter__(self) -> Iterator[Event]:
+        for i in range(len(self)):
+            yield self[i]
+
+    def __getitem__(self, key):
+        if isinstance(key, (int, np.integer)):
+            return Event(self.start[key], self.end[key], self.reason[key], self.phase[key], self.source[key])
+        idx = np.arange(len(self))[key]
+        return Timeline(
+            self.start[idx],
+            self.end[idx],
+            [self.reason[i] for i in idx],
+            [self.phase[i] for i in idx],
+            [self.source[i] for i in idx],
+        )
+
+    def sorted(self) -> "Timeline":
+        return self[np.argsort(self.start, kind="stable")]
+
+    @property
+    def has_phase(self) -> bool:
+        return any(self.phase)
+
+    def effective_end(self) -> np.ndarray:
+        """End times with missing ends collapsed onto the start."""
+        return np.where(self.end == MISSING, self.start, self.end)
+
+    def durations(self) -> np.ndarray:
+        """Per-row duration in minutes."""
+        return np.maximum(self.effective_end() - self.start, 0)
+
+    def matches(self, pattern: str, field: str = "reason") -> np.ndarray:
+        rx = re.compile(pattern, re.IGNORECASE)
+        return np.fromiter((bool(rx.search(s or "")) for s in getattr(self, field)), dtype=bool, count=len(self))
+
+    def to_records(self) -> list[dict]:
+        return [e.to_record() for e in self]
@@ -2,6 +2,7 @@ import pandas as pd
 from openpyxl import Workbook
 from openpyxl.styles import Alignment, Font, PatternFill
 import re
+from event_model import Timeline, format_minutes
 
 def float_to_hhmm(hrs_float: float) -> str:
     # extract whole hours
@@ -14,7 +15,32 @@ def float_to_hhmm(hrs_float: float) -> str:
         minutes = 0
     return f"{hours:02d}:{minutes:02d}"
 
-def generate_excel_from_extracted_data(metadata: dict, deductions: list[dict], net_laytime_used_hours: float):
+def parse_number(raw) -> float:
+    """First number in a value like "30,000 MT" or "USD 12000/day"; 0.0 if none."""
+    # Use regex to find numbers (integers or floats)
+    match = re.search(r'(\d+\.?\d*)', str(raw).replace(",", ""))
+    return float(match.group(1)) if match else 0.0
+
+def laytime_allowed_days(metadata: dict):
+    """Allowed laytime in days (Quantity / DISRATE), or None when the discharge rate is zero."""
+    # Robustly extract numerical part from Quantity and Discharge Rate
+    quantity = parse_number(metadata.get("Quantity", ""))
+    # Changed key from DISRATE to Discharge Rate
+    disrate = parse_number(metadata.get("DISRATE", ""))
+
+    if disrate == 0:
+        return None
+    return quantity / disrate
+
+def generate_excel_from_extracted_data(metadata: dict, deductions: list[dict], net_laytime_used_hours: float,
+                                       timeline: Timeline = None, calendar=None, laytime_index=None):
+    """
+    When `timeline` is given (one row per deduction), dates, From/To and hours
+    come from its epoch-minute columns instead of the model's strings. With a
+    `calendar`, row hours are counted working time. With a `laytime_index`,
+    the header shows when laytime expires and the time on demurrage.
+    """
+    aligned = timeline is not None and len(timeline) == len(deductions)
     wb = Workbook()
     ws = wb.active
     ws.title = "LAY TIME CALCULATIONS"
@@ -27,28 +53,24 @@ def generate_excel_from_extracted_data(metadata: dict, deductions: list[dict], n
     LIGHT_GREY = PatternFill(start_color="D9D9D9", end_color="D9D9D9", fill_type="solid")
 
     # --- Calculate Laytime Allowed ---
-    time_allowed = ""
     try:
-        # Robustly extract numerical part from Quantity and Discharge Rate
-        quantity_raw = metadata.get("Quantity", "")
-        # Changed key from DISRATE to Discharge Rate
-        disrate_raw = metadata.get("DISRATE", "") 
-
-        # Use regex to find numbers (integers or floats)
-        quantity_match = re.search(r'(\d+\.?\d*)', str(quantity_raw))
-        disrate_match = re.search(r'(\d+\.?\d*)', str(disrate_raw))
-
-        quantity = float(quantity_match.group(1)) if quantity_match else 0.0
-        disrate = float(disrate_match.group(1)) if disrate_match else 0.0
-
-        if disrate != 0:
-            time_allowed = f"{quantity / disrate:.4f}"
+        allowed_days = laytime_allowed_days(metadata)
+        if allowed_days is not None:
+            time_allowed = f"{allowed_days:.4f}"
         else:
             time_allowed = "N/A (Discharge Rate is zero)"
     except Exception as e:
         time_allowed = f"Error calculating Laytime Allowed: {e}"
+        allowed_days = None
 
-    laytime_allowed_value = deductions[0].get('deducted_to', 'N/A Discharge rate is 0')
+    if aligned:
+        # Laytime starts counting where the NOR period row ends
+        laytime_start = timeline.end[0]
+        laytime_start_row = [format_minutes(laytime_start, "%d/%m/%Y"), format_minutes(laytime_start, "%H:%M"),
+                             format_minutes(laytime_start, "%A")]
+    else:
+        laytime_allowed_value = deductions[0].get('deducted_to', 'N/A Discharge rate is 0')
+        laytime_start_row = [deductions[1].get('Date'), laytime_allowed_value, deductions[1].get('Day')]
 
     a_c = ""
     if metadata.get("A/C", ""):
@@ -65,10 +87,22 @@ def generate_excel_from_extracted_data(metadata: dict, deductions: list[dict], n
         ["LTC  AT :", metadata.get("LTC AT", ""), "", "", "VESSEL BERTHED :", metadata.get("Vessel Berthed", "")],
         ["DEMMURAGE :", metadata.get("DEMMURAGE", ""), "", "", "COMMENCED CARGO :", metadata.get("Commenced Cargo", "")],
         ["DESPATCH :", metadata.get("DESPATCH", ""), "", "", "COMPLETED CARGO :", metadata.get("Completed Cargo", "")],
-        ["LAYTIME TO START COUNTING :",deductions[1].get('Date'), laytime_allowed_value,deductions[1].get('Day')],
+        ["LAYTIME TO START COUNTING :", *laytime_start_row],
         ["TIME ALLOWED :", time_allowed]
     ]
 
+    if laytime_index is not None and allowed_days is not None:
+        expires_at = laytime_index.expiry(allowed_days * 24 * 60)
+        on_demurrage = laytime_index.time_on_demurrage(allowed_days * 24 * 60)
+        header_rows.append([
+            "LAYTIME EXPIRES :",
+            format_minutes(expires_at, "%d/%m/%Y") or "Not expired",
+            format_minutes(expires_at, "%H:%M") or "",
+            format_minutes(expires_at, "%A") or "",
+            "TIME ON DEMURRAGE :",
+            float_to_hhmm(on_demurrage / 60.0),
+        ])
+
     for row in header_rows:
         ws.append(row)
 
@@ -100,18 +134,31 @@ def generate_excel_from_extracted_data(metadata: dict, deductions: list[dict], n
     to_count_sum = 0
     prev_date = None
     prev_day = None
-    for d in deductions:
-        date = str(d.get("Date", "")).strip()
-        day = str(d.get("Day", "")).strip()
+    durations = None
+    if aligned:
+        if calendar is not None:
+            durations = calendar.counted_minutes(timeline.start, timeline.effective_end())
+        else:
+            durations = timeline.durations()
+    for i, d in enumerate(deductions):
+        if aligned:
+            start, end = timeline.start[i], timeline.end[i]
+            date = format_minutes(start, "%d/%m/%Y")
+            day = format_minutes(start, "%A")
+            d = {**d, "deducted_from": format_minutes(start, "%H:%M"), "deducted_to": format_minutes(end, "%H:%M") or ""}
+            hrs_float = float(durations[i]) / 60.0
+        else:
+            date = str(d.get("Date", "")).strip()
+            day = str(d.get("Day", "")).strip()
+            raw_hours = d.get('total_hours')
+            try:
+                hrs_float = float(raw_hours)
+            except (TypeError, ValueError):
+                hrs_float = 0.0
 
         # Show date/day only if different from previous row
         date_to_write = date if date != prev_date else ""
         day_to_write = day if day != prev_day else ""
-        raw_hours = d.get('total_hours')
-        try:
-            hrs_float = float(raw_hours)
-        except (TypeError, ValueError):
-            hrs_float = 0.0
 
         if d.get("deduct"):
             deduction_sum += hrs_float
@@ -153,16 +200,19 @@ def generate_excel_from_extracted_data(metadata: dict, deductions: list[dict], n
         cell.font = Font(bold=True)
         cell.fill = LIGHT_GREEN
 
-    difference = round(float(time_used) - float(time_allowed), 4)
-    if difference > 0:
-        rate = float(metadata.get("DEMMURAGE", 0))
+    # Without an allowed time (DISRATE 0 or unreadable) there is nothing to compare against
+    difference = round(float(time_used) - allowed_days, 4) if allowed_days is not None else None
+    if difference is None:
+        ws.append(["DEMMURAGE / DESPATCH", time_allowed])
+    elif difference > 0:
+        rate = parse_number(metadata.get("DEMMURAGE", 0))
         cost = difference * rate
         ws.append(["DEMMURAGE", f"{difference:.4f}"])
         ws.append(["Rate US$", rate, f"{cost:.2f}"])
         ws['B6'].fill = LIGHT_GREY
     elif difference < 0:
         des_pull = abs(difference)
-        rate = float(metadata.get("DESPATCH", 0))
+        rate = parse_number(metadata.get("DESPATCH", 0))
         credit = des_pull * rate
         ws.append(["DESPATCH", f"{des_pull:.4f}"])
         ws.append(["Rate US$", rate, f"{credit:.2f}"])
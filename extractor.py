@@ -1,10 +1,12 @@
 # extractor.py
 
-import os, json
-import time
+import os
 from google.cloud import aiplatform
 import google.generativeai as genai
 
+from gemini_client import generate_json
+from deadlines import BudgetError
+
 # ---------- CONFIG ----------
 PROJECT_ID = "laytimecalculation"
 LOCATION = "global"
@@ -14,11 +16,26 @@ MODEL = "models/gemini-1.5-flash-latest"
 aiplatform.init(project=PROJECT_ID, location=LOCATION)
 genai.configure(api_key=os.getenv("GOOGLE_API_KEY"))
 
-# ---------- Extractor ----------
-def extract_with_gemini(pdf_path):
-    model = genai.GenerativeModel(MODEL)
+# ---------- Local text ----------
+def read_pdf_text(pdf_path, max_pages=None) -> str:
+    """
+    Text layer of a PDF without calling the model. Returns "" for scanned
+    documents, non-PDFs, or when pypdf is not installed.
+    """
+    try:
+        from pypdf import PdfReader
+    except ImportError:
+        return ""
+    try:
+        reader = PdfReader(pdf_path)
+        pages = reader.pages if max_pages is None else reader.pages[:max_pages]
+        return "\n".join((p.extract_text() or "") for p in pages).strip()
+    except Exception as e:
+        print(f"⚠️ Could not read text from {pdf_path}: {e}")
+        return ""
 
-    prompt = """
+# ---------- Extractor ----------
+GENERIC_PROMPT = """
     You are an intelligent document understanding agent. You will receive a raw PDF document. It may be any of the following:
 
     - Contract
@@ -91,16 +108,114 @@ def extract_with_gemini(pdf_path):
     - Do not include any commentary or explanation.
     """
 
+# ---------- Type-specific prompts ----------
+# Used when doc_classifier is confident about the type: the model only reads
+# the instructions and output shape for that one document type.
+TYPED_PROMPT = """
+    You will receive a raw PDF document: a {label}.
+    Return a **single, clean JSON object** with "document_type": "{doc_type}" and this shape:
+    {schema}
+
+    {instructions}
+
+    ## Rules
+    - Do not omit any events, clauses, table rows or key sections.
+    - Do not summarize. Do not infer. Output must be valid JSON only, without commentary.
+    """
+
+TYPE_PROMPTS = {
+    "Contract": {
+        "label": "charter party contract",
+        "schema": """{"document_type": "Contract", "working_hours": {"Monday to Friday": "HH:MM to HH:MM", "Saturday": "HH:MM to HH:MM"},
+     "laytime_commencement": "", "demurrage": "", "despatch": "", "disrate": "", "terms": "",
+     "Vessel Name": "", "Charterer": "", "Quantity": "", "Product": "", "Port": "",
+     "sections": [{"heading": "", "body": {"<subclause>": "<text>"}}]}""",
+        "instructions": """- Keep clause numbers like 4.1 in headings; parse headings from layout or all-caps text.
+    - One entry per clause and subclause, with the paragraph or bullet structure preserved inside each.
+    - Include terms, risks, prices, parties, dates, weather & holiday exemptions and procedures.
+    - "laytime_commencement" is the time unit after which laytime starts (e.g. "6 hours after NOR").
+    - "demurrage", "despatch", "disrate" and "terms" hold values only, without units.""",
+    },
+    "SoF": {
+        "label": "Statement of Facts",
+        "schema": """{"document_type": "SoF", "Vessel Name": "", "Port": "", "Quantity": "",
+     "Chronological Events": [{"date": "DD/MM/YYYY", "day": "", "start_time": "HH:MM", "end_time": "HH:MM or null", "Event": "", "Remarks": ""}]}""",
+        "instructions": """- Include every event of the chronological log, whatever the table is called in the document.
+    - Split "HH:MM/HH:MM" ranges into "start_time" and "end_time"; single times get "end_time": null.
+    - If the log uses one combined "Date & Time" column, keep that key ("YYYY-MM-DD HH:MM") instead of splitting it.""",
+    },
+    "LoP": {
+        "label": "Letter of Protest",
+        "schema": """{"document_type": "LoP", "Vessel Name": "", "Port": "", "date": "", "submitted_by": "", "submitted_to": "",
+     "protest_reason": "", "events": [{"Date & Time": "YYYY-MM-DD HH:MM", "Event": "", "Remarks": ""}], "signatures": []}""",
+        "instructions": "- Extract the protest reason, who submitted it to whom, every timestamp mentioned and the signatories.",
+    },
+    "NOR": {
+        "label": "Notice of Readiness",
+        "schema": """{"document_type": "NOR", "Vessel Name": "", "Port": "", "Berth": "", "tendered": "YYYY-MM-DD HH:MM",
+     "accepted": "YYYY-MM-DD HH:MM", "free_pratique": "", "customs": "", "remarks": ""}""",
+        "instructions": "- Give all the details related to berth, port, pratique and customs, with tender and acceptance times.",
+    },
+    "PumpingLog": {
+        "label": "pumping log",
+        "schema": """{"document_type": "PumpingLog", "Vessel Name": "", "Port": "",
+     "pumping_records": [{"Date & Time": "YYYY-MM-DD HH:MM", "rate": "", "volume": "", "pressure": "", "remarks": ""}]}""",
+        "instructions": "- One record per row of the log, keeping time entries, flow rates, volumes, pressures and comments.",
+    },
+}
+
+
+def extraction_prompt(doc_type=None) -> str:
+    """Short prompt for a classified document, or the generic one when the type is unknown."""
+    spec = TYPE_PROMPTS.get(doc_type)
+    if spec is None:
+        return GENERIC_PROMPT
+    return TYPED_PROMPT.format(doc_type=doc_type, **spec)
+
+
+def extract_with_gemini(pdf_path, doc_type=None):
+    """
+    Structured JSON for one PDF. `doc_type` (from doc_classifier) selects a
+    type-specific prompt and output shape; None sends the generic prompt,
+    which also asks the model for the type.
+    """
+    prompt = extraction_prompt(doc_type)
+    options = {"generation_config": {"response_mime_type": "application/json"}} if doc_type in TYPE_PROMPTS else {}
+
+
     try:
-        # Upload PDF and generate content
-        response = model.generate_content([prompt, genai.upload_file(pdf_path)])
-        raw = response.text.strip()
+        # Upload PDF and generate content; a malformed or cut-off answer is repaired
+        data, raw = generate_json(MODEL, [prompt], stage="extraction", expect="object", files=[pdf_path], **options)
+        if doc_type in TYPE_PROMPTS:
+            data["document_type"] = doc_type
+        return data, raw
+    except BudgetError:
+        raise
+    except Exception as e:
+        return {"error": str(e)}, raw if 'raw' in locals() else ""
 
-        # Extract only JSON part
-        json_start = raw.find("{")
-        json_end = raw.rfind("}") + 1
-        json_clean = raw[json_start:json_end]
+# ---------- Voyage-specific contract fields ----------
+def extract_contract_fields(contract_text):
+    """
+    For a contract whose clauses are already known (same charter-party form),
+    pull out only the fields that change per voyage from its text.
+    """
+
+    prompt = """
+    You will receive the text of a charter party contract. Return a single JSON object with only these keys
+    (use "" when absent, values without units):
+    "laytime_commencement", "demurrage", "despatch", "disrate", "terms",
+    "Vessel Name", "Charterer", "Quantity", "Product", "Port",
+    "working_hours": {"Monday to Friday": "HH:MM to HH:MM", "Saturday": "HH:MM to HH:MM"}
+    Output must be valid JSON only.
+    """
 
-        return json.loads(json_clean), raw
+    try:
+        return generate_json(
+            MODEL, [prompt, contract_text], stage="extraction", expect="object",
+            generation_config={"response_mime_type": "application/json"}
+        )
+    except BudgetError:
+        raise
     except Exception as e:
-        return {"error": str(e)}, response.text if 'response' in locals() else ""
\ No newline at end of file
+        return {"error": str(e)}, ""
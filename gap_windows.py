@@ -0,0 +1,135 @@
+# gap_windows.py
+
+import os
+
+import numpy as np
+
+from event_model import MISSING, Timeline
+
+# ---------- CONFIG ----------
+DAY = 1440
+DAY_END = DAY - 1                    # rows that close a day end at 23:59
+WINDOW_DAYS = int(os.getenv("LAYTIME_GAP_WINDOW_DAYS", "2"))     # days per gap-fill prompt, 0 = one prompt
+MIN_WINDOWED_DAYS = 4                # shorter voyages still go in a single prompt
+GAP_FILL_WORKERS = int(os.getenv("LAYTIME_GAP_FILL_WORKERS", "4"))
+COMPLETION_PATTERN = r"complet\w*\s+(?:of\s+)?discharg|discharg\w*\s+complet"
+
+
+def plan_windows(tl: Timeline, window_days: int = WINDOW_DAYS, min_days: int = MIN_WINDOWED_DAYS) -> list[dict]:
+    """
+    Split a sorted timeline into runs of `window_days` calendar days. Each
+    window owns the rows starting on its days ("rows", index array) and is
+    sent with one more row on each side ("context") so the model sees how
+    the neighbouring day ends and starts. A single window comes back when
+    the voyage is short or windowing is off.
+    """
+    if not len(tl):
+        return []
+    days = tl.start // DAY
+    first, last = int(days.min()), int(days.max())
+    if window_days <= 0 or last - first + 1 < max(min_days, 2 * window_days):
+        return [{"first_day": first, "last_day": last, "rows": np.arange(len(tl)), "context": np.arange(len(tl))}]
+
+    windows = []
+    for d0 in range(first, last + 1, window_days):
+        d1 = min(d0 + window_days - 1, last)
+        rows = np.flatnonzero((days >= d0) & (days <= d1))
+        if not len(rows):
+            continue
+        lo, hi = max(int(rows[0]) - 1, 0), min(int(rows[-1]) + 1, len(tl) - 1)
+        windows.append({"first_day": d0, "last_day": d1, "rows": rows, "context": np.arange(lo, hi + 1)})
+    # The first and last windows also own anything the model puts outside the voyage's days
+    windows[0]["first_day"], windows[-1]["last_day"] = None, None
+    return windows
+
+
+def owned(filled: Timeline, window: dict) -> Timeline:
+    """The rows of a window's output that start on its own days; the rest is its neighbours' context."""
+    days = filled.start // DAY
+    mask = np.ones(len(filled), dtype=bool)
+    if window["first_day"] is not None:
+        mask &= days >= window["first_day"]
+    if window["last_day"] is not None:
+        mask &= days <= window["last_day"]
+    return filled[mask]
+
+
+def _collapse_day(tl: Timeline, day: int, label: str) -> tuple[Timeline, bool]:
+    """One 00:00–23:59 row for an excepted day, as the gap-fill prompt asks for."""
+    on_day = tl.start // DAY == day
+    if not on_day.any():
+        return tl, False
+    rows = np.flatnonzero(on_day)
+    if len(rows) == 1 and tl.start[rows[0]] == day * DAY and tl.end[rows[0]] == day * DAY + DAY_END:
+        return tl, False
+    row = Timeline([day * DAY], [day * DAY + DAY_END], [label], [""], [tl.source[rows[0]]])
+    return Timeline.concat([tl[~on_day], row]).sorted(), True
+
+
+def window_of(tl: Timeline, windows: list[dict]) -> np.ndarray:
+    """Index of the window that owns each row (by the day it starts on)."""
+    bounds = np.array([w["last_day"] for w in windows[:-1]], dtype=np.int64)
+    return np.searchsorted(bounds, tl.start // DAY, side="left")
+
+
+def stitch_windows(parts: list[Timeline], windows: list[dict], calendar=None) -> tuple[Timeline, dict]:
+    """
+    Join the owned rows of each window's output (`parts`, in window order),
+    then make every edge between two windows consistent:
+    - an excepted day (Sunday/holiday) on either side of the edge is a single
+      00:00–23:59 row;
+    - the last row before the edge stops at the next window's first row, and
+      ends at 23:59 when that row is on a later day;
+    - a gap left across the edge is filled with the previous row's reason;
+    - nothing from a later window survives after a "completed discharging"
+      row, which the prompt makes the last entry.
+    Returns (timeline, {"windows", "boundary_fixes", "fixes"}).
+    """
+    fixes = {"excepted": 0, "overlap": 0, "day_end": 0, "gap": 0, "after_completion": 0}
+    tl = Timeline.concat(parts).sorted()
+
+    if calendar is not None:
+        edge_days = sorted({d for w in windows[:-1] for d in (w["last_day"], w["last_day"] + 1)})
+        for day in edge_days:
+            if calendar.is_excepted(day):
+                label = "National Holiday" if day in calendar.holidays else "Sunday"
+                tl, changed = _collapse_day(tl, day, label)
+                fixes["excepted"] += changed
+
+    start, end = tl.start.copy(), tl.end.copy()
+    owners = window_of(tl, windows)
+    gaps = []
+    for k in range(len(windows) - 1):
+        mine, theirs = np.flatnonzero(owners == k), np.flatnonzero(owners > k)
+        if not len(mine) or not len(theirs):
+            continue
+        i, next_start = int(mine[-1]), int(start[theirs[0]])
+        day_end = int(start[i]) // DAY * DAY + DAY_END
+        if end[i] != MISSING and end[i] > next_start:
+            end[i] = next_start
+            fixes["overlap"] += 1
+        elif next_start // DAY > int(start[i]) // DAY and (end[i] == MISSING or end[i] < day_end):
+            end[i] = day_end
+            fixes["day_end"] += 1
+        # 23:59 -> 00:00 is the day break, not a gap
+        prev_end = int(start[i]) if end[i] == MISSING else int(end[i])
+        gap_from = prev_end + 1 if prev_end % DAY == DAY_END else prev_end
+        if next_start > gap_from:
+            gaps.append((gap_from, next_start, tl.reason[i], tl.phase[i], tl.source[i]))
+            fixes["gap"] += 1
+
+    tl = Timeline(start, end, tl.reason, tl.phase, tl.source)
+    if gaps:
+        tl = Timeline.concat([tl, Timeline(*[list(col) for col in zip(*gaps)])]).sorted()
+
+    # The prompt ends the timeline when discharge is completed
+    done = np.flatnonzero(tl.matches(COMPLETION_PATTERN))
+    if len(done):
+        c = int(done[-1])
+        owners = window_of(tl, windows)
+        later = (owners > owners[c]) & (tl.start > tl.start[c])
+        if later.any():
+            fixes["after_completion"] = int(later.sum())
+            tl = tl[~later]
+
+    return tl, {"windows": len(windows), "boundary_fixes": sum(fixes.values()), "fixes": fixes}
@@ -0,0 +1,244 @@
+# gemini_client.py
+
+import os
+import json
+import time
+from typing import Callable, Optional
+
+import google.generativeai as genai
+
+from metrics import METRICS, Metrics
+from json_repair import extend_at, parse_json, value_at
+from prompt_codec import check_budget, estimate_tokens
+from cassette import active_cassette, request_key
+from deadlines import BudgetError, call_timeout, call_with_deadline, current_budget
+from hedging import HEDGER
+
+# ---------- CONFIG ----------
+DEFAULT_MODEL = "models/gemini-1.5-flash-latest"
+
+# Per stage: models tried cheapest first, and the confidence needed to stop early.
+# Override with LAYTIME_CASCADE_<STAGE>_MODELS="m1,m2" and LAYTIME_CASCADE_<STAGE>_THRESHOLD=0.8
+CASCADES = {
+    "deduction": {
+        "models": ["models/gemini-1.5-flash-8b-latest", "models/gemini-1.5-pro-latest"],
+        "threshold": 0.75,
+    },
+}
+
+EXACT_TOKEN_COUNT = os.getenv("LAYTIME_EXACT_TOKEN_COUNT") == "1"   # ask the API instead of estimating (one extra round trip)
+
+# Follow-up calls for the rest of a cut-off JSON answer that repair can't supply
+MAX_CONTINUATIONS = 2
+CONTINUE_ARRAY = """Your previous answer was cut off. It was a JSON array{where}, and its last complete element was:
+{last}
+Return ONLY a JSON array with the elements that come after that one, in the same format. Do not repeat earlier elements."""
+CONTINUE_KEYS = """Your previous answer was cut off before these keys: {keys}.
+Return ONLY a JSON object with those keys, in the same format."""
+
+# ---------- INIT ----------
+genai.configure(api_key=os.getenv("GOOGLE_API_KEY"))
+_models = {}
+
+
+def stage_config(stage: str) -> dict:
+    """Cascade settings for a stage, with environment overrides applied."""
+    cfg = dict(CASCADES.get(stage, {"models": [DEFAULT_MODEL], "threshold": 0.0}))
+    env = stage.upper()
+    if os.getenv(f"LAYTIME_CASCADE_{env}_MODELS"):
+        cfg["models"] = [m.strip() for m in os.environ[f"LAYTIME_CASCADE_{env}_MODELS"].split(",") if m.strip()]
+    if os.getenv(f"LAYTIME_CASCADE_{env}_THRESHOLD"):
+        cfg["threshold"] = float(os.environ[f"LAYTIME_CASCADE_{env}_THRESHOLD"])
+    return cfg
+
+
+def get_model(name: str):
+    if name not in _models:
+        _models[name] = genai.GenerativeModel(name)
+    return _models[name]
+
+
+def generate(model_name: str, contents, stage: str = "default", files=(), **kwargs) -> str:
+    """
+    One model call; returns the response text and records latency per stage
+    and model. `files` are local paths uploaded alongside `contents`. With an
+    active cassette the call is recorded, or served from the recording. Live
+    calls run under the stage's deadline and the current run budget.
+    """
+    cassette = active_cassette()
+    # Pre-flight: count the input and refuse a prompt over the stage's token budget
+    live = cassette is None or cassette.mode != "replay"
+    if EXACT_TOKEN_COUNT and live and not files:
+        tokens = get_model(model_name).count_tokens(contents).total_tokens
+    else:
+        tokens = estimate_tokens(contents, files)
+    check_budget(stage, tokens)
+    key = request_key(model_name, contents, files, kwargs) if cassette is not None else None
+    t0 = time.perf_counter()
+    text, error, stopped = None, None, False
+    try:
+        if cassette is not None and cassette.mode == "replay":
+            budget = current_budget()
+            if budget is not None:
+                budget.check()
+            entry = cassette.play(key, stage=stage, model_name=model_name, contents=contents, files=files)
+            if entry.get("error"):
+                raise RuntimeError(entry["error"])
+            text = entry["text"]
+        else:
+            # Files are uploaded once, before any hedging; a duplicate request reuses them
+            uploaded = call_with_deadline(lambda: [genai.upload_file(p) for p in files], stage) if files else []
+            parts = (list(contents) if isinstance(contents, list) else [contents]) + uploaded
+            timeout = call_timeout(stage)
+
+            def call():
+                return get_model(model_name).generate_content(
+                    parts if files else contents, request_options={"timeout": timeout}, **kwargs
+                ).text
+
+            # Hedging-aware limits: first attempts wait for a token, duplicates only use spare ones
+            kind = f"{stage}:{model_name}"
+            HEDGER.limiter(model_name).acquire(current_budget())
+            # Latency is the model's, not the upload's or the wait for a token
+            t0 = time.perf_counter()
+            HEDGER.start_primary(kind)
+            hedge = {}
+            try:
+                text = call_with_deadline(
+                    call, stage, hedge_after=HEDGER.delay(kind),
+                    may_hedge=lambda: HEDGER.try_hedge(kind, model_name), stats=hedge,
+                )
+            finally:
+                HEDGER.finish(kind, time.perf_counter() - t0, hedge.get("hedged", False), hedge.get("hedge_won", False))
+        return text
+    except BudgetError as e:
+        stopped = True
+        METRICS.incr(f"model.{stage}.{model_name}.{type(e).__name__.lower()}")
+        raise
+    except Exception as e:
+        error = str(e)
+        METRICS.incr(f"model.{stage}.{model_name}.errors")
+        raise
+    finally:
+        latency = time.perf_counter() - t0
+        METRICS.incr(f"model.{stage}.{model_name}.calls")
+        METRICS.observe(f"model.{stage}.{model_name}.latency_s", latency)
+        # A run that was stopped says nothing about the model; don't replay it
+        if cassette is not None and cassette.mode == "record" and not stopped:
+            cassette.record(key, stage, model_name, latency, text=text, error=error)
+
+
+def generate_json(model_name: str, contents, stage: str = "default", expect: Optional[str] = None,
+                  required=(), files=(), **kwargs) -> tuple[object, str]:
+    """
+    generate() for an answer that should be JSON; returns (value, raw).
+    The answer goes through the repair parser, so fences, commentary,
+    comments, quotes and literals cost no extra call. Only when the answer
+    was cut off does a short continuation request ask for what is missing:
+    the elements after the last complete one of the array it stopped in,
+    then any `required` keys still absent. Raises ValueError if nothing
+    parseable came back.
+    """
+    raw = generate(model_name, contents, stage=stage, files=files, **kwargs).strip()
+    value, info = parse_json(raw, expect, stage=stage)
+    base = list(contents) if isinstance(contents, list) else [contents]
+
+    # A continuation of an array is itself an array; it may be cut off again
+    path, last, cut = info["cut_path"], info["cut_last"], info["truncated"]
+    for _ in range(MAX_CONTINUATIONS):
+        if not cut or path is None or not isinstance(value_at(value, path), list):
+            break
+        METRICS.incr(f"json.{stage}.continuations")
+        where = f' (the "{".".join(path)}" field)' if path else ""
+        ask = CONTINUE_ARRAY.format(where=where, last=json.dumps(last, default=str))
+        more = generate(model_name, base + [ask], stage=stage, files=files, **kwargs)
+        try:
+            tail, more_info = parse_json(more, "array", stage=stage)
+        except ValueError:
+            break
+        extend_at(value, path, tail)
+        cut = more_info["truncated"]
+        if tail:
+            last = value_at(value, path)[-1]
+
+    missing = [k for k in required if isinstance(value, dict) and k not in value]
+    if info["truncated"] and missing:
+        METRICS.incr(f"json.{stage}.continuations")
+        ask = CONTINUE_KEYS.format(keys=", ".join(missing))
+        more = generate(model_name, base + [ask], stage=stage, files=files, **kwargs)
+        try:
+            extra, _ = parse_json(more, "object", stage=stage)
+            value.update({k: extra[k] for k in missing if k in extra})
+        except ValueError:
+            pass
+    return value, raw
+
+
+def cascade(stage: str, contents, parse: Callable[[str], dict],
+            confidence: Callable[[dict], Optional[float]], **kwargs) -> tuple[dict, str]:
+    """
+    Try the stage's models cheapest first. `confidence(result)` returns None
+    when the parsed result fails schema validation, otherwise its confidence;
+    a valid result at or above the stage threshold stops the cascade. When no
+    model clears the bar, the most confident valid result is returned.
+    Returns (result, model_name). Re-raises if every model errors, and raises
+    ValueError if no model gave a schema-valid result, so callers fall back.
+    """
+    cfg = stage_config(stage)
+    models = cfg["models"]
+    if not models:
+        raise ValueError(f"no models configured for stage {stage!r}")
+    best, best_conf, best_model = None, -1.0, None
+    last_error = None
+    METRICS.incr(f"cascade.{stage}.requests")
+
+    for level, model_name in enumerate(models):
+        if level:
+            METRICS.incr(f"cascade.{stage}.escalations")
+        try:
+            result = parse(generate(model_name, contents, stage=stage, **kwargs))
+        except BudgetError:
+            raise
+        except Exception as e:
+            last_error = e
+            continue
+
+        conf = confidence(result)
+        if conf is None:
+            METRICS.incr(f"cascade.{stage}.schema_failures")
+            last_error = ValueError(f"{model_name} gave no schema-valid result for stage {stage!r}")
+            continue
+        if conf > best_conf:
+            best, best_conf, best_model = result, conf, model_name
+        if conf >= cfg["threshold"]:
+            break
+        METRICS.incr(f"cascade.{stage}.low_confidence")
+
+    if best is None:
+        raise last_error
+    METRICS.incr(f"cascade.{stage}.answered_by.{best_model}")
+    return best, best_model
+
+
+def cascade_report(stage: str, before: Optional[dict] = None, metrics: Optional[Metrics] = None) -> dict:
+    """
+    Requests, escalations and escalation rate for a stage (since `before`, a
+    prior report, if given), from `metrics` (a run's collector) or METRICS.
+    """
+    counters = (metrics or METRICS).counters_with_prefix(f"cascade.{stage}.")
+    base = (before or {}).get("counters", {})
+    delta = {k: v - base.get(k, 0) for k, v in counters.items()}
+    requests = delta.get(f"cascade.{stage}.requests", 0)
+    escalations = delta.get(f"cascade.{stage}.escalations", 0)
+    return {
+        "stage": stage,
+        "threshold": stage_config(stage)["threshold"],
+        "requests": int(requests),
+        "escalations": int(escalations),
+        "escalation_rate": escalations / requests if requests else 0.0,
+        "schema_failures": int(delta.get(f"cascade.{stage}.schema_failures", 0)),
+        "answered_by": {
+            k.rsplit("answered_by.", 1)[1]: int(v) for k, v in delta.items() if ".answered_by." in k and v
+        },
+        "counters": counters,
+    }
@@ -0,0 +1,189 @@
+# hedging.py
+
+import os
+import time
+import threading
+from collections import defaultdict, deque
+from typing import Optional
+
+import numpy as np
+
+from metrics import METRICS, Metrics
+
+# ---------- CONFIG ----------
+HEDGING_ENABLED = os.getenv("LAYTIME_HEDGE", "0") == "1"            # opt-in
+HEDGE_PERCENTILE = float(os.getenv("LAYTIME_HEDGE_PERCENTILE", "95"))
+HEDGE_MIN_SAMPLES = 20          # no hedging until a call type has this much history
+HEDGE_MIN_DELAY = 0.5           # seconds; never hedge faster than this
+HEDGE_MAX_EXTRA_RATIO = 0.05    # hedges may add at most 5% extra requests overall
+HEDGE_MAX_IN_FLIGHT = 4         # and at most this many at once
+RECENT_SAMPLES = 500            # rolling window per call type for the percentile
+RATE_LIMIT_RPM = float(os.getenv("LAYTIME_RPM", "0"))              # per model, 0 = unlimited
+HEDGE_TOKEN_RESERVE = 0.25      # hedges only use tokens while the bucket is above this share
+BUCKET_EDGES = np.geomspace(0.05, 600, 25)                          # seconds, log-spaced
+
+
+class LatencyHistogram:
+    """Log-bucketed latency counts plus a rolling window for percentiles, per call type."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counts = defaultdict(lambda: np.zeros(len(BUCKET_EDGES) + 1, dtype=np.int64))
+        self.recent = defaultdict(lambda: deque(maxlen=RECENT_SAMPLES))
+
+    def observe(self, kind: str, seconds: float):
+        with self._lock:
+            self.counts[kind][np.searchsorted(BUCKET_EDGES, seconds)] += 1
+            self.recent[kind].append(seconds)
+
+    def percentile(self, kind: str, q: float) -> Optional[float]:
+        with self._lock:
+            samples = list(self.recent.get(kind, ()))
+        if len(samples) < HEDGE_MIN_SAMPLES:
+            return None
+        return float(np.percentile(samples, q))
+
+    def snapshot(self) -> dict:
+        """{kind: {"le_<edge>": count, ..., "p50", "p95", "p99"}} for reports."""
+        with self._lock:
+            counts = {k: v.copy() for k, v in self.counts.items()}
+            recent = {k: np.asarray(v) for k, v in self.recent.items()}
+        out = {}
+        for kind, c in counts.items():
+            labels = [f"le_{e:.3g}" for e in BUCKET_EDGES] + ["le_inf"]
+            row = {label: int(n) for label, n in zip(labels, c) if n}
+            if recent[kind].size:
+                for q in (50, 95, 99):
+                    row[f"p{q}"] = float(np.percentile(recent[kind], q))
+            out[kind] = row
+        return out
+
+
+class RateLimiter:
+    """
+    Token bucket per model. Primary requests wait for a token; hedges only
+    take one if it's there right now and the bucket stays above the reserve,
+    so duplicates never delay first attempts.
+    """
+
+    def __init__(self, per_minute: float = RATE_LIMIT_RPM):
+        self.rate = per_minute / 60.0
+        self.capacity = max(per_minute / 6.0, 1.0)     # ten seconds' worth of burst
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, budget=None):
+        if self.rate <= 0:
+            return
+        while True:
+            with self._lock:
+                self._refill()
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            if budget is not None:
+                budget.check()
+            time.sleep(min(wait, 0.2))
+
+    def try_acquire_hedge(self) -> bool:
+        if self.rate <= 0:
+            return True
+        with self._lock:
+            self._refill()
+            if self.tokens - 1 >= HEDGE_TOKEN_RESERVE * self.capacity:
+                self.tokens -= 1
+                return True
+            return False
+
+
+class Hedger:
+    """Decides when a slow call gets a duplicate, within the global extra-request cap."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.primaries = 0
+        self.hedges = 0
+        self.in_flight = 0
+        self.histogram = LatencyHistogram()
+        self._limiters = {}
+
+    def limiter(self, model_name: str) -> RateLimiter:
+        with self._lock:
+            if model_name not in self._limiters:
+                self._limiters[model_name] = RateLimiter()
+            return self._limiters[model_name]
+
+    def delay(self, kind: str) -> Optional[float]:
+        """Seconds after which a call of this kind is hedged, or None (disabled / not enough history)."""
+        if not HEDGING_ENABLED:
+            return None
+        p = self.histogram.percentile(kind, HEDGE_PERCENTILE)
+        return None if p is None else max(p, HEDGE_MIN_DELAY)
+
+    def start_primary(self, kind: str):
+        with self._lock:
+            self.primaries += 1
+        METRICS.incr(f"hedge.{kind}.primary")
+
+    def try_hedge(self, kind: str, model_name: str) -> bool:
+        """Claim a hedge slot: under the global cap and with a spare rate-limit token."""
+        with self._lock:
+            if self.in_flight >= HEDGE_MAX_IN_FLIGHT or self.hedges + 1 > HEDGE_MAX_EXTRA_RATIO * self.primaries:
+                METRICS.incr(f"hedge.{kind}.capped")
+                return False
+        if not self.limiter(model_name).try_acquire_hedge():
+            METRICS.incr(f"hedge.{kind}.rate_limited")
+            return False
+        with self._lock:
+            self.hedges += 1
+            self.in_flight += 1
+        METRICS.incr(f"hedge.{kind}.fired")
+        return True
+
+    def finish(self, kind: str, seconds: float, hedged: bool, hedge_won: bool):
+        self.histogram.observe(kind, seconds)
+        if hedged:
+            with self._lock:
+                self.in_flight -= 1
+            if hedge_won:
+                METRICS.incr(f"hedge.{kind}.won")
+
+    def report(self) -> dict:
+        with self._lock:
+            primaries, hedges = self.primaries, self.hedges
+        return {
+            "enabled": HEDGING_ENABLED,
+            "primaries": primaries,
+            "hedges": hedges,
+            "extra_ratio": hedges / primaries if primaries else 0.0,
+            "latency": self.histogram.snapshot(),
+        }
+
+    def run_report(self, metrics: Metrics) -> dict:
+        """report() for the calls recorded in one run's collector; latency as p50/p95/max per stage:model."""
+        counters = metrics.counters_with_prefix("hedge.")
+        primaries = int(sum(v for k, v in counters.items() if k.endswith(".primary")))
+        hedges = int(sum(v for k, v in counters.items() if k.endswith(".fired")))
+        latency = {}
+        for name, t in metrics.snapshot()["timings"].items():
+            # model.<stage>.<model>.latency_s
+            if name.startswith("model.") and name.endswith(".latency_s"):
+                stage, model_name = name[len("model."):-len(".latency_s")].split(".", 1)
+                latency[f"{stage}:{model_name}"] = {k: t[k] for k in ("count", "p50", "p95", "max")}
+        return {
+            "enabled": HEDGING_ENABLED,
+            "primaries": primaries,
+            "hedges": hedges,
+            "extra_ratio": hedges / primaries if primaries else 0.0,
+            "latency": latency,
+        }
+
+
+HEDGER = Hedger()
@@ -0,0 +1,309 @@
+# json_repair.py
+
+import re
+import json
+from typing import Optional
+
+from metrics import METRICS
+
+# ---------- CONFIG ----------
+FENCE_PATTERN = re.compile(r"```(?:json|JSON)?\s*\n?(.*?)(?:```|$)", re.DOTALL)
+LITERALS = {
+    "true": True, "false": False, "null": None,
+    "True": True, "False": False, "None": None,
+    # JSON has no NaN/Infinity; downstream code expects null for "no value"
+    "nan": None, "NaN": None, "Infinity": None, "undefined": None,
+}
+LITERAL_PATTERN = re.compile(r"-?Infinity|[A-Za-z_]+")
+NUMBER_PATTERN = re.compile(r"[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?")
+BARE_KEY_PATTERN = re.compile(r"[A-Za-z_$][\w$\- ]*")
+ESCAPES = {'"': '"', "'": "'", "\\": "\\", "/": "/", "b": "\b", "f": "\f", "n": "\n", "r": "\r", "t": "\t"}
+
+
+class _Truncated(Exception):
+    """The text ended inside a value; `partial` is what was complete of it."""
+
+    def __init__(self, partial=None):
+        self.partial = partial
+
+
+class _Parser:
+    """
+    Lenient recursive-descent JSON reader. Besides strict JSON it accepts
+    comments, single-quoted strings and bare keys, Python/JS literals,
+    trailing and missing commas. When the text stops early every complete
+    element is kept: a cut-off array element is dropped, a cut-off object
+    keeps its complete members.
+    """
+
+    def __init__(self, text: str):
+        self.text = text
+        self.pos = 0
+        self.fixes = set()
+        self.dropped = 0
+        self.cut_path = None        # keys to the array the text stopped in
+        self.cut_last = None        # its last complete element
+
+    # ---------- Lexing ----------
+    def skip(self):
+        text, n = self.text, len(self.text)
+        while self.pos < n:
+            c = text[self.pos]
+            if c.isspace():
+                self.pos += 1
+            elif text.startswith("//", self.pos) or c == "#":
+                end = text.find("\n", self.pos)
+                self.pos = n if end < 0 else end + 1
+                self.fixes.add("comment")
+            elif text.startswith("/*", self.pos):
+                end = text.find("*/", self.pos + 2)
+                self.pos = n if end < 0 else end + 2
+                self.fixes.add("comment")
+            else:
+                return
+
+    def peek(self) -> str:
+        self.skip()
+        if self.pos >= len(self.text):
+            raise _Truncated()
+        return self.text[self.pos]
+
+    # ---------- Values ----------
+    def value(self, path: tuple):
+        c = self.peek()
+        if c == "{":
+            return self.object(path)
+        if c == "[":
+            return self.array(path)
+        if c in "\"'":
+            return self.string()
+        return self.scalar()
+
+    def object(self, path: tuple) -> dict:
+        self.pos += 1
+        out = {}
+        while True:
+            try:
+                c = self.peek()
+                if c == "}":
+                    self.pos += 1
+                    return out
+                if c == ",":
+                    # ",}" or ",," — a stray comma
+                    self.pos += 1
+                    self.fixes.add("trailing_comma")
+                    continue
+                key = self.key()
+                if self.peek() != ":":
+                    raise ValueError(f"expected ':' after key {key!r} at offset {self.pos}")
+                self.pos += 1
+            except _Truncated:
+                raise _Truncated(out)
+            try:
+                out[key] = self.value(path + (key,))
+            except _Truncated as t:
+                # A container keeps what it had; a cut-off scalar is dropped
+                if isinstance(t.partial, (dict, list)):
+                    out[key] = t.partial
+                else:
+                    self.dropped += 1
+                raise _Truncated(out)
+            try:
+                c = self.peek()
+            except _Truncated:
+                raise _Truncated(out)
+            if c == ",":
+                self.pos += 1
+            elif c != "}":
+                self.fixes.add("missing_comma")
+
+    def array(self, path: tuple) -> list:
+        self.pos += 1
+        out = []
+        while True:
+            try:
+                c = self.peek()
+                if c == "]":
+                    self.pos += 1
+                    return out
+                if c == ",":
+                    self.pos += 1
+                    self.fixes.add("trailing_comma")
+                    continue
+                try:
+                    out.append(self.value(path))
+                except _Truncated:
+                    self.dropped += 1
+                    raise
+                c = self.peek()
+            except _Truncated:
+                # Any array deeper down was inside the element just dropped
+                self.cut_path, self.cut_last = list(path), (out[-1] if out else None)
+                raise _Truncated(out)
+            if c == ",":
+                self.pos += 1
+            elif c != "]":
+                self.fixes.add("missing_comma")
+
+    def key(self) -> str:
+        c = self.peek()
+        if c in "\"'":
+            return self.string()
+        m = BARE_KEY_PATTERN.match(self.text, self.pos)
+        if not m:
+            raise ValueError(f"unexpected {c!r} at offset {self.pos}")
+        self.pos = m.end()
+        self.fixes.add("bare_key")
+        return m.group(0).strip()
+
+    def string(self) -> str:
+        quote = self.text[self.pos]
+        if quote == "'":
+            self.fixes.add("single_quote")
+        self.pos += 1
+        text, n = self.text, len(self.text)
+        chunks = []
+        while True:
+            end = self.pos
+            while end < n and text[end] not in (quote, "\\"):
+                end += 1
+            chunks.append(text[self.pos:end])
+            if end >= n:
+                self.pos = n
+                raise _Truncated()
+            if text[end] == quote:
+                self.pos = end + 1
+                return "".join(chunks)
+            # Backslash escape
+            if end + 1 >= n:
+                self.pos = n
+                raise _Truncated()
+            e = text[end + 1]
+            if e == "u" and re.fullmatch(r"[0-9a-fA-F]{4}", text[end + 2:end + 6]):
+                chunks.append(chr(int(text[end + 2:end + 6], 16)))
+                self.pos = end + 6
+            elif e in ESCAPES:
+                chunks.append(ESCAPES[e])
+                self.pos = end + 2
+            else:
+                # "\d" and the like: keep the backslash as written
+                chunks.append("\\" + e)
+                self.pos = end + 2
+                self.fixes.add("escape")
+
+    def scalar(self):
+        text = self.text
+        m = LITERAL_PATTERN.match(text, self.pos)
+        if m:
+            word = m.group(0)
+            if m.end() >= len(text) and any(lit.startswith(word) and lit != word for lit in LITERALS):
+                self.pos = len(text)
+                raise _Truncated()
+            if word.lstrip("-") not in LITERALS:
+                raise ValueError(f"unexpected {word!r} at offset {self.pos}")
+            if word not in ("true", "false", "null"):
+                self.fixes.add("literal")
+            self.pos = m.end()
+            return LITERALS[word.lstrip("-")]
+        m = NUMBER_PATTERN.match(text, self.pos)
+        if not m:
+            raise ValueError(f"unexpected {text[self.pos]!r} at offset {self.pos}")
+        if m.end() >= len(text):
+            # The digits may have gone on
+            self.pos = len(text)
+            raise _Truncated()
+        self.pos = m.end()
+        number = m.group(0)
+        if re.fullmatch(r"[-+]?\d+", number):
+            return int(number)
+        return float(number)
+
+
+def _candidate(text: str, expect: Optional[str]) -> tuple[str, set]:
+    """The part of a response that should hold the JSON: inside a code fence if there is one."""
+    fixes = set()
+    m = FENCE_PATTERN.search(text)
+    if m and m.group(1).strip():
+        text = m.group(1)
+        fixes.add("fence")
+    opener = {"object": "{", "array": "["}.get(expect)
+    starts = [i for i in ((text.find(opener),) if opener else (text.find("{"), text.find("["))) if i >= 0]
+    if not starts:
+        raise ValueError(f"No JSON {expect or 'value'} found in the response text.")
+    return text[min(starts):], fixes
+
+
+def parse_json(text: str, expect: Optional[str] = None, stage: str = "default") -> tuple[object, dict]:
+    """
+    Parse a model response that should be JSON (`expect` "object", "array"
+    or None for either). Code fences, commentary around the value, comments,
+    single quotes, None/nan literals and trailing commas are repaired; a
+    response cut off mid-way keeps every complete element. Returns
+    (value, info) where info has "repaired", "truncated", "fixes",
+    "dropped" and, for a truncated response, "cut_path"/"cut_last" (the
+    keys leading to the array it stopped in, and that array's last
+    complete element). Raises ValueError when nothing can be recovered.
+    """
+    body, fixes = _candidate(str(text or ""), expect)
+    closer = {"{": "}", "[": "]"}[body[0]]
+    info = {"repaired": False, "truncated": False, "fixes": [], "dropped": 0, "cut_path": None, "cut_last": None}
+
+    # Fast path: the usual, well-formed answer
+    end = body.rfind(closer) + 1
+    try:
+        value = json.loads(body[:end])
+        if body[end:].strip():
+            fixes.add("trailing_text")
+        if fixes:
+            info.update(repaired=True, fixes=sorted(fixes))
+            METRICS.incr(f"json.{stage}.repaired")
+        return value, info
+    except (json.JSONDecodeError, ValueError):
+        pass
+
+    parser = _Parser(body)
+    try:
+        value = parser.value(())
+        if body[parser.pos:].strip():
+            parser.fixes.add("trailing_text")
+    except _Truncated as t:
+        value = t.partial
+        if value is None:
+            METRICS.incr(f"json.{stage}.failed")
+            raise ValueError("The response ended before any complete JSON value.")
+        parser.fixes.add("truncated")
+        info.update(truncated=True, cut_path=parser.cut_path, cut_last=parser.cut_last)
+        METRICS.incr(f"json.{stage}.truncated")
+    except ValueError as e:
+        METRICS.incr(f"json.{stage}.failed")
+        raise ValueError(f"Unrepairable JSON: {e}") from None
+
+    info.update(repaired=True, fixes=sorted(fixes | parser.fixes), dropped=parser.dropped)
+    METRICS.incr(f"json.{stage}.repaired")
+    return value, info
+
+
+def value_at(value, path) -> object:
+    """The value under a list of object keys (None if a key is missing)."""
+    for key in path or ():
+        if not isinstance(value, dict):
+            return None
+        value = value.get(key)
+    return value
+
+
+def extend_at(value, path, tail: list) -> int:
+    """
+    Append a continuation's elements to the array under `path`, skipping
+    the leading ones the model repeated from before the cut. Returns how
+    many were added.
+    """
+    target = value_at(value, path)
+    if not isinstance(target, list):
+        return 0
+    for k in range(min(len(tail), len(target)), 0, -1):
+        if target[-k:] == tail[:k]:
+            tail = tail[k:]
+            break
+    target.extend(tail)
+    return len(tail)
@@ -5,8 +5,13 @@ import pandas as pd
 from google.cloud import aiplatform
 import google.generativeai as genai
 from datetime import datetime
-import numbers
-from typing import List, Dict
+from typing import List, Dict, Optional
+import numpy as np
+from event_model import Timeline
+from laytime_index import LaytimeIndex
+from gemini_client import generate, generate_json
+from deadlines import BudgetError
+from prompt_codec import compact_json, record_savings
 
 # ---------- CONFIG ----------
 PROJECT_ID = "laytimecalculation"
@@ -17,147 +22,248 @@ MODEL = "models/gemini-1.5-flash-latest"
 aiplatform.init(project=PROJECT_ID, location=LOCATION)
 genai.configure(api_key=os.getenv("GOOGLE_API_KEY"))
 
+def _get_ci(d: dict, *names, default=None):
+    """d[name] for the first of `names` present, ignoring key case."""
+    lowered = {str(k).lower(): v for k, v in d.items()}
+    for name in names:
+        if name.lower() in lowered:
+            return lowered[name.lower()]
+    return default
+
+
 def flatten_contract(contract_data):
+    """
+    Contract clauses as {title: text}. Accepts the "Sections"/"Items"/
+    "Subsections" layout as well as the lower-case "sections" with
+    "heading"/"body" (or a {title: body} dict) that the extractor produces.
+    """
     flattened = {}
-    for section in contract_data.get("Sections", []):
-        for item in section.get("Items", []):
+    sections = _get_ci(contract_data or {}, "Sections", default=None)
+    if sections is None:
+        sections = _get_ci(_get_ci(contract_data or {}, "Agreement", default={}) or {}, "Sections", default=[])
+    if isinstance(sections, dict):
+        sections = [{"heading": title, "body": body} for title, body in sections.items()]
+    for section in sections or []:
+        if not isinstance(section, dict):
+            continue
+        for item in _get_ci(section, "Items", default=[]) or []:
             if isinstance(item, dict):
                 flattened.update(item)
-        for sub in section.get("Subsections", []):
+        for sub in _get_ci(section, "Subsections", default=[]) or []:
             if isinstance(sub, dict):
-                title = sub.get("Subsection Title") or sub.get("Clause Title")
-                content = sub.get("Content", "")
+                title = _get_ci(sub, "Subsection Title", "Clause Title", "title", "heading")
+                content = _get_ci(sub, "Content", "body", default="")
                 if title and content:
                     flattened[title] = content
+        heading = _get_ci(section, "heading", "title", default="") or ""
+        body = _get_ci(section, "body", "content", default=None)
+        if isinstance(body, dict):
+            flattened.update({f"{heading}: {k}" if heading else k: v for k, v in body.items()})
+        elif isinstance(body, (str, list)) and body and heading:
+            flattened[heading] = body
     return flattened
 
-# ---------- GEMINI EXTRACTION PROMPT ----------
-def extract_metadata_from_docs(contract_data, sof_data):
-    model = genai.GenerativeModel(MODEL)
+# ---------- LOCAL METADATA RESOLVER ----------
+METADATA_FIELDS = [
+    "Vessel Name", "A/C", "TERMS", "PRODUCT", "DISRATE", "LTC AT", "DEMMURAGE", "DESPATCH",
+    "Port", "Charterer", "Quantity", "NOR TENDERED", "NOR VALID",
+    "Vessel Arrival", "Vessel Berthed", "Commenced Cargo", "Completed Cargo",
+]
 
-    prompt = """
-You are a maritime document extraction assistant.
+# Fields the model only needs the contract for; the rest come from the SoF.
+CONTRACT_FIELDS = {"Vessel Name", "A/C", "TERMS", "PRODUCT", "DISRATE", "LTC AT", "DEMMURAGE", "DESPATCH"}
 
-You will receive:
-1. A structured Contract JSON (with sections and subsections)
-2. A Statement of Facts (SoF) JSON containing vessel operations and events.
-
----
-
-🎯 YOUR TASK: Extract and return a structured JSON object with the following keys:
-
-### 📘 From Contract:
-- Vessel Name
-- A/C. It can be present Charterer
-- TERMS
-- PRODUCT
-- DISCHARGE RATE/DISRATE. Check the document to find the quantity of goods which are to be discharged per day.
-- LTC AT
-- DEMURRAGE
-- DESPATCH
-
-### 📄 From SoF:
-- Port
-- Charterers
-- Quantity
-- NOR TENDERED (if present)
-- NOR VALID (if present)
-- Vessel Arrival Date & Time. It is the start time of the first event entry.
-- Vessel Berthed Date & Time
-- Commenced Cargo Date & Time
-- Completed Cargo Date & Time
-- Chronological Events: as a list of objects with:
-  - Date & Time
-  - Event
-  - Remarks (if present)
-
-⚠️ STRICTLY return the data in the following JSON format:
-
-```json
-{
-  "Vessel Name": "...",
-  "A/C": "...",
-  "TERMS": "...",
-  "PRODUCT": "...",
-  "DISRATE": "...",
-  "LTC AT": "...",
-  "DEMMURAGE": "...",
-  "DESPATCH": "...",
-  "Port": "...",
-  "Charterer": "...",
-  "Quantity": "...",
-  "NOR TENDERED": "...",
-  "NOR VALID": "...",
-  "Vessel Arrival": "...",
-  "Vessel Berthed": "...",
-  "Commenced Cargo": "...",
-  "Completed Cargo": "..."
+# Header keys as they tend to appear in the extracted JSON, matched case-insensitively.
+KEY_PATTERNS = {
+    "Vessel Name": r"^(vessel|vessel_?name|ship|ship_?name|name_of_vessel|mv)$",
+    "A/C":         r"^(a/c|account)$",
+    "Charterer":   r"^(charterers?|charterer_?name)$",
+    "TERMS":       r"^terms?$",
+    "PRODUCT":     r"^(product|cargo|commodity|cargo_?description)$",
+    "DISRATE":     r"^(disrate|discharge_?rate|discharging_?rate)$",
+    "LTC AT":      r"^(laytime_?commencement|ltc_?at)$",
+    "DEMMURAGE":   r"^(demurrage|demmurage|demurrage_?rate)$",
+    "DESPATCH":    r"^(despatch|dispatch|despatch_?rate)$",
+    "Port":        r"^(port|port_?of_?discharge|discharge_?port|discharging_?port|port_?name)$",
+    "Quantity":    r"^(quantity|cargo_?quantity|qty|bl_?quantity|b/l_?quantity)$",
 }
+
+# Only worth a model call when there is no event log to search.
+OPTIONAL_FIELDS = {"NOR TENDERED", "NOR VALID"}
+
+# First event whose text matches marks the milestone.
+EVENT_PATTERNS = {
+    "NOR TENDERED":    r"\bNOR tendered\b|\bNotice of Readiness tendered\b",
+    "NOR VALID":       r"\bNOR (accepted|valid)\b|\bNotice of Readiness (accepted|valid)\b",
+    "Vessel Berthed":  r"\b(berthed|all fast|made fast|alongside)\b",
+    "Commenced Cargo": r"\bcommenced (discharg|load|cargo|pumping)",
+    "Completed Cargo": r"\bcompleted (discharg|load|cargo|pumping)",
+}
+
+
+def _normalize_key(key) -> str:
+    return re.sub(r"[\s\-]+", "_", str(key).strip().lower())
+
+
+def _find_scalar(data, pattern: str, depth: int = 2):
+    """
+    Breadth-first search for the first scalar value whose key matches `pattern`.
+    Only header-like nesting is searched; clause sections and event logs are skipped.
+    """
+    level = [data]
+    for _ in range(depth + 1):
+        nested = []
+        for node in level:
+            if not isinstance(node, dict):
+                continue
+            for k, v in node.items():
+                if isinstance(v, (str, int, float)) and not isinstance(v, bool):
+                    if re.search(pattern, _normalize_key(k), re.IGNORECASE) and str(v).strip():
+                        return v
+                elif isinstance(v, dict) and _normalize_key(k) not in ("sections", "chronological_events"):
+                    nested.append(v)
+        level = nested
+    return None
+
+
+def _event_text(e: dict) -> str:
+    return " ".join(str(e.get(k) or "") for k in ("event_phase", "event", "Event", "reason", "remarks", "Remarks"))
+
+
+def _event_start(e: dict):
+    ts = e.get("timestamp") or e.get("start_time")
+    if isinstance(ts, datetime):
+        return ts.strftime("%Y-%m-%d %H:%M")
+    return str(ts) if ts else None
+
+
+def resolve_metadata_locally(contract_data: dict, sof_data: dict, events: Optional[list[dict]] = None,
+                             known: Optional[dict] = None) -> dict:
+    """
+    Fill the Excel header fields from structures we already have: the values
+    pulled out of the contract in app.py (`known`), the extracted contract/SoF
+    JSON, and the event log. Anything that can't be resolved is left out.
+    """
+    resolved = {k: v for k, v in (known or {}).items() if v not in (None, "")}
+
+    for field, pattern in KEY_PATTERNS.items():
+        if field in resolved:
+            continue
+        sources = (contract_data, sof_data) if field in CONTRACT_FIELDS else (sof_data, contract_data)
+        for src in sources:
+            value = _find_scalar(src or {}, pattern)
+            if value is not None:
+                resolved[field] = value
+                break
+
+    if "A/C" not in resolved and "Charterer" in resolved:
+        resolved["A/C"] = resolved["Charterer"]
+
+    dated = [e for e in (events or []) if _event_start(e)]
+    if dated and "Vessel Arrival" not in resolved:
+        # Vessel arrival is the start time of the first event entry.
+        resolved["Vessel Arrival"] = _event_start(dated[0])
+    for field, pattern in EVENT_PATTERNS.items():
+        if field in resolved:
+            continue
+        hit = next((e for e in dated if re.search(pattern, _event_text(e), re.IGNORECASE)), None)
+        if hit:
+            resolved[field] = _event_start(hit)
+
+    return resolved
+
+
+# ---------- GEMINI EXTRACTION PROMPT ----------
+def extract_metadata_from_docs(contract_data, sof_data, events: Optional[list[dict]] = None, known: Optional[dict] = None):
+    """
+    Resolve the header fields locally first and only ask Gemini for the ones
+    that are still missing. Returns (metadata, raw_response); raw_response is
+    empty when no model call was needed.
+    """
+    metadata = resolve_metadata_locally(contract_data, sof_data, events, known)
+    missing = [
+        f for f in METADATA_FIELDS
+        if f not in metadata and not (events and f in OPTIONAL_FIELDS)
+    ]
+    if not missing:
+        return metadata, ""
+
+    prompt = f"""
+You are a maritime document extraction assistant.
+Return ONLY a JSON object with exactly these keys (use "" if not found): {json.dumps(missing)}
+- DISRATE is the quantity of goods to be discharged per day.
+- A/C is the charterer.
+- Times as "YYYY-MM-DD HH:MM".
 """
+    parts = [prompt]
+    if any(f in CONTRACT_FIELDS for f in missing):
+        contract = flatten_contract(contract_data)
+        parts.append(f"\nContract:\n{compact_json(contract)}")
+        record_savings("metadata", json.dumps(contract, separators=(',', ':')), parts[-1])
+    if any(f not in CONTRACT_FIELDS for f in missing):
+        # The event log is only needed for the milestone times.
+        needs_events = any(f in EVENT_PATTERNS or f == "Vessel Arrival" for f in missing)
+        sof_header = sof_data if needs_events else {
+            k: v for k, v in (sof_data or {}).items()
+            if _normalize_key(k) not in ("chronological_events",)
+        }
+        # Empty fields dropped, event lists as one column header plus rows
+        parts.append(f"\nSoF:\n{compact_json(sof_header)}")
+        record_savings("metadata", json.dumps(sof_header, separators=(',', ':'), default=str), parts[-1])
+
     try:
-        flattened_contract = flatten_contract(contract_data)
-        response = model.generate_content(
-            [prompt, f"\n\nContract:\n{json.dumps(flattened_contract)}\n\nSoF:\n{json.dumps(sof_data)}"],
+        extracted, raw = generate_json(
+            MODEL, parts, stage="metadata", expect="object",
             generation_config={"response_mime_type": "application/json"}
         )
-        raw = response.text.strip()
-        match = re.search(r"\{[\s\S]*\}", raw)
-        if not match:
-            raise ValueError("❌ No JSON object found in Gemini response")
-        return json.loads(match.group(0)), raw
+        for f in missing:
+            if extracted.get(f) not in (None, ""):
+                metadata[f] = extracted[f]
+        return metadata, raw
+    except BudgetError:
+        raise
     except Exception as e:
-        return {"error": str(e)}, raw if 'raw' in locals() else ""
+        print(f"❌ Metadata extraction failed for {missing}: {e}")
+        return metadata, raw if 'raw' in locals() else ""
 
 class LaytimeCalculator:
-    def __init__(self, records: list[dict], deductions: list[dict]):
+    def __init__(self, records, deductions: list[dict], calendar=None):
         """
-        records:    List of {"start_time": str|float|datetime, "end_time": str|float|datetime, ...}
-        deductions: List of {"deduct": bool, "total_hours": float, ...}
+        records:    Timeline, or list of {"start_time": str|float|datetime, "end_time": ..., ...}
+        deductions: List of {"deduct": bool, "total_hours": float, ...}, one per record
+        calendar:   optional WorkingCalendar; when given only working time counts
         """
-        self.blocks = records
+        self.timeline = records if isinstance(records, Timeline) else Timeline.from_records(records)
         self.deductions = deductions
+        self.calendar = calendar
 
-    def _parse_dt(self, s) -> datetime:
-        # 1) Already a datetime? return it.
-        if isinstance(s, datetime):
-            return s
-
-        # 2) Numeric? Treat as UNIX timestamp (seconds since epoch).
-        if isinstance(s, numbers.Number):
-            try:
-                return datetime.fromtimestamp(s)
-            except (OSError, ValueError) as e:
-                raise ValueError(f"Invalid timestamp {s!r}") from e
-
-        # 3) String? Try your format, then ISO.
-        if isinstance(s, str):
-            s = s.strip()
-            if not s:
-                raise ValueError("Empty time string")
-            try:
-                return datetime.strptime(s, "%Y-%m-%d %H:%M")
-            except ValueError:
-                try:
-                    return datetime.fromisoformat(s)
-                except ValueError as e:
-                    raise ValueError(f"Couldn’t parse time string {s!r}") from e
-
-        # 4) Anything else is unrecognized.
-        raise ValueError(f"Cannot parse timestamp from {s!r}")
+    def _aligned(self) -> bool:
+        return len(self.deductions) == len(self.timeline)
+
+    def deduct_mask(self) -> np.ndarray:
+        return np.array([bool(d.get("deduct", False)) for d in self.deductions], dtype=bool)
 
     def total_block_hours(self) -> float:
-        total = 0.0
-        try:
-            st = self._parse_dt(self.blocks[0]["start_time"])
-            et = self._parse_dt(self.blocks[-1]["end_time"])
-        except:
-            st = self._parse_dt(self.blocks[0]["start_time"])
-            et = self._parse_dt(self.blocks[-1]["start_time"])
+        tl = self.timeline
+        if not len(tl):
+            return 0.0
+        # Same span as LaytimeIndex, so unsorted or overlapping rows give the same total
+        st, et = int(tl.start.min()), int(tl.effective_end().max())
+        if self.calendar is not None:
+            return self.calendar.counted_minutes(st, et) / 60.0
+        return float(et - st) / 60.0
 
-        total = (et - st).total_seconds() / 3600.0
-        return total
+    def row_minutes(self) -> np.ndarray:
+        """Counted minutes per row: calendar working time if set, else plain duration."""
+        tl = self.timeline
+        if self.calendar is not None:
+            return self.calendar.counted_minutes(tl.start, tl.effective_end())
+        return tl.durations()
 
     def total_deduction_hours(self) -> float:
+        if self._aligned():
+            # Durations straight from the integer-minute columns
+            return float(self.row_minutes()[self.deduct_mask()].sum()) / 60.0
         return sum( 
             float(d.get("total_hours"))
             for d in self.deductions
@@ -169,3 +275,14 @@ class LaytimeCalculator:
     def net_laytime_hours(self) -> float:
         return self.total_block_hours() - self.total_deduction_hours()
 
+    def laytime_index(self) -> LaytimeIndex:
+        """Cumulative counted-time index for expiry / on-demurrage queries."""
+        mask = self.deduct_mask() if self._aligned() else np.zeros(len(self.timeline), dtype=bool)
+        return LaytimeIndex(self.timeline, mask, self.calendar)
+
+    def laytime_expiry(self, allowed_hours: float):
+        """Epoch minute at which allowed laytime runs out (None if it doesn't)."""
+        return self.laytime_index().expiry(allowed_hours * 60)
+
+    def time_on_demurrage_hours(self, allowed_hours: float) -> float:
+        return self.laytime_index().time_on_demurrage(allowed_hours * 60) / 60.0
@@ -0,0 +1,89 @@
+# laytime_index.py
+
+from typing import Optional
+
+import numpy as np
+
+from event_model import Timeline
+
+
+class LaytimeIndex:
+    """
+    Cumulative counted time over a voyage timeline.
+
+    Counted time is everything between the first start and the last end,
+    minus deducted rows (and, with a calendar, minus non-working time). The
+    counted stretches are kept as sorted epoch-minute arrays with a prefix
+    sum, so "when does laytime run out" and "how much has counted by t" are
+    binary searches.
+    """
+
+    def __init__(self, timeline: Timeline, deduct_mask: np.ndarray, calendar=None):
+        self.calendar = calendar
+        ends = timeline.effective_end()
+        self.t_start = int(timeline.start.min()) if len(timeline) else 0
+        self.t_end = int(ends.max()) if len(timeline) else 0
+
+        # Merge deducted rows into non-overlapping holes
+        holes_s, holes_e = [], []
+        order = np.argsort(timeline.start[deduct_mask], kind="stable")
+        for s, e in zip(timeline.start[deduct_mask][order].tolist(), ends[deduct_mask][order].tolist()):
+            if holes_e and s <= holes_e[-1]:
+                holes_e[-1] = max(holes_e[-1], e)
+            elif e > s:
+                holes_s.append(s)
+                holes_e.append(e)
+
+        # Counted pieces are the complement of the holes within the voyage
+        piece_s, piece_e, cur = [], [], self.t_start
+        for s, e in zip(holes_s, holes_e):
+            if s > cur:
+                piece_s.append(cur)
+                piece_e.append(min(s, self.t_end))
+            cur = max(cur, e)
+        if cur < self.t_end:
+            piece_s.append(cur)
+            piece_e.append(self.t_end)
+
+        self.starts = np.array(piece_s, dtype=np.int64)
+        self.ends = np.array(piece_e, dtype=np.int64)
+        self.cum = np.concatenate([[0], np.cumsum(self._counted(self.starts, self.ends))]).astype(np.int64)
+
+    def _counted(self, t0, t1):
+        if self.calendar is not None:
+            return self.calendar.counted_minutes(t0, t1)
+        return np.maximum(np.asarray(t1) - np.asarray(t0), 0)
+
+    @property
+    def total_minutes(self) -> int:
+        return int(self.cum[-1])
+
+    def counted_until(self, t: int) -> int:
+        """Counted minutes from laytime start up to instant t."""
+        k = int(np.searchsorted(self.starts, t, side="right")) - 1
+        if k < 0:
+            return 0
+        return int(self.cum[k] + self._counted(self.starts[k], min(int(t), int(self.ends[k]))))
+
+    def expiry(self, allowed_minutes: float) -> Optional[int]:
+        """Instant the allowed laytime runs out, or None if it never does within the voyage."""
+        allowed = int(round(allowed_minutes))
+        if allowed > self.total_minutes or not len(self.starts):
+            return None
+        k = max(int(np.searchsorted(self.cum, allowed, side="left")) - 1, 0)
+        remaining = allowed - int(self.cum[k])
+        if self.calendar is not None:
+            return self.calendar.advance(self.starts[k], remaining)
+        return int(self.starts[k]) + remaining
+
+    def time_on_demurrage(self, allowed_minutes: float, t: Optional[int] = None) -> int:
+        """Counted minutes past the allowed laytime, at instant t (default: end of voyage)."""
+        used = self.total_minutes if t is None else self.counted_until(t)
+        return max(0, used - int(round(allowed_minutes)))
+
+    def after_expiry(self, timeline: Timeline, allowed_minutes: float) -> np.ndarray:
+        """Rows that start once the vessel is on demurrage."""
+        at = self.expiry(allowed_minutes)
+        if at is None:
+            return np.zeros(len(timeline), dtype=bool)
+        return timeline.start >= at
@@ -0,0 +1,373 @@
+# loadtest.py
+"""
+Concurrent-session load test for the voyage pipeline, with no live model.
+
+    # Synthetic voyages of 60-240 SoF events, 2 arrivals/s, 4 workers
+    python loadtest.py --sessions 40 --rate 2 --events 60,240 --workers 4
+
+    # Recorded voyages replayed from a cassette at their recorded latency
+    python loadtest.py --cassette month_end.cassette.gz --voyage voyages/A --voyage voyages/B --sessions 20
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import contextvars
+import tempfile
+import threading
+import tracemalloc
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from typing import Optional
+
+import numpy as np
+
+from prompt_codec import parse_events_table
+
+# ---------- CONFIG ----------
+STAGE_LATENCY = {"extraction": 6.0, "gap_fill": 12.0, "deduction": 1.5, "metadata": 2.0, "default": 1.0}  # median s of a live call
+LATENCY_SIGMA = 0.6          # lognormal spread of synthetic latencies
+TIME_SCALE = 0.05            # synthetic latencies are multiplied by this
+EVENT_SPACING_HOURS = (1, 8)
+REMARKS = [
+    ("Discharging", 0.55), ("Stopped discharging due to rain", 0.12), ("Awaiting shore tank", 0.08),
+    ("Shifting to berth", 0.05), ("Hoses connected", 0.05), ("Cargo sampling and analysis", 0.05),
+    ("Pump breakdown, discharging suspended", 0.05), ("Awaiting surveyor", 0.05),
+]
+DEDUCT_PATTERN = r"rain|await|shifting|breakdown|suspend|notice of readiness|\bNOR\b"
+PERCENTILES = (50, 95, 99)
+
+try:
+    import resource
+except ImportError:       # not on Windows
+    resource = None
+
+
+# ---------- Synthetic voyages ----------
+def minimal_pdf(note: str) -> bytes:
+    """A valid one-page blank PDF; `note` rides along in a comment so every file hashes differently."""
+    objects = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        b"<< /Type /Pages /Kids [3 0 R] /Count 1 >>",
+        b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] >>",
+    ]
+    out = b"%PDF-1.4\n%" + note.encode("ascii", "replace") + b"\n"
+    offsets = []
+    for n, body in enumerate(objects, start=1):
+        offsets.append(len(out))
+        out += f"{n} 0 obj\n".encode() + body + b"\nendobj\n"
+    xref = len(out)
+    out += f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n".encode()
+    out += b"".join(f"{o:010d} 00000 n \n".encode() for o in offsets)
+    out += f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n".encode()
+    return out
+
+
+def write_voyage(folder: str, session: int, n_events: int) -> list[tuple[str, str]]:
+    """Contract + SoF placeholders; the synthetic backend reads the spec back from the SoF."""
+    os.makedirs(folder, exist_ok=True)
+    files = []
+    for name, spec in (("contract.pdf", {"session": session}), ("sof.pdf", {"session": session, "events": n_events})):
+        path = os.path.join(folder, name)
+        with open(path, "wb") as f:
+            f.write(minimal_pdf(json.dumps(spec)))
+        files.append((name, path))
+    return files
+
+
+def read_spec(path: str) -> dict:
+    with open(path, "rb") as f:
+        f.readline()
+        try:
+            return json.loads(f.readline()[1:].decode("ascii"))
+        except ValueError:
+            return {}
+
+
+def synthetic_contract() -> dict:
+    return {
+        "document_type": "Contract",
+        "working_hours": {"Monday to Friday": "08:00 to 17:00", "Saturday": "08:00 to 12:00"},
+        "laytime_commencement": "6 hours after NOR tendered",
+        "demurrage": "12000", "despatch": "6000", "disrate": "3000", "terms": "SHEX",
+        "Quantity": "30000", "Vessel Name": "MT Loadtest", "Port": "Santos",
+        "sections": [
+            {"heading": "Laytime", "body": {"commencement": "Laytime commences 6 hours after NOR tendered."}},
+            {"heading": "Weather", "body": {"rain": "Time lost due to rain shall not count as laytime."}},
+            {"heading": "Shifting", "body": {"shifting": "Time shifting between berths shall not count."}},
+            {"heading": "Breakdown", "body": {"pumps": "Breakdown of vessel's pumps shall not count."}},
+        ],
+    }
+
+
+def synthetic_sof(n_events: int, seed: int) -> dict:
+    rng = random.Random(seed)
+    t = datetime(2024, 1, 1) + timedelta(days=rng.randrange(300), hours=rng.randrange(24))
+    remarks, weights = zip(*REMARKS)
+    events = []
+    for i in range(n_events):
+        remark = "NOR tendered" if i == 0 else "Commenced discharging" if i == 1 else rng.choices(remarks, weights)[0]
+        events.append({"Date & Time": t.strftime("%Y-%m-%d %H:%M"), "Event": remark, "Remarks": remark})
+        t += timedelta(minutes=rng.randrange(EVENT_SPACING_HOURS[0] * 60, EVENT_SPACING_HOURS[1] * 60, 15))
+    return {"document_type": "SoF", "Vessel Name": "MT Loadtest", "Port": "Santos", "Chronological Events": events}
+
+
+class SyntheticBackend:
+    """
+    Stands in for the model in gemini_client.generate (via cassette.use_player):
+    a well-formed answer for every stage after a lognormal delay around
+    STAGE_LATENCY. `error_rate` of calls fail like a live call would.
+    """
+
+    mode = "replay"
+
+    def __init__(self, time_scale: float = TIME_SCALE, error_rate: float = 0.0, seed: Optional[int] = None):
+        self.time_scale = time_scale
+        self.error_rate = error_rate
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def _draw(self, stage: str) -> tuple[float, bool]:
+        with self._lock:
+            latency = self._rng.lognormvariate(np.log(STAGE_LATENCY.get(stage, STAGE_LATENCY["default"])), LATENCY_SIGMA)
+            return latency * self.time_scale, self._rng.random() < self.error_rate
+
+    def play(self, key: str, stage: str = "default", model_name: str = "", contents=None, files=(), **_) -> dict:
+        latency, fail = self._draw(stage)
+        time.sleep(latency)
+        if fail:
+            return {"text": None, "error": f"synthetic {stage} failure", "latency_s": latency}
+        prompt = "\n".join(contents) if isinstance(contents, list) else str(contents or "")
+        return {"text": self.answer(stage, prompt, files), "error": None, "latency_s": latency}
+
+    def answer(self, stage: str, prompt: str, files) -> str:
+        if stage == "extraction" and files:
+            spec = read_spec(files[0])
+            if "events" in spec:
+                return json.dumps(synthetic_sof(spec["events"], spec.get("session", 0)))
+            return json.dumps(synthetic_contract())
+        if stage == "gap_fill":
+            # Echo the input blocks back: the shape the pipeline expects, no gaps invented
+            m = re.search(r"events_json_string:\n(.*?)```", prompt, re.DOTALL)
+            return json.dumps(parse_events_table(m.group(1)) if m else [])
+        if stage == "deduction":
+            m = re.search(r"\*\*Description:\*\* (.*)", prompt)
+            remark = m.group(1) if m else ""
+            with self._lock:
+                confidence = round(self._rng.uniform(0.6, 0.98), 2)
+            return json.dumps({
+                "Remark": remark, "Clause": "synthetic clause", "confidence_score": confidence,
+                "deduct": bool(re.search(DEDUCT_PATTERN, remark, re.IGNORECASE)),
+                "reason": "synthetic decision", "total_hours": 0.0,
+            })
+        if stage == "metadata":
+            m = re.search(r"exactly these keys \(use \"\" if not found\): (\[.*?\])", prompt)
+            return json.dumps({k: "" for k in json.loads(m.group(1))} if m else {})
+        return "{}"
+
+
+# ---------- Sessions ----------
+class QuietUI:
+    """Collects pipeline messages instead of printing them; errors count against the session."""
+
+    def __init__(self):
+        self.errors = []
+        self.warnings = []
+
+    def error(self, msg):
+        self.errors.append(str(msg))
+
+    def warning(self, msg):
+        self.warnings.append(str(msg))
+
+    def _ignore(self, *args, **kwargs):
+        pass
+
+    header = subheader = success = info = markdown = dataframe = _ignore
+
+
+def run_session(session: int, files: list[tuple[str, str]], store, arrived: float) -> dict:
+    from pipeline import run_voyage
+
+    started = time.perf_counter()
+    ui = QuietUI()
+    out = {"session": session, "queue_s": started - arrived, "ok": False, "error": None, "stages": {}, "events": 0}
+    try:
+        result = run_voyage(files, ui, store)
+        if result is None:
+            out["error"] = ui.errors[-1] if ui.errors else "no result"
+        else:
+            out["ok"] = not ui.errors
+            out["error"] = ui.errors[0] if ui.errors else None
+            out["stages"] = result["metrics"].get("stage_seconds", {})
+            out["events"] = len(result["timeline"])
+            out["degraded"] = bool(result["degraded"])
+    except Exception as e:
+        out["error"] = f"{type(e).__name__}: {e}"
+    done = time.perf_counter()
+    out["run_s"] = done - started
+    out["latency_s"] = done - arrived
+    return out
+
+
+def percentiles(values) -> dict:
+    v = np.asarray([x for x in values if x is not None], dtype=float)
+    if not v.size:
+        return {}
+    row = {f"p{q}": round(float(np.percentile(v, q)), 3) for q in PERCENTILES}
+    row["max"] = round(float(v.max()), 3)
+    return row
+
+
+def peak_rss_mb() -> Optional[float]:
+    if resource is None:
+        return None
+    kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(kb / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)   # bytes on macOS, KB on Linux
+
+
+def load_test(voyages: list, sessions: int, rate: float, workers: int, store=None, seed: Optional[int] = None,
+              trace_memory: bool = False) -> dict:
+    """
+    Open-loop load: `sessions` voyages arrive as a Poisson process at `rate`
+    per second (0 = all at once) and run on `workers` threads (0 = one per
+    session, like concurrent app users). `voyages` is a list of callables
+    session -> files. Returns the report dict.
+    """
+    from metrics import METRICS
+    import pipeline  # noqa: F401  (import cost stays out of the first sessions' latency)
+
+    METRICS.reset()
+    rng = random.Random(seed)
+    if trace_memory:
+        tracemalloc.start()
+    t0 = time.perf_counter()
+    futures = []
+    with ThreadPoolExecutor(max_workers=workers or sessions) as pool:
+        for i in range(sessions):
+            files = voyages[i % len(voyages)](i)
+            # Each session runs in a copy of this context, so it sees the cassette/player set by the caller
+            futures.append(pool.submit(contextvars.copy_context().run, run_session, i, files, store, time.perf_counter()))
+            if rate > 0 and i + 1 < sessions:
+                time.sleep(rng.expovariate(rate))
+        results = [f.result() for f in futures]
+    wall = time.perf_counter() - t0
+    traced_peak = None
+    if trace_memory:
+        traced_peak = round(tracemalloc.get_traced_memory()[1] / 2 ** 20, 1)
+        tracemalloc.stop()
+
+    failed = [r for r in results if not r["ok"]]
+    stages = sorted({s for r in results for s in r["stages"]})
+    timings = METRICS.snapshot()["timings"]
+    model_calls = {}
+    for name, t in timings.items():
+        # model.<stage>.<model>.latency_s
+        if name.startswith("model.") and name.endswith(".latency_s"):
+            stage = name.split(".")[1]
+            row = model_calls.setdefault(stage, {"calls": 0, "p50": 0.0, "p95": 0.0})
+            row["calls"] += t["count"]
+            row["p50"] = max(row["p50"], round(t["p50"], 3))
+            row["p95"] = max(row["p95"], round(t["p95"], 3))
+    return {
+        "sessions": sessions,
+        "workers": workers or sessions,
+        "arrival_rate_per_s": rate,
+        "wall_seconds": round(wall, 2),
+        "throughput_per_minute": round(len(results) / wall * 60, 2) if wall else None,
+        "events_per_second": round(sum(r["events"] for r in results) / wall, 1) if wall else None,
+        "completed": len(results) - len(failed),
+        "failed": len(failed),
+        "error_rate": round(len(failed) / len(results), 3) if results else 0.0,
+        "degraded": sum(1 for r in results if r.get("degraded")),
+        "errors": Counter(r["error"] for r in failed).most_common(5),
+        "latency_s": percentiles(r["latency_s"] for r in results),
+        "queue_s": percentiles(r["queue_s"] for r in results),
+        "stage_s": {s: percentiles(r["stages"].get(s) for r in results) for s in stages},
+        "model_calls": model_calls,
+        "peak_rss_mb": peak_rss_mb(),
+        "peak_traced_mb": traced_peak,
+    }
+
+
+def print_report(report: dict):
+    print(f"\n📊 {report['sessions']} sessions on {report['workers']} workers in {report['wall_seconds']}s "
+          f"({report['throughput_per_minute']}/min, {report['events_per_second']} events/s)")
+    print(f"   completed {report['completed']}, failed {report['failed']} "
+          f"(error rate {report['error_rate']:.1%}), degraded {report['degraded']}")
+    for label, row in [("end-to-end", report["latency_s"]), ("queue wait", report["queue_s"])]:
+        print(f"   {label:<12} " + "  ".join(f"{k} {v:.2f}s" for k, v in row.items()))
+    for stage, row in report["stage_s"].items():
+        print(f"   {stage:<12} " + "  ".join(f"{k} {v:.2f}s" for k, v in row.items()))
+    for stage, row in report["model_calls"].items():
+        print(f"   model {stage:<6} {row['calls']} calls  p50 {row['p50']:.2f}s  p95 {row['p95']:.2f}s")
+    print(f"   peak RSS {report['peak_rss_mb']} MB" + (f", traced peak {report['peak_traced_mb']} MB" if report["peak_traced_mb"] else ""))
+    for error, n in report["errors"]:
+        print(f"   ❌ {n}× {error}")
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="Drive concurrent voyage sessions through the pipeline without a live model.")
+    ap.add_argument("--sessions", type=int, default=20)
+    ap.add_argument("--rate", type=float, default=1.0, help="arrivals per second (Poisson); 0 = all at once")
+    ap.add_argument("--workers", type=int, default=0, help="concurrent sessions; 0 = no limit")
+    ap.add_argument("--events", default="80", help="SoF events per synthetic voyage: N or MIN,MAX")
+    ap.add_argument("--time-scale", type=float, default=TIME_SCALE, help="multiplier on synthetic model latency")
+    ap.add_argument("--error-rate", type=float, default=0.0, help="share of synthetic model calls that fail")
+    ap.add_argument("--cassette", help="replay recorded voyages instead of synthetic ones")
+    ap.add_argument("--voyage", action="append", default=[], help="voyage folder recorded in --cassette (repeatable)")
+    ap.add_argument("--no-store", action="store_true", help="run without the SQLite store")
+    ap.add_argument("--trace-memory", action="store_true", help="also report the tracemalloc peak (slower)")
+    ap.add_argument("--seed", type=int, default=None)
+    ap.add_argument("--json", help="write the report to this file")
+    args = ap.parse_args(argv)
+
+    work = tempfile.mkdtemp(prefix="laytime_load_")
+    os.environ.setdefault("LAYTIME_CHECKPOINTS", os.path.join(work, "checkpoints"))
+
+    try:
+        from cassette import use_cassette, use_player
+        from store import VoyageStore
+
+        if args.cassette:
+            if not args.voyage:
+                ap.error("--cassette needs at least one --voyage folder")
+            folders = [
+                [(name, os.path.join(folder, name)) for name in sorted(os.listdir(folder)) if name.lower().endswith((".pdf", ".docx"))]
+                for folder in args.voyage
+            ]
+            voyages = [lambda i, files=files: files for files in folders]
+            backend = use_cassette(args.cassette, mode="replay", replay_latency=True)
+        else:
+            lo, _, hi = args.events.partition(",")
+            lo, hi = int(lo), int(hi or lo)
+            sizes = random.Random(args.seed)
+            voyages = [lambda i: write_voyage(os.path.join(work, f"voyage_{i:04d}"), i, sizes.randint(lo, hi))]
+            backend = use_player(SyntheticBackend(args.time_scale, args.error_rate, args.seed))
+
+        store = None if args.no_store else VoyageStore(os.path.join(work, "loadtest.db"))
+        try:
+            with backend:
+                report = load_test(voyages, args.sessions, args.rate, args.workers, store, args.seed, args.trace_memory)
+        finally:
+            if store is not None:
+                store.close()
+    finally:
+        # Synthetic voyages, checkpoints and the store are only for this run
+        shutil.rmtree(work, ignore_errors=True)
+
+    print_report(report)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+    return report
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+# metrics.py
+
+import time
+import threading
+from collections import defaultdict, deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Optional
+
+import numpy as np
+
+# ---------- CONFIG ----------
+TIMING_SAMPLES = 2000            # most recent samples kept per timing for the percentiles
+
+_run: ContextVar[Optional["Metrics"]] = ContextVar("laytime_run_metrics", default=None)
+
+
+class Metrics:
+    """
+    Process-wide counters and timings, safe to update from worker threads.
+    Timings keep a running count/sum/max and a bounded window of recent
+    samples for percentiles, so a long-running service doesn't grow them.
+    A `scoped` instance also records into the current run's collector
+    (see run_metrics), so one run's figures aren't mixed with another's.
+    """
+
+    def __init__(self, scoped: bool = False):
+        self.scoped = scoped
+        self._lock = threading.Lock()
+        self.counters = defaultdict(float)
+        self.timings = defaultdict(lambda: deque(maxlen=TIMING_SAMPLES))
+        self.totals = defaultdict(lambda: [0, 0.0, float("-inf")])      # count, sum, max
+
+    def incr(self, name: str, n: float = 1):
+        with self._lock:
+            self.counters[name] += n
+        run = _run.get() if self.scoped else None
+        if run is not None:
+            run.incr(name, n)
+
+    def observe(self, name: str, value: float):
+        with self._lock:
+            value = float(value)
+            self.timings[name].append(value)
+            total = self.totals[name]
+            total[0] += 1
+            total[1] += value
+            total[2] = max(total[2], value)
+        run = _run.get() if self.scoped else None
+        if run is not None:
+            run.observe(name, value)
+
+    def counter(self, name: str) -> float:
+        with self._lock:
+            return self.counters.get(name, 0)
+
+    def counters_with_prefix(self, prefix: str) -> dict:
+        with self._lock:
+            return {k: v for k, v in self.counters.items() if k.startswith(prefix)}
+
+    def snapshot(self) -> dict:
+        """Counters as-is; timings as count / mean / max over all samples, p50 / p95 over the recent window."""
+        with self._lock:
+            counters = dict(self.counters)
+            timings = {k: (np.asarray(v), list(self.totals[k])) for k, v in self.timings.items() if v}
+        return {
+            "counters": counters,
+            "timings": {
+                k: {
+                    "count": int(count),
+                    "mean": float(total / count),
+                    "p50": float(np.percentile(v, 50)),
+                    "p95": float(np.percentile(v, 95)),
+                    "max": float(peak),
+                }
+                for k, (v, (count, total, peak)) in timings.items()
+            },
+        }
+
+    def reset(self):
+        with self._lock:
+            self.counters.clear()
+            self.timings.clear()
+            self.totals.clear()
+
+
+METRICS = Metrics(scoped=True)
+
+
+def current_run_metrics() -> Optional[Metrics]:
+    return _run.get()
+
+
+@contextmanager
+def run_metrics(collector: Optional[Metrics] = None):
+    """Collect what METRICS records in this context (one pipeline run) into `collector` as well."""
+    collector = collector if collector is not None else Metrics()
+    token = _run.set(collector)
+    try:
+        yield collector
+    finally:
+        _run.reset(token)
+
+
+class StageClock:
+    """Wall time per pipeline stage: call lap(stage) as each stage finishes."""
+
+    def __init__(self, prefix: str = "stage"):
+        self.prefix = prefix
+        self.seconds = {}
+        self._last = time.perf_counter()
+
+    def lap(self, stage: str) -> float:
+        now = time.perf_counter()
+        elapsed, self._last = now - self._last, now
+        self.seconds[stage] = self.seconds.get(stage, 0.0) + elapsed
+        METRICS.observe(f"{self.prefix}.{stage}.seconds", elapsed)
+        return elapsed
@@ -0,0 +1,305 @@
+# pdf_prep.py
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import threading
+import multiprocessing
+from collections import Counter
+from concurrent.futures import Future, ProcessPoolExecutor, wait
+from typing import Optional
+
+import numpy as np
+
+from metrics import METRICS
+
+# ---------- CONFIG ----------
+PREP_DPI = int(os.getenv("LAYTIME_PREP_DPI", "150"))            # scanned pages are resampled to this
+JPEG_QUALITY = int(os.getenv("LAYTIME_PREP_JPEG_QUALITY", "60"))
+MIN_PREP_BYTES = 2 * 1024 * 1024      # smaller uploads go as they are
+DPI_SLACK = 1.25                      # only resample images above PREP_DPI * this
+BLANK_CHECK_DPI = 24                  # thumbnail resolution for the blank-page test
+BLANK_INK_SHARE = 0.002               # a page with less dark pixels than this (and no text) is blank
+INK_LEVEL = 200                       # grey level (0-255) below which a pixel counts as ink
+SCAN_COVERAGE = 0.8                   # an image over this share of the page makes it a scanned page
+MIN_GAIN = 0.05                       # keep the original unless the output is this much smaller
+PREP_WORKERS = int(os.getenv("LAYTIME_PREP_WORKERS", str(max(min(os.cpu_count() or 1, 4), 1))))
+TASKS_PER_WORKER = 20                 # recycle worker processes so image buffers can't pile up
+UPLOAD_BYTES_PER_SECOND = float(os.getenv("LAYTIME_UPLOAD_MBPS", "20")) * 1e6 / 8   # for the time-saved estimate
+
+
+def backend() -> Optional[str]:
+    """The PDF library pre-processing can use: pymupdf (full), pypdf (blank pages, compression) or None."""
+    try:
+        import fitz  # noqa: F401  (pymupdf)
+        return "pymupdf"
+    except ImportError:
+        pass
+    try:
+        import pypdf  # noqa: F401
+        return "pypdf"
+    except ImportError:
+        return None
+
+
+def _ink_share(gray: np.ndarray) -> float:
+    return float((gray < INK_LEVEL).mean()) if gray.size else 0.0
+
+
+# ---------- pymupdf ----------
+def _prep_pymupdf(src: str, dst: str) -> dict:
+    import fitz
+
+    stats = {"pages": 0, "blank_pages": 0, "downsampled_pages": 0}
+    with fitz.open(src) as doc, fitz.open() as out:
+        stats["pages"] = len(doc)
+        for i, page in enumerate(doc):
+            text = page.get_text().strip()
+            thumb = page.get_pixmap(dpi=BLANK_CHECK_DPI, colorspace=fitz.csGRAY)
+            gray = np.frombuffer(thumb.samples, dtype=np.uint8)
+            if not text and _ink_share(gray) < BLANK_INK_SHARE:
+                stats["blank_pages"] += 1
+                continue
+
+            # A scan is a page mostly covered by an image; its resolution is pixel width over placed width
+            dpi, coverage = 0.0, 0.0
+            for info in page.get_image_info():
+                box = fitz.Rect(info["bbox"]) & page.rect
+                if box.width > 0:
+                    dpi = max(dpi, info["width"] / (box.width / 72.0))
+                    coverage = max(coverage, box.get_area() / max(page.rect.get_area(), 1.0))
+            if dpi > PREP_DPI * DPI_SLACK and coverage >= SCAN_COVERAGE:
+                # One JPEG of the page at PREP_DPI replaces the high-resolution image(s) and any OCR layer
+                pix = page.get_pixmap(dpi=PREP_DPI)
+                new = out.new_page(width=page.rect.width, height=page.rect.height)
+                new.insert_image(new.rect, stream=pix.tobytes("jpeg", jpg_quality=JPEG_QUALITY))
+                stats["downsampled_pages"] += 1
+                pix = None
+            else:
+                out.insert_pdf(doc, from_page=i, to_page=i)
+        if stats["blank_pages"] == stats["pages"]:
+            raise ValueError("every page looks blank")
+        out.save(dst, garbage=4, deflate=True, deflate_images=True)
+    return stats
+
+
+# ---------- pypdf (+ Pillow when installed) ----------
+def _prep_pypdf(src: str, dst: str) -> dict:
+    from pypdf import PdfReader, PdfWriter
+
+    try:
+        from PIL import Image
+    except ImportError:
+        Image = None
+
+    stats = {"pages": 0, "blank_pages": 0, "downsampled_pages": 0}
+    reader = PdfReader(src)
+    writer = PdfWriter()
+    stats["pages"] = len(reader.pages)
+    for page in reader.pages:
+        if not (page.extract_text() or "").strip():
+            contents = page.get_contents()
+            image_count = len(page.images)
+            if image_count == 0 and (contents is None or len(contents.get_data().strip()) < 16):
+                stats["blank_pages"] += 1
+                continue
+            # A blank scan: one image with (almost) no ink
+            if Image is not None and image_count == 1:
+                thumb = page.images[0].image.convert("L")
+                thumb.thumbnail((200, 200))
+                if _ink_share(np.asarray(thumb)) < BLANK_INK_SHARE:
+                    stats["blank_pages"] += 1
+                    continue
+
+        added = writer.add_page(page)
+        page_width_in = float(added.mediabox.width) / 72.0
+        resampled = False
+        for img in (added.images if Image is not None else []):
+            # Scans fill the page, so pixel width over page width is their resolution
+            picture = img.image
+            dpi = picture.width / page_width_in if page_width_in > 0 else 0
+            if dpi > PREP_DPI * DPI_SLACK:
+                scale = PREP_DPI / dpi
+                picture = picture.convert("RGB" if picture.mode not in ("L", "1") else "L")
+                img.replace(picture.resize((max(int(picture.width * scale), 1), max(int(picture.height * scale), 1))),
+                            quality=JPEG_QUALITY)
+                resampled = True
+        stats["downsampled_pages"] += resampled
+        added.compress_content_streams()
+    if stats["blank_pages"] == stats["pages"]:
+        raise ValueError("every page looks blank")
+    writer.compress_identical_objects(remove_identicals=True, remove_orphans=True)
+    with open(dst, "wb") as f:
+        writer.write(f)
+    return stats
+
+
+def preprocess_pdf(src: str, out_dir: str) -> dict:
+    """
+    Shrink one PDF before upload: drop blank pages, resample scanned pages to
+    PREP_DPI and recompress. Runs in a worker process. Returns
+    {"path", "original_bytes", "bytes", "pages", "blank_pages",
+    "downsampled_pages", "seconds", "backend", "skipped"}; "path" is the
+    original when there was nothing to gain or anything went wrong.
+    """
+    t0 = time.perf_counter()
+    size = os.path.getsize(src)
+    result = {
+        "path": src, "original_bytes": size, "bytes": size, "pages": None, "blank_pages": 0,
+        "downsampled_pages": 0, "seconds": 0.0, "backend": backend(), "skipped": None,
+    }
+    dst = os.path.join(out_dir, f"{os.getpid()}-{os.path.basename(src)}")
+    try:
+        if result["backend"] == "pymupdf":
+            stats = _prep_pymupdf(src, dst)
+        else:
+            stats = _prep_pypdf(src, dst)
+        result.update(stats)
+        new_size = os.path.getsize(dst)
+        if new_size <= size * (1 - MIN_GAIN) or stats["blank_pages"]:
+            result.update(path=dst, bytes=new_size)
+        else:
+            result["skipped"] = "no gain"
+            os.remove(dst)
+    except Exception as e:
+        result["skipped"] = f"failed: {e}"
+        if os.path.exists(dst):
+            os.remove(dst)
+    result["seconds"] = round(time.perf_counter() - t0, 3)
+    return result
+
+
+# ---------- Pool ----------
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def _get_pool() -> ProcessPoolExecutor:
+    """One process pool for the whole server, so concurrent sessions share PREP_WORKERS processes."""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            # spawn, not fork: the parent has model-call threads running
+            options = {"max_tasks_per_child": TASKS_PER_WORKER} if sys.version_info >= (3, 11) else {}
+            _pool = ProcessPoolExecutor(
+                max_workers=PREP_WORKERS, mp_context=multiprocessing.get_context("spawn"), **options
+            )
+        return _pool
+
+
+def _skip(path: str, reason: str) -> Future:
+    size = os.path.getsize(path)
+    future = Future()
+    future.set_result({
+        "path": path, "original_bytes": size, "bytes": size, "pages": None, "blank_pages": 0,
+        "downsampled_pages": 0, "seconds": 0.0, "backend": None, "skipped": reason,
+    })
+    return future
+
+
+def start_preprocessing(paths: list[str], out_dir: str) -> dict:
+    """Submit each large PDF to the process pool; returns {path: Future} (small or non-PDF files resolve at once)."""
+    pending = {}
+    for path in paths:
+        if not path.lower().endswith(".pdf"):
+            pending[path] = _skip(path, "not a PDF")
+        elif os.path.getsize(path) < MIN_PREP_BYTES:
+            pending[path] = _skip(path, "small")
+        elif backend() is None:
+            pending[path] = _skip(path, "no PDF library")
+        else:
+            pending[path] = _get_pool().submit(preprocess_pdf, path, out_dir)
+    return pending
+
+
+def finish_preprocessing(pending: dict, path: str) -> dict:
+    """The pre-processing result for `path` (waits for it), with its savings recorded."""
+    try:
+        result = pending[path].result()
+    except Exception as e:
+        # A crashed worker costs nothing but the saving
+        result = _skip(path, f"failed: {e}").result()
+    saved = result["original_bytes"] - result["bytes"]
+    result["upload_seconds_saved"] = round(saved / UPLOAD_BYTES_PER_SECOND, 2)
+    if result["skipped"] is None:
+        METRICS.incr("prep.documents")
+        METRICS.incr("prep.bytes_in", result["original_bytes"])
+        METRICS.incr("prep.bytes_out", result["bytes"])
+        METRICS.incr("prep.blank_pages", result["blank_pages"])
+        METRICS.observe("prep.seconds", result["seconds"])
+    return result
+
+
+def stop_preprocessing(pending: dict):
+    """Cancel queued pre-processing and wait for any already running, so its output dir can be removed."""
+    for future in pending.values():
+        future.cancel()
+    wait(list(pending.values()))
+
+
+def describe(result: dict) -> str:
+    mb = 1024 * 1024
+    parts = []
+    if result["blank_pages"]:
+        parts.append(f"{result['blank_pages']} blank pages dropped")
+    if result["downsampled_pages"]:
+        parts.append(f"{result['downsampled_pages']} scanned pages at {PREP_DPI} DPI")
+    return (
+        f"{result['original_bytes'] / mb:.1f} MB → {result['bytes'] / mb:.1f} MB"
+        + (f" ({', '.join(parts)})" if parts else "")
+        + f" in {result['seconds']:.1f}s, ~{result['upload_seconds_saved']:.1f}s less upload"
+    )
+
+
+# ---------- Accuracy check ----------
+def compare_extraction(paths: list[str]) -> list[dict]:
+    """
+    Extract each sample PDF as uploaded and after pre-processing, and report
+    size saved and how many extracted events agree (same start time and
+    remark). Makes two model calls per document.
+    """
+    from extractor import extract_with_gemini
+    from pipeline import build_event_blocks, events_from_document
+    from revision import row_keys
+
+    out_dir = tempfile.mkdtemp(prefix="laytime_prep_")
+    pending = {}
+    try:
+        pending = start_preprocessing(paths, out_dir)
+        report = []
+        for path in paths:
+            prep = finish_preprocessing(pending, path)
+            row = {"file": os.path.basename(path), "original_bytes": prep["original_bytes"], "bytes": prep["bytes"],
+                   "skipped": prep["skipped"]}
+            if prep["path"] != path:
+                keys = []
+                for p in (path, prep["path"]):
+                    data, _ = extract_with_gemini(p)
+                    blocks = build_event_blocks(events_from_document(data))
+                    keys.append(Counter((start, remark) for start, _, remark in row_keys(blocks)))
+                matched = sum((keys[0] & keys[1]).values())
+                total = max(sum(keys[0].values()), 1)
+                row.update(events_original=sum(keys[0].values()), events_prepped=sum(keys[1].values()),
+                           agreement=round(matched / total, 3))
+            report.append(row)
+        return report
+    finally:
+        stop_preprocessing(pending)
+        shutil.rmtree(out_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    # python pdf_prep.py scan1.pdf scan2.pdf [--compare]
+    args = [a for a in sys.argv[1:] if not a.startswith("--")]
+    if "--compare" in sys.argv:
+        for row in compare_extraction(args):
+            print(f"📄 {row}")
+    else:
+        tmp = tempfile.mkdtemp(prefix="laytime_prep_")
+        pending = start_preprocessing(args, tmp)
+        for path in args:
+            result = finish_preprocessing(pending, path)
+            print(f"🗜️ {os.path.basename(path)}: {result['skipped'] or describe(result)}")
+        print(f"Output in {tmp}")
@@ -0,0 +1,911 @@
+# pipeline.py
+
+import os
+import re
+import sys
+import json
+import shutil
+import hashlib
+import tempfile
+import contextvars
+from concurrent.futures import ThreadPoolExecutor, wait
+from datetime import datetime
+from typing import Optional
+
+from extractor import extract_with_gemini, extract_contract_fields, read_pdf_text
+from chronological_event import chronological_events
+from deduction_engine import ERROR_CLAUSE, analyze_event_against_clauses, rule_based_decision
+from deduction_model import learned_decision, load_classifier
+from laytime_agent import extract_metadata_from_docs, resolve_metadata_locally
+from laytime_agent import LaytimeCalculator
+from excel_exporter import generate_excel_from_extracted_data, laytime_allowed_days
+from event_model import Event, Timeline, format_minutes, parse_minutes, to_minutes
+from calendar_engine import WorkingCalendar, holiday_days
+from template_cache import TemplateRegistry
+from gemini_client import cascade_report
+from hedging import HEDGER
+from metrics import METRICS, Metrics, StageClock, run_metrics
+from revision import DAY, MAX_DIRTY_SHARE, dirty_days, rows_on_days, stitch, reusable_decisions
+from deadlines import POLL_SECONDS, BudgetError, BudgetExhausted, Cancelled, RunBudget, current_budget, run_budget
+from doc_classifier import classify_document
+from event_merge import merge_streams
+from pumping import analyze_pumping, describe_evidence, pumping_decision, pumping_records, row_evidence, unreported_stoppages
+from gap_windows import GAP_FILL_WORKERS, WINDOW_DAYS, owned, plan_windows, stitch_windows
+from prompt_codec import estimate_tokens, events_table, record_savings, token_budget, token_report
+from pdf_prep import describe as describe_prep, finish_preprocessing, start_preprocessing, stop_preprocessing
+from checkpoint import NO_CHECKPOINTS, Checkpoints, input_key, timeline_from_json, timeline_to_json
+
+REQUIRED_DOCUMENTS = ["Contract", "SoF"]
+OPTIONAL_DOCUMENTS = ["LoP", "NOR", "PumpingLog"]
+ALL_EXPECTED = REQUIRED_DOCUMENTS + OPTIONAL_DOCUMENTS
+
+
+class ConsoleUI:
+    """Stand-in for the `st` module when the pipeline runs outside Streamlit (batch runs)."""
+
+    def __init__(self, verbose: bool = False):
+        self.verbose = verbose
+
+    def _say(self, msg):
+        print(msg)
+
+    header = subheader = success = info = warning = error = _say
+
+    def markdown(self, msg):
+        if self.verbose:
+            print(msg)
+
+    def dataframe(self, data):
+        if self.verbose:
+            print(f"[{len(data)} rows]")
+
+
+def file_hash(path: str, chunk_size: int = 1 << 20) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def extract_nor_delay_hours(clause_text: str) -> int:
+    """
+    Parse “<N> hours after” from the NOR clause text.
+    """
+    pattern = r'(\d+)(?:\s*\([^)]*\))?\s*hours?(\s+after|later)?'
+    m = re.search(pattern, clause_text, re.IGNORECASE)
+    return int(m.group(1)) if m else 0
+
+NOR_PATTERN = r'\bNOR tendered\b|\bNotice of Readiness tendered\b'
+COMMENCE_PATTERN = 'commenced discharging'
+
+def split_nor_period(tl: Timeline, laytime_commencement: str) -> Timeline:
+    d = tl.sorted()
+    if not len(d):
+        return d
+
+    # no event_phase labels → look in 'reason' instead
+    field = "phase" if d.has_phase else "reason"
+
+    mask_nor = d.matches(NOR_PATTERN, field)
+    if mask_nor.any():
+        nor_tender = int(d.start[mask_nor].min())
+    else:
+        # fallback to first timestamp if no explicit NOR found
+        nor_tender = int(d.start[0])
+
+    delay_h      = extract_nor_delay_hours(laytime_commencement)
+    default_cut  = nor_tender + delay_h * 60
+
+    # —— new: see if any "Commenced Discharging" happens earlier
+    mask_commence = d.matches(COMMENCE_PATTERN, field)
+    if mask_commence.any():
+        first_commence = int(d.start[mask_commence].min())
+        # pick the earlier of (NOR+delay) vs first commencement
+        laytime_start = min(default_cut, first_commence)
+    else:
+        laytime_start = default_cut
+
+    # synthetic NOR row now spans from tender → actual laytime_start
+    nor_row = Event(
+        nor_tender,
+        laytime_start,
+        f'Notice of Readiness period ({delay_h} h)',
+        'NOR' if d.has_phase else '',
+    )
+
+    # clip any row that straddles the new laytime_start
+    start = d.start.copy()
+    start[(start < laytime_start) & (d.end > laytime_start)] = laytime_start
+    d.start = start
+
+    # drop everything before laytime_start, then prepend the NOR row
+    d_after = d[start >= laytime_start]
+    return Timeline.concat([Timeline.from_events([nor_row]), d_after])
+
+
+def build_event_blocks(events: list[dict], source: str = "") -> Timeline:
+    """
+    Turn the raw document events into a Timeline. Split-field rows keep their
+    own start/end; timestamp-only rows are paired with the next timestamp.
+    `source` tags every row with the document it came from.
+    """
+    out = []
+    for idx, e in enumerate(events):
+        # Case A: split-fields event
+        if e.get("date") and (e.get("start_time") or e.get("time")):
+            # parse with dayfirst=True for “DD/MM/YYYY”
+            try:
+                start = parse_minutes(e.get("start_time") or e.get("time"), e["date"])
+                end   = parse_minutes(e.get("end_time"), e["date"])
+            except (ValueError, OverflowError):
+                continue
+            out.append(Event(start, end, e.get("Remarks") or e.get("remarks") or "", e.get("Event", ""), source))
+
+        # Case B: timestamped events to be paired
+        elif e.get("timestamp") and idx + 1 < len(events) and events[idx+1].get("timestamp"):
+            out.append(Event(
+                to_minutes(e["timestamp"]),
+                to_minutes(events[idx+1]["timestamp"]),
+                e.get("remarks") or "",
+                e.get("event") or "",
+                source,
+            ))
+
+    return Timeline.from_events(out)
+
+
+def clause_texts_from_contract(structured_data: dict) -> list[str]:
+    """Flatten the contract sections into "key: text" clause strings."""
+    clause_texts = []
+    raw_secs = (
+        structured_data.get("Sections")
+        or structured_data.get("sections")
+        or structured_data.get("Agreement", {}).get("sections", [])
+    )
+
+    if isinstance(raw_secs, dict):
+        sections = [
+            {"heading": sec_title, "body": sec_body} for sec_title, sec_body in raw_secs.items()
+        ]
+    else:
+        sections = raw_secs
+
+    for section in sections:
+
+        heading = section.get("heading", "") or section.get("title", "")
+        body    = section.get("body", {}) or section.get("content", "")
+
+        norm_heading = re.sub(r'[^a-zA-Z0-9]+', '_', heading.lower()).strip('_')
+
+        if isinstance(body, dict):
+            for key, val in body.items():
+                # normalize sub-key
+                entry_key = re.sub(r'[^a-zA-Z0-9]+', '_', key.lower()).strip('_')
+
+                # append each subclause as a separate dict-string
+                if isinstance(val, dict):
+                    clause_texts.append(f"{entry_key}: {val}")
+                elif isinstance(val, list):
+                    for item in val:
+                        clause_texts.append(f"{entry_key}: {item}")
+                else:
+                    clause_texts.append(f"{entry_key}: {val}")
+        elif isinstance(body, list):
+            # body is a list of items
+            for idx, item in enumerate(body, start=1):
+                entry_key = f"{idx}"
+                clause_texts.append(f"{entry_key}: {item}")
+        else:
+            # single non-dict, non-list value
+            clause_texts.append(f"{norm_heading}: {body}")
+    return clause_texts
+
+
+def events_from_document(structured_data: dict) -> list[dict]:
+    """Collect chronological events from an SoF/LoP/NOR/PumpingLog extraction."""
+    all_events = []
+    events = (
+        structured_data.get("Chronological Events", [])
+        or structured_data.get("chronological_events", [])
+        or structured_data.get("events", [])     # LoP extraction shape
+        # PumpingLog: rows with a comment are events; bare readings are only for analyze_pumping
+        or [r for r in pumping_records(structured_data) if r.get("Remarks") or r.get("remarks")]
+    )
+    for e in events:
+        if e.get("Date & Time"):
+            try:
+                ts = datetime.strptime(e.get("Date & Time"), "%Y-%m-%d %H:%M")
+                all_events.append({
+                    "timestamp": ts,
+                    "event": e.get("Event"),
+                    "remarks": e.get("Remarks") or e.get("remarks")
+                })
+            except:
+                pass
+            continue
+
+        # Case 2: split fields (date, day, start_time, end_time)
+        elif e.get("Date") or e.get("date"):
+            date_val   = e.get("Date") or e.get("date")
+            day_val    = e.get("Day")  or e.get("day")
+            start_val  = e.get("start_time") or e.get("Start_Time")
+            end_val    = e.get("end_time")   or e.get("End_Time")
+            remarks_val= e.get("Remarks")    or e.get("remarks")
+
+            ev = {
+                "date":       date_val,
+                "day":        day_val,
+                "start_time": start_val,
+                "end_time":   end_val,
+                "remarks":    remarks_val
+            }
+
+        else:
+            # neither format recognized
+            continue
+
+        all_events.append(ev)
+    return all_events
+
+
+def sort_by_timestamp(events: list[dict]) -> list[dict]:
+    """Events with a datetime timestamp in time order; the others keep their positions."""
+    slots = [i for i, ev in enumerate(events) if isinstance(ev.get("timestamp"), datetime)]
+    dated = sorted((events[i] for i in slots), key=lambda x: x["timestamp"])
+    out = list(events)
+    for i, ev in zip(slots, dated):
+        out[i] = ev
+    return out
+
+
+def reuse_decision(decision: dict, event: Event, origin: str) -> dict:
+    """A cached deduction decision re-stamped with this event's date and times; `origin` says where it came from."""
+    record = event.to_record()
+    return {
+        **decision,
+        "Date": record["date"],
+        "Day": record["day"],
+        "Remark": event.reason or event.phase or decision.get("Remark"),
+        "deducted_from": format_minutes(event.start, "%H:%M"),
+        "deducted_to": format_minutes(event.end, "%H:%M"),
+        "total_hours": round(event.duration / 60.0, 4),
+        "cached": True,
+        "origin": origin,
+    }
+
+
+def extract_from_template(file_name: str, contract_text: str, templates: TemplateRegistry, ui):
+    """
+    If the PDF text matches a known charter-party form, re-extract only the
+    voyage-specific fields and reuse everything else. Returns (structured_data,
+    template) or (None, None) when there is no usable match.
+    """
+    template = templates.match_text(contract_text)
+    if template is None:
+        return None, None
+    fields, _ = extract_contract_fields(contract_text)
+    if "error" in fields:
+        ui.warning(f"⚠️ Field extraction failed for {file_name}, running full extraction: {fields['error']}")
+        return None, None
+    ui.info(f"♻️ {file_name} matches a known charter-party form ({template['similarity']:.0%}); reusing its clauses.")
+    structured_data = {
+        **template["contract"],
+        **{k: v for k, v in fields.items() if v not in (None, "", {})},
+        "document_type": "Contract",
+    }
+    return structured_data, template
+
+
+def extract_documents(files: list[tuple[str, str]], ui, templates: TemplateRegistry = None, store=None,
+                      checkpoints: Checkpoints = NO_CHECKPOINTS, hashes: dict = None) -> dict:
+    """
+    Run Gemini extraction on each (file_name, path) and sort the results into
+    contract clauses, contract metadata and chronological events. Files the
+    store has already seen (same hash) reuse their stored extraction, and
+    full extractions of an interrupted run are picked up from `checkpoints`.
+    Files that do go to the model are shrunk first (pdf_prep), in parallel.
+    """
+    doc_types = []
+    clause_texts = []
+    metadata = {}
+    extracted_data = {}
+    documents = []
+    event_streams = []
+    template_id = None
+
+    # Extractions already stored or checkpointed; the rest are pre-processed in parallel meanwhile
+    known = {}
+    for file_name, path in files:
+        doc_hash = (hashes or {}).get(path) or file_hash(path)
+        structured_data = store.document(doc_hash) if store is not None else None
+        if structured_data is not None:
+            ui.info(f"♻️ {file_name} is unchanged since a previous run; reusing its extraction.")
+        else:
+            structured_data = checkpoints.load("extraction", doc_hash)
+            if structured_data is not None:
+                ui.info(f"⏯️ {file_name}: resuming from its checkpointed extraction.")
+        known[path] = (doc_hash, structured_data)
+    prep_dir = tempfile.mkdtemp(prefix="laytime_prep_")
+    pending = start_preprocessing([path for path, (_, data) in known.items() if data is None], prep_dir)
+
+    try:
+        for file_name, path in files:
+            template = None
+            doc_hash, structured_data = known[path]
+            prep = None
+
+            # Local guess at the type: picks the prompt, and non-contracts skip the template lookup
+            guess = classify_document(file_name, read_pdf_text(path, max_pages=1)) if structured_data is None else None
+            maybe_contract = guess is None or guess["doc_type"] in (None, "Contract")
+
+            contract_text = read_pdf_text(path) if templates is not None and maybe_contract else ""
+            if structured_data is None and contract_text:
+                structured_data, template = extract_from_template(file_name, contract_text, templates, ui)
+
+            # Run Gemini extraction
+            if structured_data is None:
+                if guess["doc_type"]:
+                    ui.markdown(f"🏷️ {file_name} looks like a {guess['doc_type']} (score {guess['score']:g}); using its extraction prompt.")
+                try:
+                    # Blank pages dropped and scans resampled before upload
+                    prep = finish_preprocessing(pending, path)
+                    if prep["skipped"] is None:
+                        ui.info(f"🗜️ {file_name}: {describe_prep(prep)}")
+                    structured_data, _ = extract_with_gemini(prep["path"], guess["doc_type"])
+
+                    if "error" in structured_data:
+                        ui.error(f"❌ Gemini extraction failed for {file_name}: {structured_data['error']}")
+                        continue
+                    # Template matches are cheap to redo; only full extractions are checkpointed
+                    checkpoints.save("extraction", doc_hash, structured_data)
+
+                except BudgetError:
+                    raise
+                except Exception as e:
+                    ui.error(f"❌ Failed to extract from {file_name}: {str(e)}")
+                    continue
+
+            doc_type = structured_data.get("document_type")
+
+            # Fallback: infer doc_type from filename
+            if not doc_type:
+                doc_type = next((d for d in ALL_EXPECTED if d.lower() in file_name.lower()), None)
+
+            if not doc_type or doc_type not in ALL_EXPECTED:
+                ui.warning(f"⚠️ Skipping unknown or invalid document type for file: {file_name}")
+                continue
+
+            doc_types.append(doc_type)
+            extracted_data[doc_type] = structured_data
+            documents.append({
+                "hash": doc_hash,
+                "file_name": file_name,
+                "size": os.path.getsize(path),
+                "doc_type": doc_type,
+                "data": structured_data,
+                "prep": None if prep is None else {k: v for k, v in prep.items() if k != "path"},
+            })
+            ui.markdown(f"**doctype**: {doc_type}")
+            ui.markdown(f"Struc : {structured_data}")
+            if str(doc_type).strip().lower() == "contract":
+                metadata["LTC AT"] = structured_data.get("laytime_commencement")
+                metadata["DEMMURAGE"] = structured_data.get("demurrage")
+                metadata["DESPATCH"] = structured_data.get("despatch")
+                metadata["DISRATE"] = structured_data.get("disrate")
+                metadata["TERMS"] = structured_data.get("terms")
+                if template is not None:
+                    clause_texts.extend(template["clause_texts"])
+                    template_id = template["id"]
+                else:
+                    contract_clauses = clause_texts_from_contract(structured_data)
+                    clause_texts.extend(contract_clauses)
+                    if templates is not None and contract_clauses:
+                        # Keep only the form itself; header scalars change per voyage
+                        form = {k: v for k, v in structured_data.items() if isinstance(v, (dict, list))}
+                        template_id = templates.register(contract_clauses, form, contract_text)
+
+            # SoF and others: each document's chronological events are one stream
+            else:
+                events = sort_by_timestamp(events_from_document(structured_data))
+                event_streams.append((doc_type, events))
+
+    finally:
+        # Running workers may still be writing into prep_dir
+        stop_preprocessing(pending)
+        shutil.rmtree(prep_dir, ignore_errors=True)
+
+    return {
+        "doc_types": doc_types,
+        "clause_texts": clause_texts,
+        "metadata": metadata,
+        "extracted_data": extracted_data,
+        "documents": documents,
+        "event_streams": event_streams,
+        "template_id": template_id,
+    }
+
+
+def gap_fill_input(tl: Timeline) -> str:
+    """The events for the gap-fill prompt as a per-date table; the saving over indented JSON is logged."""
+    table = events_table(tl)
+    record_savings("gap_fill", json.dumps(tl.to_records(), indent=2), table)
+    return table
+
+
+def _fill_window(tl: Timeline, calendar, checkpoints: Checkpoints = NO_CHECKPOINTS) -> Timeline:
+    """Gap-fill one window of rows with a single model call (runs on a worker thread; no ui calls)."""
+    key = input_key(timeline_to_json(tl), calendar.describe(), sorted(calendar.holidays), calendar.exclude_sundays)
+    saved = checkpoints.load("gap_fill_window", key)
+    if saved is not None:
+        return timeline_from_json(saved)
+    final_records, _ = chronological_events(gap_fill_input(tl), tl, calendar=calendar)
+    if isinstance(final_records, dict):
+        raise RuntimeError(final_records.get("error"))
+    filled = Timeline.from_records(final_records).sorted()
+    checkpoints.save("gap_fill_window", key, timeline_to_json(filled))
+    return filled
+
+
+def _gap_fill_windows(tl: Timeline, windows: list[dict], calendar, ui,
+                      checkpoints: Checkpoints = NO_CHECKPOINTS) -> tuple[Timeline, bool]:
+    """
+    Gap-fill each window (its rows plus one context row either side) in
+    parallel, keep the rows each window owns and stitch them in window order.
+    A window that fails or runs out of budget keeps its document rows.
+    Returns (timeline, complete).
+    """
+    workers = max(min(GAP_FILL_WORKERS, len(windows)), 1)
+    parts, failed, exhausted = [], 0, 0
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="gap-fill") as pool:
+        # Each worker runs in a copy of this context so it sees the run's budget
+        futures = [
+            pool.submit(contextvars.copy_context().run, _fill_window, tl[w["context"]], calendar, checkpoints)
+            for w in windows
+        ]
+        # Wait here rather than in result(), so this thread keeps checking for a stop
+        budget = current_budget()
+        while budget is not None and wait(futures, timeout=POLL_SECONDS).not_done:
+            if budget.cancelled():
+                for future in futures:
+                    future.cancel()
+                raise Cancelled("Run cancelled during gap filling")
+        for w, future in zip(windows, futures):
+            try:
+                parts.append(owned(future.result(), w))
+            except BudgetExhausted:
+                exhausted += 1
+                parts.append(tl[w["rows"]])
+            except BudgetError:
+                raise
+            except Exception as e:
+                failed += 1
+                ui.error(f"❌ Gap filling failed for {format_minutes(tl.start[w['rows'][0]], '%d/%m/%Y')} onwards: {e}")
+                parts.append(tl[w["rows"]])
+
+    filled, stats = stitch_windows(parts, windows, calendar)
+    METRICS.incr("gap_fill.windows", len(windows))
+    METRICS.incr("gap_fill.boundary_fixes", stats["boundary_fixes"])
+    ui.info(
+        f"🪟 Gap filling ran in {len(windows)} windows of {WINDOW_DAYS} days ({workers} at a time); "
+        f"{stats['boundary_fixes']} fixes at window edges."
+    )
+    if exhausted:
+        current_budget().note("gap_fill", f"{exhausted} of {len(windows)} gap-fill windows kept the document events as they are")
+        ui.warning(f"⏱️ Time budget ran out for {exhausted} of {len(windows)} gap-fill windows; their document events are used as extracted.")
+    return filled, not (failed or exhausted)
+
+
+def _gap_fill(tl: Timeline, blocks: Timeline, calendar, ui, checkpoints: Checkpoints = NO_CHECKPOINTS) -> Timeline:
+    key = input_key(
+        timeline_to_json(tl), timeline_to_json(blocks), calendar.describe(),
+        sorted(calendar.holidays), calendar.exclude_sundays,
+    )
+    saved = checkpoints.load("gap_fill", key)
+    if saved is not None:
+        ui.info("⏯️ Resuming from the checkpointed gap-filled timeline.")
+        return timeline_from_json(saved)
+
+    # Long voyages go to the model a few days at a time; so does any table too big for one prompt
+    windows = plan_windows(tl)
+    if len(windows) == 1 and token_budget("gap_fill") and estimate_tokens(events_table(tl)) > token_budget("gap_fill") // 2:
+        windows = plan_windows(tl, window_days=1, min_days=2)
+    if len(windows) > 1:
+        filled, complete = _gap_fill_windows(tl, windows, calendar, ui, checkpoints)
+        ui.markdown(f"final_records:{filled.to_records()}")
+        if complete:
+            checkpoints.save("gap_fill", key, timeline_to_json(filled))
+        return filled
+
+    # Prepare data for Gemini prompt; missing end times go over as "-"
+    events_json_string = gap_fill_input(tl)
+
+    try:
+        final_records, _ = chronological_events(events_json_string, blocks, calendar=calendar)
+    except BudgetExhausted:
+        current_budget().note("gap_fill", "skipped gap filling; using the NOR-split document events as they are")
+        ui.warning("⏱️ Time budget ran out before gap filling; continuing with the document events as extracted.")
+        return tl
+    ui.markdown(f"final_records:{final_records}")
+
+    if isinstance(final_records, dict):
+        ui.error(f"❌ Gap filling failed: {final_records.get('error')}")
+        return tl
+    # Parse the model output once; everything downstream works on epoch minutes
+    filled = Timeline.from_records(final_records).sorted()
+    checkpoints.save("gap_fill", key, timeline_to_json(filled))
+    return filled
+
+
+def fill_gaps(nor_tl: Timeline, blocks: Timeline, calendar, ui, previous=None,
+              checkpoints: Checkpoints = NO_CHECKPOINTS) -> Timeline:
+    """
+    Gap-fill the NOR-split events. `previous` is (input, output) of an earlier
+    version of this voyage; then only the days with changed rows (and their
+    neighbours) are sent to the model and the rest of the old output is kept.
+    """
+    if previous is not None and len(nor_tl):
+        prev_input, prev_output = previous
+        days = dirty_days(prev_input, nor_tl)
+        all_days = set((nor_tl.start // DAY).tolist())
+        if not days:
+            ui.info("♻️ Events unchanged since the previous version; reusing its gap-filled timeline.")
+            return prev_output
+        if len(days) <= MAX_DIRTY_SHARE * len(all_days):
+            ui.info(f"🔁 Revised events: refilling gaps on {len(days)} of {len(all_days)} days.")
+            refilled = _gap_fill(nor_tl[rows_on_days(nor_tl, days)], blocks, calendar, ui, checkpoints)
+            return stitch(prev_output, refilled, days)
+    return _gap_fill(nor_tl, blocks, calendar, ui, checkpoints)
+
+
+def run_voyage(files: list[tuple[str, str]], ui=None, store=None, budget: RunBudget = None,
+               previous_voyage_id: Optional[str] = None) -> Optional[dict]:
+    """
+    Full pipeline for one voyage: extraction → NOR split → gap filling →
+    deductions → laytime summary → Excel workbook. `ui` receives progress
+    (the `st` module in the app, ConsoleUI for batch runs). When a `store`
+    is given the result is queued for persistence. Returns None if the
+    required documents are missing.
+
+    Model calls run under `budget` (a fresh RunBudget by default). When it
+    runs out, later stages fall back to local logic and say so in
+    result["degraded"]; if it is cancelled, Cancelled is raised.
+
+    Each stage's output is checkpointed under the hashes of the input
+    files, so a crashed, cancelled or timed-out run picks up where it
+    stopped when the same files are run again. A clean run removes them.
+
+    A run that revises a stored voyage (`previous_voyage_id`, or else the
+    latest stored voyage with the same vessel, port and NOR) only
+    re-analyses the rows that changed.
+    """
+    budget = budget or current_budget() or RunBudget()
+    # The run's own counters: other runs in this process (service workers, load-test sessions) don't leak in
+    with run_budget(budget), run_metrics() as run_stats:
+        return _run_voyage(files, ui or ConsoleUI(), store, budget, run_stats, previous_voyage_id)
+
+
+def _run_voyage(files: list[tuple[str, str]], ui, store, budget: RunBudget, run_stats: Metrics,
+                previous_voyage_id: Optional[str] = None) -> Optional[dict]:
+    clock = StageClock()
+    templates = TemplateRegistry(store) if store is not None else None
+    hashes = {path: file_hash(path) for _, path in files}
+    checkpoints = Checkpoints.for_files(hashes.values())
+    try:
+        docs = extract_documents(files, ui, templates, store, checkpoints, hashes)
+    except BudgetExhausted:
+        budget.note("extraction", "stopped: budget exhausted before all documents were extracted")
+        ui.error("⏱️ Time budget ran out while extracting the documents; nothing could be analysed.")
+        return None
+    clock.lap("extraction")
+    if budget.cancelled():
+        raise Cancelled("Run cancelled after extraction")
+    template_id = docs["template_id"]
+    extracted_data = docs["extracted_data"]
+    clause_texts = docs["clause_texts"]
+    metadata = docs["metadata"]
+
+    # Step 2: Ensure required documents exist
+    if not all(req in docs["doc_types"] for req in REQUIRED_DOCUMENTS):
+        ui.error("❌ Please upload both Contract and SoF files. They are required for clause–remark matching.")
+        return None
+    ui.success("✅ Required documents uploaded and processed successfully.")
+
+    # Step 2.5: Club Events by Working Hours
+    ui.header("🗓️ Chronological Events")
+    # One timeline from all event documents; the same stoppage reported twice is kept once
+    blocks, merge_stats = merge_streams([
+        build_event_blocks(events, source=doc_type) for doc_type, events in docs["event_streams"]
+    ])
+    if merge_stats["duplicates"]:
+        ui.info(
+            f"🔗 Merged {merge_stats['streams']} event streams: {merge_stats['duplicates']} events reported "
+            f"more than once were combined, {merge_stats['within_stream']} of them repeated within one document "
+            f"({merge_stats['rows_out']} events)."
+        )
+
+    # Pumping log as numbers: flow rates, volume, stoppages against DISRATE
+    pumping = analyze_pumping(extracted_data.get("PumpingLog"), metadata.get("DISRATE"))
+    if pumping is not None:
+        p = pumping["summary"]
+        ui.info(
+            f"🛢️ Pumping log: {p['readings']} readings, {p['total_volume']:g} discharged at {p['mean_rate']:g}/h"
+            + (f" ({p['rate_vs_disrate']:.0%} of DISRATE)" if "rate_vs_disrate" in p else "")
+            + f"; {p['zero_flow_hours']:g} h without flow, {p['low_rate_hours']:g} h below rate."
+        )
+
+    # Step 2.5: Insert NOR split
+    nor_key = input_key(timeline_to_json(blocks), metadata["LTC AT"])
+    saved = checkpoints.load("nor_split", nor_key)
+    if saved is not None:
+        nor_tl = timeline_from_json(saved)
+    else:
+        nor_tl = split_nor_period(blocks, metadata["LTC AT"])
+        checkpoints.save("nor_split", nor_key, timeline_to_json(nor_tl))
+    ui.dataframe(nor_tl.to_records())
+
+    # Revision of a stored voyage (given, or same vessel, port and NOR) → diff against that version
+    previous_id = None
+    if store is not None and previous_voyage_id:
+        if store.has_input_events(previous_voyage_id):
+            previous_id = previous_voyage_id
+        else:
+            ui.warning(f"⚠️ Voyage {previous_voyage_id} has no stored events to compare against; analysing in full.")
+    elif store is not None and len(nor_tl):
+        identity = resolve_metadata_locally(
+            extracted_data["Contract"], extracted_data["SoF"], blocks.to_records(), metadata
+        )
+        previous_id = store.previous_voyage(
+            identity.get("Vessel Name"), identity.get("Port"), int(nor_tl.start.min()), identity.get("NOR TENDERED")
+        )
+
+    # Working hours, Sundays and holidays for this voyage
+    calendar = WorkingCalendar.from_contract(
+        extracted_data["Contract"], metadata.get("TERMS"), holiday_days(blocks)
+    )
+    ui.markdown(f"**Working hours:** {calendar.describe()}")
+    clock.lap("events")
+
+    previous = (store.input_events(previous_id), store.events(previous_id)) if previous_id else None
+    timeline = fill_gaps(nor_tl, blocks, calendar, ui, previous, checkpoints)
+
+    # If end_time is empty, default it to the start time
+    timeline.end = timeline.effective_end()
+    ui.dataframe(timeline.to_records())
+    clock.lap("gap_fill")
+    if budget.cancelled():
+        raise Cancelled("Run cancelled after gap filling")
+
+    evidence = row_evidence(timeline, pumping)
+    unreported = unreported_stoppages(pumping, timeline)
+    if unreported:
+        ui.warning(
+            f"⚠️ The pumping log shows {len(unreported)} stoppage(s) with no matching SoF entry: "
+            + ", ".join(f"{format_minutes(c['start'])}–{format_minutes(c['end'], '%H:%M')}" for c in unreported)
+        )
+
+    # Step 4: Deduction Engine (Gemini-powered)
+    ui.header("Laytime Deductions (via Gemini)")
+    deductions = []
+    recomputed = []
+    if clause_texts and len(timeline):
+        ui.info(f"Analyzing {len(timeline)} events against {len(clause_texts)} clauses...")
+
+        reused = (
+            reusable_decisions(previous[1], store.deductions(previous_id), timeline)
+            if previous_id else [None] * len(timeline)
+        )
+        cache_hits = 0
+        from_log = 0
+        learned_rows = 0
+        resumed = 0
+        fallback_rows = 0
+        out_of_time = False
+        clauses_key = input_key(clause_texts)
+
+        # Local classifier trained on stored decisions: one batch prediction for every row
+        learned = load_classifier()
+        if learned is not None:
+            learned_p, learned_clauses = learned.predict_timeline(timeline, clause_texts)
+        for i, (event, prior, log_evidence) in enumerate(zip(timeline, reused, evidence)):
+            if budget.cancelled():
+                raise Cancelled("Run cancelled during deductions")
+
+            # Unchanged row of a revised SoF → keep the earlier decision
+            if prior is not None:
+                deductions.append(reuse_decision(prior, event, "revision"))
+                continue
+
+            # Prepare the event object for the deduction engine
+            event_obj = event.to_record()
+            event_obj["reason"] = event.reason or event.phase or "No reason provided"
+            if log_evidence is not None:
+                event_obj["pumping_evidence"] = describe_evidence(log_evidence)
+
+            # Decided before the previous run stopped
+            unit_key = input_key(event_obj, clauses_key)
+            saved = checkpoints.load("deduction", unit_key)
+            if saved is not None:
+                # Only model answers are checkpointed
+                deductions.append({**saved, "origin": saved.get("origin", "model")})
+                resumed += 1
+                continue
+
+            # Plain discharging at full rate per the pumping log → counts, no model needed
+            decision = pumping_decision(event_obj, log_evidence)
+            if decision is not None:
+                deductions.append({**decision, "origin": "pumping_log"})
+                from_log += 1
+                continue
+
+            # Same remark under the same charter-party form → reuse the decision
+            cached = templates.cached_deduction(template_id, event_obj) if template_id else None
+            if cached is not None:
+                deductions.append(reuse_decision(cached, event, "template"))
+                cache_hits += 1
+                continue
+
+            # Remarks the learned classifier is sure about skip the model
+            decision = learned_decision(event_obj, learned_p[i], learned_clauses[i]) if learned is not None else None
+            if decision is not None:
+                deductions.append({**decision, "origin": "learned"})
+                learned_rows += 1
+                continue
+
+            # Out of time → keyword rules for this and every remaining row;
+            # a failed model call → keyword rules for this row only
+            if not out_of_time:
+                try:
+                    decision = analyze_event_against_clauses(event_obj, clause_texts)
+                except BudgetExhausted:
+                    decision, out_of_time = None, True
+                if decision is not None and decision.get("Clause") != ERROR_CLAUSE and "error" not in decision:
+                    decision["origin"] = "model"
+                    checkpoints.save("deduction", unit_key, decision)
+                    if template_id:
+                        templates.remember_deduction(template_id, event_obj, decision)
+                    deductions.append(decision)
+                    continue
+            excepted = event.duration > 0 and calendar.counted_minutes(event.start, event.end) == 0
+            deductions.append({**rule_based_decision(event_obj, excepted=excepted), "origin": "fallback"})
+            fallback_rows += 1
+
+        recomputed = [r is None for r in reused]
+        if fallback_rows:
+            budget.note("deduction", f"rule-only deductions for {fallback_rows} of {len(timeline)} events")
+            cause = "Time budget ran out" if out_of_time else "Model calls failed"
+            ui.warning(f"⏱️ {cause}: {fallback_rows} events were decided by keyword rules, not the model.")
+        if previous_id:
+            ui.info(f"🔁 Re-analysed {sum(recomputed)} of {len(timeline)} events; the rest are unchanged from the previous version.")
+        if cache_hits:
+            ui.info(f"♻️ Reused {cache_hits} cached deduction decisions for this contract form.")
+        if learned_rows:
+            ui.info(f"🧠 {learned_rows} events decided by the learned classifier (confidence ≥ {learned.report['threshold']:.0%}).")
+        if from_log:
+            ui.info(f"🛢️ Decided {from_log} discharging events from the pumping log without a model call.")
+        if resumed:
+            ui.info(f"⏯️ Resumed {resumed} deduction decisions from checkpoints of an interrupted run.")
+
+        cascade_stats = cascade_report("deduction", metrics=run_stats)
+        if cascade_stats["requests"]:
+            ui.info(
+                f"🪜 Model cascade: {cascade_stats['requests']} events, {cascade_stats['escalations']} escalated "
+                f"({cascade_stats['escalation_rate']:.0%} at confidence < {cascade_stats['threshold']:.2f}), "
+                f"{cascade_stats['schema_failures']} schema failures"
+            )
+
+        if not deductions:
+            ui.warning("⚠️ No valid deductions could be analyzed.")
+    else:
+        ui.warning("⚠️ Cannot run deduction engine. Clause texts or event records are missing.")
+    clock.lap("deduction")
+
+    # Step 5: Final Laytime Summary
+    calc = None
+    summary = {}
+    if len(timeline) and deductions:
+        calc = LaytimeCalculator(timeline, deductions, calendar=calendar)
+        summary = {
+            "total_hours": calc.total_block_hours(),
+            "deduction_hours": calc.total_deduction_hours(),
+            "net_hours": calc.net_laytime_hours(),
+        }
+
+        ui.header("🧮 Laytime Calculation Summary")
+        ui.markdown(f"- **Total Working-Hour Blocks:** {summary['total_hours']:.2f} hrs")
+        ui.markdown(f"- **Total Deductions:**          {summary['deduction_hours']:.2f} hrs")
+        ui.markdown(f"- **Net Laytime Used:**         {summary['net_hours']:.2f} hrs")
+
+    # 🔄 Resolve header metadata locally; Gemini only fills what is still missing
+    try:
+        metadata_response, _ = extract_metadata_from_docs(
+            extracted_data["Contract"], extracted_data["SoF"], events=blocks.to_records(), known=metadata
+        )
+    except BudgetExhausted:
+        budget.note("metadata", "header fields resolved locally only")
+        metadata_response = resolve_metadata_locally(
+            extracted_data["Contract"], extracted_data["SoF"], blocks.to_records(), metadata
+        )
+
+    clock.lap("metadata")
+    laytime_index = calc.laytime_index() if calc is not None else None
+    allowed_days = laytime_allowed_days(metadata_response)
+    summary["allowed_days"] = allowed_days
+    if laytime_index is not None and allowed_days is not None:
+        summary["expiry"] = laytime_index.expiry(allowed_days * 24 * 60)
+        summary["demurrage_hours"] = laytime_index.time_on_demurrage(allowed_days * 24 * 60) / 60.0
+        ui.markdown(f"- **Laytime Expires:**          {format_minutes(summary['expiry']) or 'Not expired'}")
+        ui.markdown(f"- **Time on Demurrage:**        {summary['demurrage_hours']:.2f} hrs")
+
+    # ✅ Build Excel workbook
+    workbook = None
+    if deductions:
+        workbook = generate_excel_from_extracted_data(
+            metadata_response, deductions, summary.get("net_hours", 0.0), timeline=timeline, calendar=calendar,
+            laytime_index=laytime_index
+        )
+
+    clock.lap("summary")
+    result = {
+        "metadata": metadata_response,
+        "documents": docs["documents"],
+        "clause_texts": clause_texts,
+        "blocks": blocks,
+        "timeline": timeline,
+        "calendar": calendar,
+        "deductions": deductions,
+        "summary": summary,
+        "workbook": workbook,
+        "metrics": {"deduction_cascade": cascade_report("deduction", metrics=run_stats), "event_merge": merge_stats},
+        "gap_input": nor_tl,
+        "recomputed": recomputed,
+        "degraded": list(budget.degraded),
+        "pumping": None if pumping is None else {
+            "summary": pumping["summary"], "candidates": pumping["candidates"], "unreported": unreported,
+        },
+    }
+    result["metrics"]["elapsed_seconds"] = round(budget.elapsed(), 1)
+    result["metrics"]["stage_seconds"] = {k: round(v, 3) for k, v in clock.seconds.items()}
+    result["metrics"]["model_calls"] = HEDGER.run_report(run_stats)
+    result["metrics"]["prompt_tokens"] = token_report(metrics=run_stats)["stages"]
+    saved = sum(s["saved_tokens"] for s in result["metrics"]["prompt_tokens"].values())
+    sent = sum(s["input_tokens"] for s in result["metrics"]["prompt_tokens"].values())
+    if saved > 0 and sent:
+        ui.info(f"🧾 Compact prompt encoding saved ~{saved:,} input tokens ({saved / (saved + sent):.0%}); ~{sent:,} sent.")
+    if previous_id:
+        result["revision"] = {
+            "previous_id": previous_id, "recomputed_rows": sum(recomputed), "total_rows": len(recomputed),
+        }
+    if store is not None:
+        result["voyage_id"] = store.save_voyage_async(result)
+    # Degraded runs keep their checkpoints so a rerun with more time can finish them
+    if not budget.degraded:
+        checkpoints.clear()
+    return result
+
+
+# ---------- Batch runs ----------
+def run_batch(folders: list[str], store=None) -> list[dict]:
+    """Run every voyage folder (one folder of PDFs per voyage) through the pipeline."""
+    results = []
+    for folder in folders:
+        files = [
+            (name, os.path.join(folder, name))
+            for name in sorted(os.listdir(folder))
+            if name.lower().endswith((".pdf", ".docx"))
+        ]
+        print(f"📂 {folder}: {len(files)} documents")
+        result = run_voyage(files, ConsoleUI(), store=store)
+        if result is not None:
+            results.append(result)
+    return results
+
+
+if __name__ == "__main__":
+    from store import VoyageStore
+
+    if len(sys.argv) < 2:
+        print("Usage: python pipeline.py <voyage_folder> [<voyage_folder> ...]")
+        sys.exit(1)
+    with VoyageStore() as store:
+        run_batch(sys.argv[1:], store=store)
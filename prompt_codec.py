@@ -0,0 +1,196 @@
+# prompt_codec.py
+
+import os
+import re
+import json
+from typing import Optional
+
+from metrics import METRICS, Metrics
+from event_model import MISSING, Timeline, format_minutes
+
+# ---------- CONFIG ----------
+CHARS_PER_TOKEN = 4.0            # local estimate; close enough for budgeting English/JSON prompts
+FILE_TOKENS = 258 * 4            # uploaded PDFs are billed per page; assume a short document
+# Input-token ceiling per model call, by stage. Override with LAYTIME_TOKEN_BUDGET_<STAGE>=n (0 = no limit)
+TOKEN_BUDGETS = {
+    "extraction": 20_000,
+    "gap_fill": 30_000,
+    "metadata": 12_000,
+    "deduction": 4_000,
+    "default": 30_000,
+}
+NO_END = "-"                     # end_time cell for a row without an end
+
+
+class TokenBudgetExceeded(ValueError):
+    """A prompt is over its stage's input-token budget even after compaction."""
+
+
+# ---------- Counting ----------
+def estimate_tokens(contents, files=()) -> int:
+    """Input tokens of a prompt (str or list of parts), estimated locally without a model call."""
+    parts = contents if isinstance(contents, list) else [contents]
+    chars = sum(len(p) if isinstance(p, str) else len(str(p)) for p in parts)
+    return int(chars / CHARS_PER_TOKEN + 0.5) + FILE_TOKENS * len(files or ())
+
+
+def token_budget(stage: str) -> int:
+    env = os.getenv(f"LAYTIME_TOKEN_BUDGET_{stage.upper()}")
+    if env is not None:
+        return int(env)
+    return TOKEN_BUDGETS.get(stage, TOKEN_BUDGETS["default"])
+
+
+def check_budget(stage: str, tokens: int):
+    """Record a call's input tokens; raise TokenBudgetExceeded if they are over the stage budget."""
+    METRICS.incr(f"tokens.{stage}.input", tokens)
+    METRICS.observe(f"tokens.{stage}.per_call", tokens)
+    budget = token_budget(stage)
+    if budget and tokens > budget:
+        METRICS.incr(f"tokens.{stage}.over_budget")
+        raise TokenBudgetExceeded(f"{stage} prompt is ~{tokens} tokens, over its budget of {budget}")
+
+
+def record_savings(stage: str, verbose: str, compact: str) -> int:
+    """Log how many tokens a compact encoding saved over the old one; returns the saving."""
+    saved = estimate_tokens(verbose) - estimate_tokens(compact)
+    METRICS.incr(f"tokens.{stage}.verbose", estimate_tokens(verbose))
+    METRICS.incr(f"tokens.{stage}.compact", estimate_tokens(compact))
+    return saved
+
+
+def token_report(before: Optional[dict] = None, metrics: Optional[Metrics] = None) -> dict:
+    """
+    Per stage: input tokens sent, tokens saved by compact encodings and calls
+    over budget (since `before`), from `metrics` (a run's collector) or METRICS.
+    """
+    counters = (metrics or METRICS).counters_with_prefix("tokens.")
+    base = (before or {}).get("counters", {})
+    delta = {k: v - base.get(k, 0) for k, v in counters.items()}
+    stages = sorted({k.split(".")[1] for k in delta})
+    report = {}
+    for stage in stages:
+        verbose, compact = delta.get(f"tokens.{stage}.verbose", 0), delta.get(f"tokens.{stage}.compact", 0)
+        report[stage] = {
+            "input_tokens": int(delta.get(f"tokens.{stage}.input", 0)),
+            "saved_tokens": int(verbose - compact),
+            "saved_share": round((verbose - compact) / verbose, 3) if verbose else 0.0,
+            "over_budget": int(delta.get(f"tokens.{stage}.over_budget", 0)),
+        }
+    return {"stages": {k: v for k, v in report.items() if any(v.values())}, "counters": counters}
+
+
+# ---------- Encodings ----------
+def squeeze(prompt: str) -> str:
+    """A prompt without the indentation of the source it was written in."""
+    return re.sub(r"(?m)^[ \t]+", "", prompt).strip() + "\n"
+
+
+def _cell(value) -> str:
+    return re.sub(r"\s+", " ", str(value or "")).replace("|", "/").strip()
+
+
+def events_table(tl: Timeline) -> str:
+    """
+    A timeline as one pipe-separated table per date, instead of a JSON array
+    of records: the keys appear once in the header, the date and weekday once
+    per day, times as HH:MM (an end on a later day keeps its date).
+    """
+    with_phase = tl.has_phase
+    header = "start_time|end_time|reason" + ("|event_phase" if with_phase else "")
+    lines, current = [header], None
+    for i in range(len(tl)):
+        start, end = int(tl.start[i]), int(tl.end[i])
+        day = format_minutes(start, "%d/%m/%Y %A")
+        if day != current:
+            lines.append(f"== {day}")
+            current = day
+        if end == MISSING:
+            end_cell = NO_END
+        elif end // 1440 == start // 1440:
+            end_cell = format_minutes(end, "%H:%M")
+        else:
+            end_cell = format_minutes(end)
+        row = [format_minutes(start, "%H:%M"), end_cell, _cell(tl.reason[i])]
+        if with_phase:
+            row.append(_cell(tl.phase[i]))
+        lines.append("|".join(row))
+    return "\n".join(lines)
+
+
+def parse_events_table(text: str) -> list[dict]:
+    """Records back from events_table() output (used by the synthetic load-test backend)."""
+    lines = [l for l in text.strip().splitlines() if l.strip()]
+    if not lines:
+        return []
+    columns = lines[0].split("|")
+    records, date = [], None
+    for line in lines[1:]:
+        if line.startswith("== "):
+            date = line[3:].split(" ")[0]
+            continue
+        row = dict(zip(columns, line.split("|")))
+        d, m, y = date.split("/")
+        start = f"{y}-{m}-{d} {row['start_time']}"
+        end = row.get("end_time", NO_END)
+        if end == NO_END:
+            end = None
+        elif len(end) == 5:
+            end = f"{y}-{m}-{d} {end}"
+        rec = {"date": date, "start_time": start, "end_time": end, "reason": row.get("reason", "")}
+        if row.get("event_phase"):
+            rec["event_phase"] = row["event_phase"]
+        records.append(rec)
+    return records
+
+
+def compact(value):
+    """
+    A JSON-ready copy without empty values, where every list of objects
+    becomes {"columns": [...], "rows": [[...], ...]} so its keys are written
+    once instead of once per element.
+    """
+    if isinstance(value, dict):
+        out = {}
+        for k, v in value.items():
+            v = compact(v)
+            if v not in (None, "", [], {}):
+                out[k] = v
+        return out
+    if isinstance(value, (list, tuple)):
+        items = [compact(v) for v in value]
+        items = [v for v in items if v not in (None, "", [], {})]
+        if len(items) > 1 and all(isinstance(v, dict) for v in items):
+            columns = list(dict.fromkeys(k for v in items for k in v))
+            return {"columns": columns, "rows": [[v.get(c) for c in columns] for v in items]}
+        return items
+    return value
+
+
+def compact_json(value) -> str:
+    return json.dumps(compact(value), separators=(",", ":"), ensure_ascii=False, default=str)
+
+
+def clause_list(clause_texts: list[str], remark: str = "", max_tokens: Optional[int] = None) -> tuple[str, int]:
+    """
+    Contract clauses for a deduction prompt: whitespace collapsed, duplicates
+    dropped and, when they would not fit `max_tokens`, only the clauses
+    sharing the most words with the remark (kept in contract order).
+    Returns (text, clauses_dropped).
+    """
+    clauses = list(dict.fromkeys(_cell(c) for c in clause_texts if _cell(c)))
+    if max_tokens is not None and estimate_tokens("\n".join(clauses)) > max_tokens:
+        words = set(re.findall(r"[a-z]+", remark.lower()))
+        ranked = sorted(range(len(clauses)), key=lambda i: -len(words & set(re.findall(r"[a-z]+", clauses[i].lower()))))
+        keep, used = set(), 0
+        for i in ranked:
+            cost = estimate_tokens(clauses[i]) + 1
+            if used + cost > max_tokens:
+                continue
+            keep.add(i)
+            used += cost
+        dropped = len(clauses) - len(keep)
+        clauses = [c for i, c in enumerate(clauses) if i in keep]
+    else:
+        dropped = 0
+    return "\n".join(f"- {c}" for c in clauses), dropped
@@ -0,0 +1,296 @@
+# pumping.py
+
+import re
+from typing import Optional
+
+import numpy as np
+
+from event_model import Timeline, format_minutes, parse_minutes
+from excel_exporter import parse_number
+
+# ---------- CONFIG ----------
+# Log rates are per hour (mt/h or m3/h); the contract DISRATE is per day
+ZERO_FLOW_RATE = 1.0            # below this an interval counts as a stoppage
+LOW_FLOW_SHARE = 0.5            # below this share of DISRATE/24 it is a rate shortfall
+MIN_CANDIDATE_MINUTES = 30      # shorter dips are noise
+MAX_READING_GAP_MINUTES = 360   # longer gaps between readings are unknown, not flow
+MIN_COVERAGE = 0.9              # share of a row the log must cover to decide it from the log
+PUMPING_CONFIDENCE = 0.9
+PUMPING_CLAUSE = "Pumping log: cargo discharged at or above the contract rate"
+CARGO_PATTERN = r"discharg|pumping|cargo operations"
+STOPPAGE_PATTERN = r"stop|suspend|interrupt|await|waiting|rain|weather|breakdown|shift|hose|sampl|delay|slow|reduced"
+
+KEY_PATTERNS = {
+    "time": r"date\s*&\s*time|timestamp|date_?time|^time$",
+    "date": r"^date$",
+    "clock": r"^(start_?)?time$|^hour$",
+    "rate": r"rate|flow",
+    "volume": r"vol|quantity|total|discharged|cumul",
+    "remarks": r"remark|comment|note|event",
+}
+
+
+def _number(raw) -> float:
+    """Numeric value or NaN (parse_number's 0.0 would read as a real zero rate)."""
+    if raw is None or not re.search(r"\d", str(raw)):
+        return np.nan
+    return parse_number(raw)
+
+
+def _find_key(record: dict, kind: str) -> Optional[str]:
+    return next((k for k in record if re.search(KEY_PATTERNS[kind], str(k), re.IGNORECASE)), None)
+
+
+def pumping_records(data: Optional[dict]) -> list[dict]:
+    """The log rows of a PumpingLog extraction: "pumping_records", else the first list of dicts with a rate column."""
+    if not data:
+        return []
+    if isinstance(data.get("pumping_records"), list):
+        return data["pumping_records"]
+    for value in data.values():
+        if isinstance(value, list) and value and isinstance(value[0], dict) and _find_key(value[0], "rate"):
+            return value
+    return []
+
+
+def load_series(records: list[dict]) -> dict:
+    """
+    Readings as sorted arrays: t (epoch minutes), rate and volume (NaN where
+    absent) and remarks. Rows without a parseable time are dropped.
+    """
+    t, rate, volume, remarks = [], [], [], []
+    for r in records:
+        if not isinstance(r, dict):
+            continue
+        time_key, date_key, clock_key = _find_key(r, "time"), _find_key(r, "date"), _find_key(r, "clock")
+        try:
+            if time_key and r.get(time_key):
+                m = parse_minutes(r[time_key])
+            else:
+                m = parse_minutes(r.get(clock_key), r.get(date_key)) if clock_key else None
+        except (ValueError, OverflowError):
+            m = None
+        if m is None:
+            continue
+        rate_key, volume_key, remarks_key = _find_key(r, "rate"), _find_key(r, "volume"), _find_key(r, "remarks")
+        t.append(m)
+        rate.append(_number(r.get(rate_key)) if rate_key else np.nan)
+        volume.append(_number(r.get(volume_key)) if volume_key else np.nan)
+        remarks.append(str(r.get(remarks_key) or "") if remarks_key else "")
+    order = np.argsort(np.asarray(t, dtype=np.int64), kind="stable")
+    return {
+        "t": np.asarray(t, dtype=np.int64)[order],
+        "rate": np.asarray(rate, dtype=float)[order],
+        "volume": np.asarray(volume, dtype=float)[order],
+        "remarks": [remarks[i] for i in order],
+    }
+
+
+def interval_rates(series: dict) -> dict:
+    """
+    Per interval between consecutive readings: start/end, actual rate (from
+    volume differences when the log has a cumulative volume, otherwise the
+    reading's own rate), volume moved and the running cumulative volume.
+    """
+    t, rate, volume = series["t"], series["rate"], series["volume"]
+    t0, t1 = t[:-1], t[1:]
+    hours = (t1 - t0) / 60.0
+
+    known = ~np.isnan(volume)
+    cumulative = known.sum() >= 2 and np.all(np.diff(volume[known]) >= 0)
+    if cumulative:
+        dv = np.diff(volume)
+        actual = np.where(hours > 0, dv / np.where(hours > 0, hours, 1), np.nan)
+        actual = np.where(np.isnan(actual), rate[:-1], actual)
+    else:
+        actual = rate[:-1].copy()
+    actual[(t1 - t0) > MAX_READING_GAP_MINUTES] = np.nan
+
+    moved = np.nan_to_num(actual) * hours
+    return {
+        "t0": t0, "t1": t1, "rate": actual, "moved": moved,
+        "cumulative": np.concatenate([[0.0], np.cumsum(moved)]),
+        "volume_source": "cumulative volume" if cumulative else "reported rate",
+    }
+
+
+def flow_states(rates: np.ndarray, required: Optional[float]) -> np.ndarray:
+    """-1 unknown, 0 at/above threshold, 1 below LOW_FLOW_SHARE of the required rate, 2 zero flow."""
+    state = np.zeros(len(rates), dtype=np.int8)
+    if required:
+        state[rates < LOW_FLOW_SHARE * required] = 1
+    state[rates < ZERO_FLOW_RATE] = 2
+    state[np.isnan(rates)] = -1
+    return state
+
+
+def _runs(state: np.ndarray) -> list[tuple[int, int]]:
+    """[start, stop) index ranges of equal consecutive states."""
+    if not len(state):
+        return []
+    edges = np.flatnonzero(np.diff(state)) + 1
+    bounds = np.concatenate([[0], edges, [len(state)]])
+    return list(zip(bounds[:-1].tolist(), bounds[1:].tolist()))
+
+
+def analyze_pumping(data: Optional[dict], disrate) -> Optional[dict]:
+    """
+    Pumping-log analytics for one voyage. Returns None without a usable log,
+    else {"summary", "intervals", "candidates", "events"}: candidates are the
+    zero-flow and below-rate periods with their evidence, `events` the same
+    periods as a Timeline (source "PumpingLog analytics").
+    """
+    series = load_series(pumping_records(data))
+    if len(series["t"]) < 2:
+        return None
+    iv = interval_rates(series)
+    daily = _number(disrate)
+    required = daily / 24.0 if daily and not np.isnan(daily) else None
+    state = flow_states(iv["rate"], required)
+    minutes = iv["t1"] - iv["t0"]
+
+    candidates = []
+    for a, b in _runs(state):
+        kind = int(state[a])
+        span = int(minutes[a:b].sum())
+        if kind not in (1, 2) or span < MIN_CANDIDATE_MINUTES:
+            continue
+        hours = span / 60.0
+        moved = float(iv["moved"][a:b].sum())
+        in_run = (series["t"] >= iv["t0"][a]) & (series["t"] <= iv["t1"][b - 1])
+        candidates.append({
+            "start": int(iv["t0"][a]),
+            "end": int(iv["t1"][b - 1]),
+            "kind": "zero_flow" if kind == 2 else "low_rate",
+            "from": format_minutes(int(iv["t0"][a])),
+            "to": format_minutes(int(iv["t1"][b - 1])),
+            "evidence": {
+                "readings": int(in_run.sum()),
+                "mean_rate": round(moved / hours, 2) if hours else 0.0,
+                "min_rate": round(float(np.nanmin(iv["rate"][a:b])), 2),
+                "required_rate": round(required, 2) if required else None,
+                "volume_moved": round(moved, 2),
+                "shortfall_volume": round(required * hours - moved, 2) if required else None,
+                "log_remarks": sorted({r for r, m in zip(series["remarks"], in_run) if m and r}),
+            },
+        })
+
+    events = Timeline(
+        [c["start"] for c in candidates],
+        [c["end"] for c in candidates],
+        ["Pumping stopped (zero flow in pumping log)" if c["kind"] == "zero_flow"
+         else f"Pumping below rate ({c['evidence']['mean_rate']:g} vs {c['evidence']['required_rate']:g} per hour)"
+         for c in candidates],
+        [""] * len(candidates),
+        ["PumpingLog analytics"] * len(candidates),
+    )
+    known = state >= 0
+    total_hours = float(minutes[known].sum()) / 60.0
+    summary = {
+        "readings": int(len(series["t"])),
+        "from": format_minutes(int(series["t"][0])),
+        "to": format_minutes(int(series["t"][-1])),
+        "volume_source": iv["volume_source"],
+        "total_volume": round(float(iv["cumulative"][-1]), 2),
+        "mean_rate": round(float(iv["moved"][known].sum()) / total_hours, 2) if total_hours else 0.0,
+        "required_rate": round(required, 2) if required else None,
+        "zero_flow_hours": round(float(minutes[state == 2].sum()) / 60.0, 2),
+        "low_rate_hours": round(float(minutes[state == 1].sum()) / 60.0, 2),
+    }
+    if required:
+        summary["rate_vs_disrate"] = round(summary["mean_rate"] / required, 3)
+    return {"summary": summary, "intervals": {**iv, "state": state}, "candidates": candidates, "events": events}
+
+
+def row_evidence(timeline: Timeline, pumping: Optional[dict]) -> list[Optional[dict]]:
+    """
+    Per timeline row, what the pumping log says about that period: covered
+    share, mean rate and minutes of zero / low flow. One (rows × intervals)
+    overlap matrix; None for rows the log doesn't touch.
+    """
+    if pumping is None or not len(timeline):
+        return [None] * len(timeline)
+    iv = pumping["intervals"]
+    state = iv["state"]
+    start, end = timeline.start[:, None], timeline.effective_end()[:, None]
+    overlap = np.clip(np.minimum(end, iv["t1"][None, :]) - np.maximum(start, iv["t0"][None, :]), 0, None)
+    overlap = overlap * (state >= 0)[None, :]
+    covered = overlap.sum(axis=1)
+    moved = (overlap * np.nan_to_num(iv["rate"])[None, :]).sum(axis=1) / 60.0
+    zero = (overlap * (state == 2)[None, :]).sum(axis=1)
+    low = (overlap * (state == 1)[None, :]).sum(axis=1)
+    length = (timeline.effective_end() - timeline.start).astype(float)
+    required = pumping["summary"]["required_rate"]
+
+    out = []
+    for i in range(len(timeline)):
+        if covered[i] == 0:
+            out.append(None)
+            continue
+        out.append({
+            "covered_share": round(float(covered[i] / length[i]), 3) if length[i] else 1.0,
+            "mean_rate": round(float(moved[i] * 60.0 / covered[i]), 2),
+            "required_rate": required,
+            "zero_flow_minutes": int(zero[i]),
+            "low_rate_minutes": int(low[i]),
+        })
+    return out
+
+
+def describe_evidence(evidence: dict) -> str:
+    """One line for the deduction prompt."""
+    text = f"covers {evidence['covered_share']:.0%} of this period; mean rate {evidence['mean_rate']:g}/h"
+    if evidence["required_rate"] is not None:
+        text += f" vs {evidence['required_rate']:g}/h required"
+    if evidence["zero_flow_minutes"]:
+        text += f"; no flow for {evidence['zero_flow_minutes']} min"
+    if evidence["low_rate_minutes"]:
+        text += f"; below rate for {evidence['low_rate_minutes']} min"
+    return text
+
+
+def pumping_decision(event: dict, evidence: Optional[dict]) -> Optional[dict]:
+    """
+    A deduction decision straight from the log, or None when the model is
+    still needed. Only the unambiguous case is decided here: a discharging
+    row with no stoppage wording that the log covers, flowing at or above
+    the required rate throughout. That time counts as laytime.
+    """
+    remark = event.get("reason") or ""
+    if evidence is None or not re.search(CARGO_PATTERN, remark, re.IGNORECASE):
+        return None
+    if re.search(STOPPAGE_PATTERN, remark, re.IGNORECASE):
+        return None
+    if evidence["covered_share"] < MIN_COVERAGE or evidence["zero_flow_minutes"] or evidence["low_rate_minutes"]:
+        return None
+
+    start = parse_minutes(event.get("start_time"))
+    end = parse_minutes(event.get("end_time")) or start
+    return {
+        "Date": event.get("date"),
+        "Day": event.get("day"),
+        "Remark": remark,
+        "Clause": PUMPING_CLAUSE,
+        "confidence_score": PUMPING_CONFIDENCE,
+        "deduct": False,
+        "reason": f"Pumping log shows discharging throughout ({describe_evidence(evidence)}); counts as laytime",
+        "deducted_from": format_minutes(start, "%H:%M"),
+        "deducted_to": format_minutes(end, "%H:%M"),
+        "total_hours": round(max(end - start, 0) / 60.0, 4),
+        "evidence": evidence,
+    }
+
+
+def unreported_stoppages(pumping: Optional[dict], timeline: Timeline) -> list[dict]:
+    """Log stoppages that no SoF row with stoppage wording overlaps."""
+    if pumping is None or not pumping["candidates"] or not len(timeline):
+        return []
+    stop_rows = timeline.matches(STOPPAGE_PATTERN, "reason") | timeline.matches(STOPPAGE_PATTERN, "phase")
+    s, e = timeline.start[stop_rows], timeline.effective_end()[stop_rows]
+    out = []
+    for c in pumping["candidates"]:
+        if c["kind"] != "zero_flow":
+            continue
+        if not np.any((s < c["end"]) & (e > c["start"])):
+            out.append(c)
+    return out
@@ -0,0 +1,219 @@
+# result_export.py
+
+import io
+import csv
+import json
+from typing import Iterable, Iterator, Optional
+
+from event_model import format_minutes
+
+# ---------- CONFIG ----------
+FORMATS = ("xlsx", "csv", "json", "parquet")
+PARQUET_BATCH_ROWS = 5000
+MIME_TYPES = {
+    "xlsx": "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+    "csv": "text/csv",
+    "json": "application/json",
+    "parquet": "application/vnd.apache.parquet",
+}
+COLUMNS = [
+    "date", "day", "start_time", "end_time", "deduct", "deducted_hours", "to_count_hours",
+    "remark", "clause", "reason", "confidence_score",
+]
+
+
+def result_rows(result: dict) -> Iterator[dict]:
+    """One flat row per analysed event, hours from the timeline (working time if a calendar is set)."""
+    tl = result.get("timeline")
+    deductions = result.get("deductions") or []
+    calendar = result.get("calendar")
+    aligned = tl is not None and len(tl) == len(deductions)
+    if aligned:
+        minutes = calendar.counted_minutes(tl.start, tl.effective_end()) if calendar is not None else tl.durations()
+
+    for i, d in enumerate(deductions):
+        if aligned:
+            hours = round(float(minutes[i]) / 60.0, 4)
+            start, end = format_minutes(tl.start[i]), format_minutes(tl.end[i])
+            date, day = format_minutes(tl.start[i], "%d/%m/%Y"), format_minutes(tl.start[i], "%A")
+        else:
+            try:
+                hours = float(d.get("total_hours"))
+            except (TypeError, ValueError):
+                hours = 0.0
+            start, end = d.get("deducted_from"), d.get("deducted_to")
+            date, day = d.get("Date"), d.get("Day")
+        deduct = bool(d.get("deduct", False))
+        try:
+            confidence = float(d.get("confidence_score"))
+        except (TypeError, ValueError):
+            confidence = None
+        yield {
+            "date": date,
+            "day": day,
+            "start_time": start,
+            "end_time": end,
+            "deduct": deduct,
+            "deducted_hours": hours if deduct else 0.0,
+            "to_count_hours": 0.0 if deduct else hours,
+            "remark": d.get("Remark"),
+            "clause": d.get("Clause"),
+            "reason": d.get("reason"),
+            "confidence_score": confidence,
+        }
+
+
+# ---------- Sinks ----------
+class CsvSink:
+    def __init__(self):
+        self.buf = io.StringIO()
+        self.writer = csv.DictWriter(self.buf, fieldnames=COLUMNS)
+        self.writer.writeheader()
+
+    def write(self, row: dict):
+        self.writer.writerow(row)
+
+    def drain(self) -> bytes:
+        """Bytes written since the last drain (for streaming)."""
+        data = self.buf.getvalue().encode("utf-8")
+        self.buf.seek(0)
+        self.buf.truncate()
+        return data
+
+    def close(self) -> bytes:
+        return self.drain()
+
+
+class JsonSink:
+    def __init__(self, result: dict):
+        self.buf = io.StringIO()
+        self.first = True
+        head = {"metadata": result.get("metadata") or {}, "summary": result.get("summary") or {}}
+        # Open the object and the rows array; rows are appended as they arrive
+        self.buf.write(json.dumps(head, default=str)[:-1] + ', "rows": [')
+
+    def write(self, row: dict):
+        if not self.first:
+            self.buf.write(",")
+        self.buf.write(json.dumps(row, default=str))
+        self.first = False
+
+    def drain(self) -> bytes:
+        data = self.buf.getvalue().encode("utf-8")
+        self.buf.seek(0)
+        self.buf.truncate()
+        return data
+
+    def close(self) -> bytes:
+        self.buf.write("]}")
+        return self.drain()
+
+
+class XlsxSink:
+    """The laytime report workbook plus a flat DATA sheet filled row by row."""
+
+    def __init__(self, result: dict):
+        from openpyxl import Workbook
+
+        self.wb = result.get("workbook") or Workbook()
+        self.ws = self.wb.create_sheet("DATA")
+        self.ws.append(COLUMNS)
+
+    def write(self, row: dict):
+        self.ws.append([row[c] for c in COLUMNS])
+
+    def close(self) -> bytes:
+        out = io.BytesIO()
+        self.wb.save(out)
+        # Leave the caller's workbook as it was
+        self.wb.remove(self.ws)
+        return out.getvalue()
+
+
+class ParquetSink:
+    """Row batches written through pyarrow's ParquetWriter into memory."""
+
+    def __init__(self, batch_rows: int = PARQUET_BATCH_ROWS):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        self.pa = pa
+        self.schema = pa.schema([
+            ("date", pa.string()), ("day", pa.string()), ("start_time", pa.string()), ("end_time", pa.string()),
+            ("deduct", pa.bool_()), ("deducted_hours", pa.float64()), ("to_count_hours", pa.float64()),
+            ("remark", pa.string()), ("clause", pa.string()), ("reason", pa.string()),
+            ("confidence_score", pa.float64()),
+        ])
+        self.out = io.BytesIO()
+        self.writer = pq.ParquetWriter(self.out, self.schema)
+        self.batch_rows = batch_rows
+        self.pending = []
+
+    def _flush(self):
+        if self.pending:
+            cols = {}
+            for field in self.schema:
+                vals = [r[field.name] for r in self.pending]
+                if field.type == self.pa.string():
+                    vals = [None if v is None else str(v) for v in vals]
+                cols[field.name] = vals
+            self.writer.write_table(self.pa.table(cols, schema=self.schema))
+            self.pending = []
+
+    def write(self, row: dict):
+        self.pending.append(row)
+        if len(self.pending) >= self.batch_rows:
+            self._flush()
+
+    def close(self) -> bytes:
+        self._flush()
+        self.writer.close()
+        return self.out.getvalue()
+
+
+def _make_sink(fmt: str, result: dict):
+    if fmt == "csv":
+        return CsvSink()
+    if fmt == "json":
+        return JsonSink(result)
+    if fmt == "xlsx":
+        return XlsxSink(result)
+    if fmt == "parquet":
+        return ParquetSink()
+    raise ValueError(f"Unsupported export format: {fmt}")
+
+
+# ---------- Public API ----------
+def export_result(result: dict, formats: Iterable[str] = FORMATS, rows: Optional[Iterable[dict]] = None) -> dict:
+    """
+    Serialize a voyage result into in-memory buffers, one per format, from a
+    single pass over the rows. Formats whose optional dependency is missing
+    (pyarrow for parquet) are left out. Returns {format: bytes}.
+    """
+    sinks = {}
+    for fmt in formats:
+        try:
+            sinks[fmt] = _make_sink(fmt, result)
+        except ImportError as e:
+            print(f"⚠️ Skipping {fmt} export: {e}")
+
+    for row in (rows if rows is not None else result_rows(result)):
+        for sink in sinks.values():
+            sink.write(row)
+
+    return {fmt: sink.close() for fmt, sink in sinks.items()}
+
+
+def stream_export(result: dict, fmt: str, chunk_rows: int = 500) -> Iterator[bytes]:
+    """
+    Yield a CSV or JSON serialization in chunks of `chunk_rows` rows, so large
+    results can be sent without building the whole payload in memory.
+    """
+    if fmt not in ("csv", "json"):
+        raise ValueError(f"Streaming is only supported for csv and json, not {fmt}")
+    sink = _make_sink(fmt, result)
+    for i, row in enumerate(result_rows(result), start=1):
+        sink.write(row)
+        if i % chunk_rows == 0:
+            yield sink.drain()
+    yield sink.close()
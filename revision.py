@@ -0,0 +1,101 @@
+# revision.py
+
+from collections import Counter
+from typing import Optional
+
+import numpy as np
+
+from event_model import Timeline
+from template_cache import normalize_text
+from deduction_engine import FALLBACK_CLAUSE
+
+# ---------- CONFIG ----------
+DAY = 1440
+MAX_DIRTY_SHARE = 0.5   # above this share of changed days a full rerun is cheaper
+
+
+def row_keys(tl: Timeline) -> list[tuple]:
+    """(start, end, normalized remark) per row: what makes two versions of a row the same."""
+    end = tl.effective_end()
+    return [(int(tl.start[i]), int(end[i]), normalize_text(tl.reason[i] or tl.phase[i])) for i in range(len(tl))]
+
+
+def diff_rows(old: Timeline, new: Timeline) -> tuple[np.ndarray, list[tuple]]:
+    """
+    Rows of `new` with no identical row in `old` (as a mask), and the keys of
+    `old` rows that no longer appear in `new`. Duplicates are matched one to one.
+    """
+    remaining = Counter(row_keys(old))
+    changed = np.zeros(len(new), dtype=bool)
+    for i, key in enumerate(row_keys(new)):
+        if remaining[key] > 0:
+            remaining[key] -= 1
+        else:
+            changed[i] = True
+    removed = [k for k, n in remaining.items() for _ in range(n)]
+    return changed, removed
+
+
+def with_neighbours(mask: np.ndarray) -> np.ndarray:
+    out = mask.copy()
+    out[1:] |= mask[:-1]
+    out[:-1] |= mask[1:]
+    return out
+
+
+def dirty_days(old: Timeline, new: Timeline) -> set[int]:
+    """
+    Days (epoch-minute // DAY) that need gap filling again: the days touched
+    by changed rows, their neighbours, and the neighbours of removed rows.
+    """
+    if not len(new):
+        return set()
+    changed, removed = diff_rows(old, new)
+    touched = with_neighbours(changed)
+    for start, _, _ in removed:
+        i = int(np.searchsorted(new.start, start))
+        touched[max(i - 1, 0):min(i + 1, len(new) - 1) + 1] = True
+    end = new.effective_end()
+    days = set((new.start[touched] // DAY).tolist()) | set((end[touched] // DAY).tolist())
+    days |= {int(s // DAY) for s, _, _ in removed} | {int(e // DAY) for _, e, _ in removed}
+    return {int(d) for d in days}
+
+
+def rows_on_days(tl: Timeline, days: set[int]) -> np.ndarray:
+    return np.isin(tl.start // DAY, np.fromiter(days, dtype=np.int64, count=len(days)))
+
+
+def stitch(previous: Timeline, refilled: Timeline, days: set[int]) -> Timeline:
+    """Previous gap-filled rows outside `days` plus the freshly filled rows for `days`."""
+    kept = previous[~rows_on_days(previous, days)]
+    return Timeline.concat([kept, refilled]).sorted()
+
+
+def reusable_decisions(previous_tl: Timeline, previous_rows: list[dict], timeline: Timeline) -> list[Optional[dict]]:
+    """
+    Per row of `timeline`, the stored decision for the identical previous row,
+    or None where the row changed or sits next to a changed row. Rule-only
+    fallback decisions are never reused.
+    """
+    if len(previous_rows) != len(previous_tl):
+        return [None] * len(timeline)
+    by_key = {}
+    for key, row in zip(row_keys(previous_tl), previous_rows):
+        by_key.setdefault(key, []).append(None if row["clause"] == FALLBACK_CLAUSE else row)
+
+    matched = []
+    for key in row_keys(timeline):
+        rows = by_key.get(key)
+        matched.append(rows.pop(0) if rows else None)
+    recompute = with_neighbours(np.array([m is None for m in matched], dtype=bool))
+
+    return [
+        None if recompute[i] else {
+            "Remark": m["remark"],
+            "Clause": m["clause"],
+            "deduct": bool(m["deduct"]),
+            "confidence_score": m["confidence"],
+            "reason": m["reason"],
+        }
+        for i, m in enumerate(matched)
+    ]
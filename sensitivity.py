@@ -0,0 +1,174 @@
+# sensitivity.py
+
+import io
+import itertools
+from typing import Optional, Sequence
+
+import numpy as np
+import pandas as pd
+
+from event_model import Timeline
+from excel_exporter import parse_number
+from pipeline import extract_nor_delay_hours, COMMENCE_PATTERN
+
+# ---------- CONFIG ----------
+DAY = 1440
+MAX_TOGGLES = 10                 # 2**10 deduction combinations at most
+DEFAULT_TOGGLES = 3              # longest deducted rows offered as toggles by default
+DELAY_STEPS = (0.0, 0.5, 1.0, 1.5, 2.0)          # × contract NOR delay
+DISRATE_STEPS = (0.8, 0.9, 1.0, 1.1, 1.2)        # × contract disrate
+RATE_STEPS = (0.9, 1.0, 1.1)                     # × contract demurrage / despatch rate
+NOR_ROW_PATTERN = r"Notice of Readiness period"
+
+
+class SensitivityGrid:
+    """
+    What-if laytime outcomes over a grid of NOR delay, disrate, demurrage and
+    despatch rates and deduction toggles, computed in one broadcast from the
+    timeline's per-row counted minutes. `amount` is positive for demurrage
+    payable and negative for despatch earned, shape
+    (delays, disrates, demurrage rates, despatch rates, toggle combinations).
+    """
+
+    def __init__(self, timeline: Timeline, deduct_mask: np.ndarray, quantity: float,
+                 nor_delays: Sequence[float], disrates: Sequence[float],
+                 demurrage_rates: Sequence[float], despatch_rates: Sequence[float],
+                 toggle_rows: Sequence[int] = (), calendar=None, first_commence: Optional[int] = None):
+        if len(toggle_rows) > MAX_TOGGLES:
+            raise ValueError(f"At most {MAX_TOGGLES} deductions can be toggled ({2 ** MAX_TOGGLES} combinations)")
+
+        self.timeline = timeline
+        self.nor_delays = np.asarray(nor_delays, dtype=float)
+        self.disrates = np.asarray(disrates, dtype=float)
+        self.demurrage_rates = np.asarray(demurrage_rates, dtype=float)
+        self.despatch_rates = np.asarray(despatch_rates, dtype=float)
+        self.toggle_rows = list(toggle_rows)
+
+        start = timeline.start
+        end = timeline.effective_end()
+        nor_rows = timeline.matches(NOR_ROW_PATTERN, "reason")
+        tender = int(start[nor_rows].min()) if nor_rows.any() else int(start[0])
+
+        # Laytime start per delay: tender + delay, or first commencement if earlier
+        laytime_start = tender + np.round(self.nor_delays * 60).astype(np.int64)
+        if first_commence is not None:
+            laytime_start = np.minimum(laytime_start, first_commence)
+
+        # Counted minutes of every row once clipped to each laytime start (delays × rows)
+        s = np.maximum(start[None, :], laytime_start[:, None])
+        e = np.maximum(end[None, :], s)
+        counted = calendar.counted_minutes(s, e) if calendar is not None else e - s
+
+        # The NOR row's own exclusion is what the delay axis replaces
+        base = np.asarray(deduct_mask, dtype=bool) & ~nor_rows
+        self.flips = np.array(list(itertools.product([False, True], repeat=len(self.toggle_rows))), dtype=bool)
+        deducted = np.repeat(base[None, :], len(self.flips), axis=0)
+        if self.toggle_rows:
+            deducted[:, self.toggle_rows] ^= self.flips
+
+        # Used laytime in days (delays × toggles), then broadcast over the rate axes
+        used = (counted.astype(float) @ (~deducted).T.astype(float)) / DAY
+        allowed = np.where(self.disrates > 0, quantity / np.where(self.disrates > 0, self.disrates, 1), np.nan)
+
+        self.used_days = used[:, None, None, None, :]
+        self.allowed_days = allowed[None, :, None, None, None]
+        self.balance_days = self.used_days - self.allowed_days
+        self.amount = np.where(
+            self.balance_days > 0,
+            self.balance_days * self.demurrage_rates[None, None, :, None, None],
+            self.balance_days * self.despatch_rates[None, None, None, :, None],
+        )
+
+    @property
+    def shape(self) -> tuple:
+        return self.amount.shape
+
+    def toggle_labels(self) -> list[str]:
+        """One label per toggle combination, naming the rows whose deduction was flipped."""
+        labels = []
+        for flip in self.flips:
+            flipped = [
+                f"#{r} {self.timeline.reason[r][:30]}"
+                for r, f in zip(self.toggle_rows, flip) if f
+            ]
+            labels.append("flipped: " + "; ".join(flipped) if flipped else "as analysed")
+        return labels
+
+    def to_frame(self) -> pd.DataFrame:
+        """One row per scenario."""
+        idx = np.indices(self.shape).reshape(len(self.shape), -1)
+        full = lambda a: np.broadcast_to(a, self.shape).ravel()
+        return pd.DataFrame({
+            "nor_delay_h": self.nor_delays[idx[0]],
+            "disrate": self.disrates[idx[1]],
+            "demurrage_rate": self.demurrage_rates[idx[2]],
+            "despatch_rate": self.despatch_rates[idx[3]],
+            "toggles": np.array(self.toggle_labels(), dtype=object)[idx[4]],
+            "time_used_days": full(self.used_days),
+            "time_allowed_days": full(self.allowed_days),
+            "balance_days": full(self.balance_days),
+            "amount": self.amount.ravel(),
+        })
+
+    def heatmap(self, demurrage_idx: int = 0, despatch_idx: int = 0, toggle_idx: int = 0) -> pd.DataFrame:
+        """Amount by NOR delay (rows) × disrate (columns) for one rate / toggle slice."""
+        return pd.DataFrame(
+            self.amount[:, :, demurrage_idx, despatch_idx, toggle_idx],
+            index=pd.Index(self.nor_delays, name="nor_delay_h"),
+            columns=pd.Index(self.disrates, name="disrate"),
+        )
+
+    def to_csv_bytes(self) -> bytes:
+        buf = io.StringIO()
+        self.to_frame().to_csv(buf, index=False)
+        return buf.getvalue().encode("utf-8")
+
+
+def _around(base: float, steps: Sequence[float]) -> list[float]:
+    return sorted({round(base * s, 2) for s in steps}) if base else [0.0]
+
+
+def sensitivity_from_result(result: dict, nor_delays: Sequence[float] = None, disrates: Sequence[float] = None,
+                            demurrage_rates: Sequence[float] = None, despatch_rates: Sequence[float] = None,
+                            toggle_rows: Sequence[int] = None) -> Optional[SensitivityGrid]:
+    """
+    Sensitivity grid for a run_voyage() result. Axes default to steps around
+    the contract values, and the longest deducted rows are offered as toggles.
+    Returns None when the timeline and deductions don't line up.
+    """
+    tl: Timeline = result.get("timeline")
+    deductions = result.get("deductions") or []
+    if tl is None or not len(tl) or len(tl) != len(deductions):
+        return None
+
+    md = result.get("metadata") or {}
+    deduct_mask = np.array([bool(d.get("deduct", False)) for d in deductions])
+
+    if nor_delays is None:
+        base_delay = extract_nor_delay_hours(str(md.get("LTC AT") or ""))
+        nor_delays = _around(base_delay, DELAY_STEPS) if base_delay else [0.0, 6.0, 12.0, 24.0]
+    if disrates is None:
+        disrates = _around(parse_number(md.get("DISRATE", "")), DISRATE_STEPS)
+    if demurrage_rates is None:
+        demurrage_rates = _around(parse_number(md.get("DEMMURAGE", "")), RATE_STEPS)
+    if despatch_rates is None:
+        despatch_rates = _around(parse_number(md.get("DESPATCH", "")), RATE_STEPS)
+    if toggle_rows is None:
+        candidates = np.flatnonzero(deduct_mask & ~tl.matches(NOR_ROW_PATTERN, "reason"))
+        longest = candidates[np.argsort(-tl.durations()[candidates], kind="stable")][:DEFAULT_TOGGLES]
+        toggle_rows = sorted(int(r) for r in longest)
+
+    # Discharge can start before NOR + delay; that cap holds whatever the delay
+    first_commence = None
+    blocks: Timeline = result.get("blocks")
+    if blocks is not None and len(blocks):
+        field = "phase" if blocks.has_phase else "reason"
+        mask = blocks.matches(COMMENCE_PATTERN, field)
+        if mask.any():
+            first_commence = int(blocks.start[mask].min())
+
+    return SensitivityGrid(
+        tl, deduct_mask, parse_number(md.get("Quantity", "")),
+        nor_delays, disrates, demurrage_rates, despatch_rates,
+        toggle_rows=toggle_rows, calendar=result.get("calendar"), first_commence=first_commence,
+    )
@@ -0,0 +1,465 @@
+# service.py
+
+import os
+import re
+import sys
+import json
+import uuid
+import base64
+import shutil
+import threading
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional
+
+import numpy as np
+
+from pipeline import ConsoleUI, run_voyage
+from store import VoyageStore
+from deadlines import RunBudget, Cancelled
+from result_export import export_result, MIME_TYPES
+from sensitivity import sensitivity_from_result
+from metrics import METRICS
+from hedging import HEDGER
+from deduction_model import maybe_retrain
+
+# ---------- CONFIG ----------
+HOST = os.getenv("LAYTIME_HOST", "127.0.0.1")
+PORT = int(os.getenv("LAYTIME_PORT", "8765"))
+WORKERS = int(os.getenv("LAYTIME_WORKERS", "2"))
+JOBS_DIR = os.getenv("LAYTIME_JOBS_DIR", "laytime_jobs")
+POLL_SECONDS = 0.5                      # idle workers look for new jobs this often
+MAX_BODY_BYTES = 200 * 1024 * 1024      # largest accepted submit request
+THROUGHPUT_WINDOW_MINUTES = 15
+JOB_TTL_HOURS = float(os.getenv("LAYTIME_JOB_TTL_HOURS", "24"))     # finished jobs' outputs are kept this long
+SWEEP_SECONDS = 600                     # how often expired job directories are looked for
+FINAL_STATES = ("done", "failed", "cancelled")
+
+JOBS_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id           TEXT PRIMARY KEY,
+    state        TEXT NOT NULL,          -- queued | running | done | failed | cancelled
+    created_at   TEXT NOT NULL,
+    started_at   TEXT,
+    finished_at  TEXT,
+    worker       TEXT,
+    files        TEXT NOT NULL,          -- JSON [[name, path], ...]
+    voyage_id    TEXT,
+    artifacts    TEXT,                   -- JSON {format: path}
+    summary      TEXT,                   -- JSON summary / degraded / revision
+    error        TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_jobs_state ON jobs(state, created_at);
+"""
+
+STATES = ("queued", "running", "done", "failed", "cancelled")
+
+
+def _now() -> str:
+    return datetime.now().isoformat(timespec="milliseconds")
+
+
+class JobQueue:
+    """Voyage jobs persisted in the store's SQLite DB, so queued work survives restarts."""
+
+    def __init__(self, store: VoyageStore, jobs_dir: str = JOBS_DIR):
+        self.store = store
+        self.jobs_dir = jobs_dir
+        os.makedirs(jobs_dir, exist_ok=True)
+        self.store.conn().executescript(JOBS_SCHEMA)
+
+    def job_dir(self, job_id: str) -> str:
+        return os.path.join(self.jobs_dir, job_id)
+
+    # ---------- Producer side ----------
+    def submit(self, files: list[tuple[str, bytes]]) -> str:
+        """Queue a voyage from in-memory files [(name, bytes)]; returns the job id."""
+        job_id = uuid.uuid4().hex
+        input_dir = os.path.join(self.job_dir(job_id), "input")
+        os.makedirs(input_dir, exist_ok=True)
+        paths = []
+        for i, (name, data) in enumerate(files):
+            name = os.path.basename(name) or f"upload_{i}"
+            # Index prefix: two uploads with the same name must not overwrite each other
+            path = os.path.join(input_dir, f"{i:02d}_{name}")
+            with open(path, "wb") as f:
+                f.write(data)
+            paths.append((name, path))
+        return self._insert(job_id, paths)
+
+    def _insert(self, job_id: str, files: list) -> str:
+        c = self.store.conn()
+        with c:
+            c.execute(
+                "INSERT INTO jobs (id, state, created_at, files) VALUES (?, 'queued', ?, ?)",
+                (job_id, _now(), json.dumps(files)),
+            )
+        METRICS.incr("jobs.submitted")
+        return job_id
+
+    # ---------- Worker side ----------
+    def claim(self, worker: str) -> Optional[dict]:
+        """Take the oldest queued job, or None. Safe across threads and processes."""
+        c = self.store.conn()
+        while True:
+            row = c.execute("SELECT id FROM jobs WHERE state = 'queued' ORDER BY created_at LIMIT 1").fetchone()
+            if row is None:
+                return None
+            with c:
+                cur = c.execute(
+                    "UPDATE jobs SET state = 'running', started_at = ?, worker = ? WHERE id = ? AND state = 'queued'",
+                    (_now(), worker, row[0]),
+                )
+            if cur.rowcount:
+                return self.get(row[0])
+            # Another worker got it first; try the next one
+
+    def finish(self, job_id: str, voyage_id: Optional[str], artifacts: dict, summary: dict):
+        c = self.store.conn()
+        with c:
+            c.execute(
+                "UPDATE jobs SET state = 'done', finished_at = ?, voyage_id = ?, artifacts = ?, summary = ? WHERE id = ?",
+                (_now(), voyage_id, json.dumps(artifacts), json.dumps(summary, default=str), job_id),
+            )
+        self.discard_input(job_id)
+        METRICS.incr("jobs.done")
+
+    def fail(self, job_id: str, error: str, state: str = "failed"):
+        c = self.store.conn()
+        with c:
+            c.execute(
+                "UPDATE jobs SET state = ?, finished_at = ?, error = ? WHERE id = ?",
+                (state, _now(), error, job_id),
+            )
+        self.discard_input(job_id)
+        METRICS.incr(f"jobs.{state}")
+
+    def cancel_queued(self, job_id: str) -> bool:
+        c = self.store.conn()
+        with c:
+            cur = c.execute(
+                "UPDATE jobs SET state = 'cancelled', finished_at = ? WHERE id = ? AND state = 'queued'",
+                (_now(), job_id),
+            )
+        if cur.rowcount:
+            self.discard_input(job_id)
+        return bool(cur.rowcount)
+
+    # ---------- Cleanup ----------
+    def discard_input(self, job_id: str):
+        """A job in a final state no longer needs its uploaded files."""
+        shutil.rmtree(os.path.join(self.job_dir(job_id), "input"), ignore_errors=True)
+
+    def expire(self, ttl_hours: float = JOB_TTL_HOURS) -> int:
+        """Remove the directories (and so the downloads) of jobs finished more than `ttl_hours` ago."""
+        cutoff = datetime.now() - timedelta(hours=ttl_hours)
+        before = cutoff.isoformat(timespec="milliseconds")
+        removed = 0
+        for job_id in os.listdir(self.jobs_dir):
+            job = self.get(job_id)
+            if job is None:
+                # Left by a crash between writing the uploads and queueing the job
+                expired = datetime.fromtimestamp(os.path.getmtime(self.job_dir(job_id))) < cutoff
+            else:
+                expired = job["state"] in FINAL_STATES and (job["finished_at"] or "") < before
+            if not expired:
+                continue
+            shutil.rmtree(self.job_dir(job_id), ignore_errors=True)
+            if job is not None and job["artifacts"]:
+                c = self.store.conn()
+                with c:
+                    c.execute("UPDATE jobs SET artifacts = NULL WHERE id = ?", (job_id,))
+            removed += 1
+        return removed
+
+    def requeue_orphans(self) -> int:
+        """Jobs left 'running' by a server that died go back to the queue."""
+        c = self.store.conn()
+        with c:
+            cur = c.execute("UPDATE jobs SET state = 'queued', started_at = NULL, worker = NULL WHERE state = 'running'")
+        return cur.rowcount
+
+    # ---------- Queries ----------
+    def get(self, job_id: str) -> Optional[dict]:
+        row = self.store.conn().execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if row is None:
+            return None
+        job = dict(row)
+        for key in ("files", "artifacts", "summary"):
+            job[key] = json.loads(job[key]) if job[key] else None
+        if job["state"] == "queued":
+            job["position"] = self.store.conn().execute(
+                "SELECT COUNT(*) FROM jobs WHERE state = 'queued' AND created_at <= ?", (job["created_at"],)
+            ).fetchone()[0]
+        return job
+
+    def stats(self) -> dict:
+        c = self.store.conn()
+        counts = dict.fromkeys(STATES, 0)
+        counts.update({r[0]: r[1] for r in c.execute("SELECT state, COUNT(*) FROM jobs GROUP BY state")})
+        since = (datetime.now() - timedelta(minutes=THROUGHPUT_WINDOW_MINUTES)).isoformat(timespec="milliseconds")
+        recent = c.execute(
+            "SELECT started_at, finished_at FROM jobs WHERE state = 'done' AND finished_at >= ?", (since,)
+        ).fetchall()
+        durations = np.array([
+            (datetime.fromisoformat(f) - datetime.fromisoformat(s)).total_seconds() for s, f in recent if s and f
+        ])
+        return {
+            "queue_depth": counts["queued"],
+            "running": counts["running"],
+            "jobs": counts,
+            "throughput_per_minute": len(recent) / THROUGHPUT_WINDOW_MINUTES,
+            "job_seconds_p50": float(np.percentile(durations, 50)) if durations.size else None,
+            "job_seconds_p95": float(np.percentile(durations, 95)) if durations.size else None,
+        }
+
+
+class WorkerPool:
+    """Threads that take jobs off the queue and run them through the pipeline."""
+
+    def __init__(self, queue: JobQueue, store: VoyageStore, workers: int = WORKERS):
+        self.queue = queue
+        self.store = store
+        self.workers = workers
+        self.budgets = {}
+        self._stop = threading.Event()
+        self._threads = []
+
+    def start(self):
+        for n in range(self.workers):
+            t = threading.Thread(target=self._loop, args=(f"worker-{n}",), name=f"laytime-worker-{n}", daemon=True)
+            t.start()
+            self._threads.append(t)
+        t = threading.Thread(target=self._sweep, name="laytime-job-sweeper", daemon=True)
+        t.start()
+        self._threads.append(t)
+
+    def stop(self):
+        self._stop.set()
+        for budget in list(self.budgets.values()):
+            budget.cancel()
+        for t in self._threads:
+            t.join()
+
+    def cancel(self, job_id: str) -> bool:
+        if self.queue.cancel_queued(job_id):
+            return True
+        budget = self.budgets.get(job_id)
+        if budget is not None:
+            budget.cancel()
+            return True
+        return False
+
+    def _loop(self, name: str):
+        while not self._stop.is_set():
+            job = self.queue.claim(name)
+            if job is None:
+                self._stop.wait(POLL_SECONDS)
+                continue
+            self.run(job)
+
+    def _sweep(self):
+        """Housekeeping between jobs: expire old job files, retrain the learned deduction classifier."""
+        while not self._stop.is_set():
+            try:
+                expired = self.queue.expire()
+                if expired:
+                    print(f"🧹 Removed the files of {expired} jobs finished over {JOB_TTL_HOURS:g} h ago")
+            except Exception as e:
+                print(f"⚠️ Job cleanup failed: {e}")
+            try:
+                report = maybe_retrain(self.store)
+                if report is not None:
+                    print(f"🧠 Retrained the deduction classifier: accuracy {report.get('accuracy')}, "
+                          f"coverage {report.get('coverage')}")
+            except Exception as e:
+                print(f"⚠️ Deduction classifier retrain failed: {e}")
+            self._stop.wait(SWEEP_SECONDS)
+
+    def run(self, job: dict):
+        job_id = job["id"]
+        budget = RunBudget()
+        self.budgets[job_id] = budget
+        try:
+            result = run_voyage([tuple(f) for f in job["files"]], ConsoleUI(), self.store, budget=budget)
+            if result is None:
+                self.queue.fail(job_id, "Required documents missing or unreadable")
+                return
+            artifacts = self.write_artifacts(job_id, result)
+            summary = {
+                "summary": result.get("summary"),
+                "degraded": result.get("degraded"),
+                "revision": result.get("revision"),
+                "metrics": {k: v for k, v in (result.get("metrics") or {}).items() if k != "model_calls"},
+            }
+            self.queue.finish(job_id, result.get("voyage_id"), artifacts, summary)
+        except Cancelled:
+            self.queue.fail(job_id, "Cancelled", state="cancelled")
+        except Exception as e:
+            print(f"❌ Job {job_id} failed: {e}")
+            self.queue.fail(job_id, str(e))
+        finally:
+            self.budgets.pop(job_id, None)
+
+    def write_artifacts(self, job_id: str, result: dict) -> dict:
+        """Exports written next to the job so downloads survive a restart."""
+        out_dir = os.path.join(self.queue.job_dir(job_id), "output")
+        os.makedirs(out_dir, exist_ok=True)
+        exports = export_result(result)
+        grid = sensitivity_from_result(result)
+        if grid is not None:
+            exports["sensitivity"] = grid.to_csv_bytes()
+        artifacts = {}
+        for fmt, data in exports.items():
+            name = "sensitivity.csv" if fmt == "sensitivity" else f"result.{fmt}"
+            path = os.path.join(out_dir, name)
+            tmp = f"{path}.tmp"
+            with open(tmp, "wb") as f:
+                f.write(data)
+            os.replace(tmp, path)
+            artifacts[fmt] = path
+        return artifacts
+
+
+# ---------- HTTP ----------
+ROUTES = [
+    ("POST", re.compile(r"^/jobs$"), "submit"),
+    ("GET", re.compile(r"^/jobs/(\w+)$"), "status"),
+    ("GET", re.compile(r"^/jobs/(\w+)/result$"), "result"),
+    ("GET", re.compile(r"^/jobs/(\w+)/download/(\w+)$"), "download"),
+    ("POST", re.compile(r"^/jobs/(\w+)/cancel$"), "cancel"),
+    ("GET", re.compile(r"^/metrics$"), "metrics"),
+]
+
+
+class ServiceHandler(BaseHTTPRequestHandler):
+    """
+    POST /jobs                     {"files": [{"name", "data" (base64)}]}
+    GET  /jobs/<id>                status (state, queue position, summary, error)
+    GET  /jobs/<id>/result         the JSON export
+    GET  /jobs/<id>/download/<fmt> xlsx | csv | json | parquet | sensitivity
+    POST /jobs/<id>/cancel
+    GET  /metrics                  queue depth, throughput, stage timings
+    """
+
+    queue: JobQueue = None
+    pool: WorkerPool = None
+
+    def log_message(self, fmt, *args):
+        pass
+
+    def _send(self, status: int, body: bytes, content_type: str = "application/json", headers: dict = None):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _json(self, status: int, payload):
+        self._send(status, json.dumps(payload, default=str).encode("utf-8"))
+
+    def _route(self, method: str):
+        for m, pattern, name in ROUTES:
+            match = pattern.match(self.path.split("?", 1)[0])
+            if m == method and match:
+                try:
+                    return getattr(self, f"handle_{name}")(*match.groups())
+                except Exception as e:
+                    return self._json(500, {"error": str(e)})
+        self._json(404, {"error": f"No route for {method} {self.path}"})
+
+    def do_GET(self):
+        self._route("GET")
+
+    def do_POST(self):
+        self._route("POST")
+
+    def handle_submit(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        if length > MAX_BODY_BYTES:
+            return self._json(413, {"error": "Request too large"})
+        try:
+            body = json.loads(self.rfile.read(length) or b"{}")
+        except json.JSONDecodeError as e:
+            return self._json(400, {"error": f"Invalid JSON: {e}"})
+        if not body.get("files"):
+            return self._json(400, {"error": "Provide 'files'"})
+        job_id = self.queue.submit([(f["name"], base64.b64decode(f["data"])) for f in body["files"]])
+        self._json(202, {"job_id": job_id, "status_url": f"/jobs/{job_id}"})
+
+    def handle_status(self, job_id):
+        job = self.queue.get(job_id)
+        if job is None:
+            return self._json(404, {"error": "Unknown job"})
+        job.pop("files", None)
+        job["downloads"] = {fmt: f"/jobs/{job_id}/download/{fmt}" for fmt in (job.pop("artifacts") or {})}
+        self._json(200, job)
+
+    def _artifact(self, job_id, fmt) -> Optional[str]:
+        job = self.queue.get(job_id)
+        if job is None or job["state"] != "done":
+            self._json(404 if job is None else 409, {"error": "Unknown job" if job is None else f"Job is {job['state']}"})
+            return None
+        path = (job["artifacts"] or {}).get(fmt)
+        if not path or not os.path.exists(path):
+            self._json(404, {"error": f"No {fmt} output for this job"})
+            return None
+        return path
+
+    def handle_result(self, job_id):
+        path = self._artifact(job_id, "json")
+        if path:
+            with open(path, "rb") as f:
+                self._send(200, f.read())
+
+    def handle_download(self, job_id, fmt):
+        path = self._artifact(job_id, fmt)
+        if path:
+            with open(path, "rb") as f:
+                self._send(200, f.read(), MIME_TYPES.get(fmt, "text/csv"),
+                           {"Content-Disposition": f'attachment; filename="{os.path.basename(path)}"'})
+
+    def handle_cancel(self, job_id):
+        if self.pool.cancel(job_id):
+            return self._json(202, {"job_id": job_id, "cancelling": True})
+        self._json(409, {"error": "Job is not queued or running here"})
+
+    def handle_metrics(self):
+        self._json(200, {
+            "queue": self.queue.stats(),
+            "workers": self.pool.workers,
+            "pipeline": METRICS.snapshot(),
+            "model_calls": HEDGER.report(),
+        })
+
+
+def serve(host: str = HOST, port: int = PORT, workers: int = WORKERS):
+    store = VoyageStore()
+    queue = JobQueue(store)
+    requeued = queue.requeue_orphans()
+    if requeued:
+        print(f"♻️ Re-queued {requeued} jobs left running by a previous server")
+    pool = WorkerPool(queue, store, workers)
+    pool.start()
+
+    ServiceHandler.queue, ServiceHandler.pool = queue, pool
+    server = ThreadingHTTPServer((host, port), ServiceHandler)
+    print(f"🚢 Laytime service on http://{host}:{port} with {workers} workers")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        pool.stop()
+        store.close()
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    serve(
+        port=int(args[0]) if args else PORT,
+        workers=int(args[1]) if len(args) > 1 else WORKERS,
+    )
@@ -0,0 +1,62 @@
+# service_client.py
+
+import os
+import time
+import base64
+from typing import Callable, Optional
+
+import requests
+
+# ---------- CONFIG ----------
+SERVICE_URL = os.getenv("LAYTIME_SERVICE_URL", "")
+POLL_SECONDS = 2.0
+FINAL_STATES = ("done", "failed", "cancelled")
+
+
+class ServiceClient:
+    """Small client for service.py: submit a voyage, follow it, fetch its outputs."""
+
+    def __init__(self, url: str = SERVICE_URL, timeout: float = 60):
+        self.url = url.rstrip("/")
+        self.timeout = timeout
+
+    def _get(self, path: str) -> requests.Response:
+        r = requests.get(f"{self.url}{path}", timeout=self.timeout)
+        r.raise_for_status()
+        return r
+
+    def submit_files(self, files: list[tuple[str, bytes]]) -> str:
+        payload = {"files": [{"name": name, "data": base64.b64encode(data).decode("ascii")} for name, data in files]}
+        r = requests.post(f"{self.url}/jobs", json=payload, timeout=self.timeout)
+        r.raise_for_status()
+        return r.json()["job_id"]
+
+    def status(self, job_id: str) -> dict:
+        return self._get(f"/jobs/{job_id}").json()
+
+    def result(self, job_id: str) -> dict:
+        return self._get(f"/jobs/{job_id}/result").json()
+
+    def download(self, job_id: str, fmt: str) -> bytes:
+        return self._get(f"/jobs/{job_id}/download/{fmt}").content
+
+    def cancel(self, job_id: str) -> bool:
+        r = requests.post(f"{self.url}/jobs/{job_id}/cancel", timeout=self.timeout)
+        return r.status_code == 202
+
+    def metrics(self) -> dict:
+        return self._get("/metrics").json()
+
+    def wait(self, job_id: str, on_update: Optional[Callable[[dict], None]] = None,
+             poll: float = POLL_SECONDS, timeout: Optional[float] = None) -> dict:
+        """Poll until the job finishes; returns its final status."""
+        end = None if timeout is None else time.monotonic() + timeout
+        while True:
+            job = self.status(job_id)
+            if on_update is not None:
+                on_update(job)
+            if job["state"] in FINAL_STATES:
+                return job
+            if end is not None and time.monotonic() > end:
+                raise TimeoutError(f"Job {job_id} still {job['state']} after {timeout}s")
+            time.sleep(poll)
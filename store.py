@@ -0,0 +1,427 @@
+# store.py
+
+import os
+import json
+import uuid
+import queue
+import sqlite3
+import threading
+from datetime import datetime
+from typing import Optional
+
+import numpy as np
+
+from event_model import MISSING, Timeline, parse_minutes, to_minutes
+
+# ---------- CONFIG ----------
+DB_PATH = os.getenv("LAYTIME_DB", "laytime.db")
+REVISION_WINDOW_HOURS = 72      # a revised SoF's events start within this of the stored version's
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS voyages (
+    id              TEXT PRIMARY KEY,
+    created_at      TEXT NOT NULL,
+    vessel          TEXT,
+    port            TEXT,
+    charterer       TEXT,
+    product         TEXT,
+    terms           TEXT,
+    quantity        TEXT,
+    disrate         TEXT,
+    demurrage_rate  TEXT,
+    despatch_rate   TEXT,
+    laytime_start   INTEGER,            -- epoch minutes
+    metadata        TEXT                -- full header metadata as JSON
+);
+CREATE INDEX IF NOT EXISTS idx_voyages_vessel    ON voyages(vessel);
+CREATE INDEX IF NOT EXISTS idx_voyages_port      ON voyages(port);
+CREATE INDEX IF NOT EXISTS idx_voyages_charterer ON voyages(charterer);
+CREATE INDEX IF NOT EXISTS idx_voyages_start     ON voyages(laytime_start);
+CREATE INDEX IF NOT EXISTS idx_voyages_created   ON voyages(created_at);
+
+CREATE TABLE IF NOT EXISTS documents (
+    hash        TEXT PRIMARY KEY,        -- sha256 of the uploaded file
+    doc_type    TEXT,
+    file_name   TEXT,
+    size        INTEGER,
+    data        TEXT,                    -- extracted JSON
+    created_at  TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_documents_type ON documents(doc_type);
+
+CREATE TABLE IF NOT EXISTS voyage_documents (
+    voyage_id   TEXT NOT NULL,
+    hash        TEXT NOT NULL,
+    PRIMARY KEY (voyage_id, hash)
+);
+
+CREATE TABLE IF NOT EXISTS events (
+    voyage_id   TEXT NOT NULL,
+    seq         INTEGER NOT NULL,
+    start_min   INTEGER NOT NULL,
+    end_min     INTEGER,
+    reason      TEXT,
+    phase       TEXT,
+    source      TEXT,
+    PRIMARY KEY (voyage_id, seq)
+);
+CREATE INDEX IF NOT EXISTS idx_events_start ON events(start_min);
+
+-- gap-filling input (NOR-split document events), diffed when a revised SoF arrives
+CREATE TABLE IF NOT EXISTS input_events (
+    voyage_id   TEXT NOT NULL,
+    seq         INTEGER NOT NULL,
+    start_min   INTEGER NOT NULL,
+    end_min     INTEGER,
+    reason      TEXT,
+    phase       TEXT,
+    source      TEXT,
+    PRIMARY KEY (voyage_id, seq)
+);
+
+CREATE TABLE IF NOT EXISTS revisions (
+    voyage_id        TEXT PRIMARY KEY,
+    previous_id      TEXT NOT NULL,
+    recomputed_rows  INTEGER,
+    total_rows       INTEGER
+);
+CREATE INDEX IF NOT EXISTS idx_revisions_previous ON revisions(previous_id);
+
+CREATE TABLE IF NOT EXISTS deductions (
+    voyage_id   TEXT NOT NULL,
+    seq         INTEGER NOT NULL,
+    start_min   INTEGER,
+    end_min     INTEGER,
+    remark      TEXT,
+    clause      TEXT,
+    deduct      INTEGER,
+    confidence  REAL,
+    reason      TEXT,
+    hours       REAL,
+    origin      TEXT,                   -- model | analyst | revision | template | pumping_log | learned | fallback
+    PRIMARY KEY (voyage_id, seq)
+);
+CREATE INDEX IF NOT EXISTS idx_deductions_remark ON deductions(remark);
+CREATE INDEX IF NOT EXISTS idx_deductions_start  ON deductions(start_min);
+
+CREATE TABLE IF NOT EXISTS results (
+    voyage_id        TEXT PRIMARY KEY,
+    total_hours      REAL,
+    deduction_hours  REAL,
+    net_hours        REAL,
+    allowed_days     REAL,
+    expiry           INTEGER,            -- epoch minutes laytime ran out, NULL if never
+    demurrage_hours  REAL
+);
+"""
+
+
+def _none_if_missing(v):
+    return None if v is None or v == MISSING else int(v)
+
+
+def _float_or_none(v):
+    try:
+        return float(v)
+    except (TypeError, ValueError):
+        return None
+
+
+def _identity(v) -> str:
+    # Same normalisation as lower(trim(...)) in SQL
+    return str(v or "").strip().lower()
+
+
+def _minutes_or_none(v) -> Optional[int]:
+    try:
+        return parse_minutes(v)
+    except (ValueError, OverflowError):
+        return None
+
+
+def _event_rows(tl: Timeline, voyage_id: str) -> list[tuple]:
+    return [
+        (voyage_id, i, int(tl.start[i]), _none_if_missing(tl.end[i]), tl.reason[i], tl.phase[i], tl.source[i])
+        for i in range(len(tl))
+    ]
+
+
+def voyage_rows(result: dict, voyage_id: str) -> dict:
+    """
+    Snapshot a run_voyage() result into plain row tuples per table. Cheap
+    enough to do on the request thread; the inserts happen on the writer.
+    """
+    md = result.get("metadata") or {}
+    tl: Timeline = result.get("timeline") or Timeline()
+    deductions = result.get("deductions") or []
+    summary = result.get("summary") or {}
+    now = datetime.now().isoformat(timespec="seconds")
+
+    voyage = (
+        voyage_id, now,
+        md.get("Vessel Name"), md.get("Port"), md.get("A/C") or md.get("Charterer"), md.get("PRODUCT"),
+        md.get("TERMS"), md.get("Quantity"), md.get("DISRATE"), md.get("DEMMURAGE"), md.get("DESPATCH"),
+        _none_if_missing(tl.end[0]) if len(tl) else None,
+        json.dumps(md, default=str),
+    )
+    documents = [
+        (d["hash"], d.get("doc_type"), d.get("file_name"), d.get("size"), json.dumps(d.get("data"), default=str), now)
+        for d in result.get("documents", [])
+    ]
+    links = [(voyage_id, d["hash"]) for d in result.get("documents", [])]
+    events = _event_rows(tl, voyage_id)
+    input_events = _event_rows(result.get("gap_input") or Timeline(), voyage_id)
+
+    aligned = len(deductions) == len(tl)
+    minutes = tl.durations() if aligned else None
+    deduction_rows = []
+    for i, d in enumerate(deductions):
+        deduction_rows.append((
+            voyage_id, i,
+            int(tl.start[i]) if aligned else None,
+            _none_if_missing(tl.end[i]) if aligned else None,
+            d.get("Remark"), d.get("Clause"), int(bool(d.get("deduct", False))),
+            _float_or_none(d.get("confidence_score")), d.get("reason"),
+            float(minutes[i]) / 60.0 if aligned else _float_or_none(d.get("total_hours")),
+            d.get("origin"),
+        ))
+
+    results = [(
+        voyage_id, summary.get("total_hours"), summary.get("deduction_hours"), summary.get("net_hours"),
+        summary.get("allowed_days"), summary.get("expiry"), summary.get("demurrage_hours"),
+    )] if summary else []
+
+    revision = result.get("revision")
+    revisions = [(
+        voyage_id, revision["previous_id"], revision["recomputed_rows"], revision["total_rows"],
+    )] if revision else []
+
+    return {"voyage": voyage, "documents": documents, "links": links, "events": events,
+            "input_events": input_events, "deductions": deduction_rows, "results": results,
+            "revisions": revisions}
+
+
+class VoyageStore:
+    """
+    Local SQLite (WAL) store for voyages, documents, events, deduction
+    decisions and results. Writes can be queued to a single background
+    writer so the app never waits on disk.
+    """
+
+    def __init__(self, path: str = DB_PATH):
+        self.path = path
+        self._local = threading.local()
+        self._queue = queue.Queue()
+        self._writer = None
+        self._lock = threading.Lock()
+        self.conn().executescript(SCHEMA)
+        # Stores created before decisions recorded their origin
+        if "origin" not in {r[1] for r in self.conn().execute("PRAGMA table_info(deductions)")}:
+            self.conn().execute("ALTER TABLE deductions ADD COLUMN origin TEXT")
+
+    def conn(self) -> sqlite3.Connection:
+        """One connection per thread."""
+        c = getattr(self._local, "conn", None)
+        if c is None:
+            c = sqlite3.connect(self.path, timeout=30)
+            c.row_factory = sqlite3.Row
+            c.execute("PRAGMA journal_mode=WAL")
+            c.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = c
+        return c
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.flush()
+        if self._writer is not None:
+            self._queue.put(None)
+            self._writer.join()
+            self._writer = None
+        c = getattr(self._local, "conn", None)
+        if c is not None:
+            c.close()
+            self._local.conn = None
+
+    # ---------- Writes ----------
+    def write_rows(self, rows: dict):
+        """Bulk insert one voyage snapshot in a single transaction."""
+        c = self.conn()
+        with c:
+            c.execute("INSERT OR REPLACE INTO voyages VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?)", rows["voyage"])
+            c.executemany("INSERT OR IGNORE INTO documents VALUES (?,?,?,?,?,?)", rows["documents"])
+            c.executemany("INSERT OR IGNORE INTO voyage_documents VALUES (?,?)", rows["links"])
+            c.executemany("INSERT OR REPLACE INTO events VALUES (?,?,?,?,?,?,?)", rows["events"])
+            c.executemany("INSERT OR REPLACE INTO input_events VALUES (?,?,?,?,?,?,?)", rows.get("input_events", []))
+            c.executemany("INSERT OR REPLACE INTO revisions VALUES (?,?,?,?)", rows.get("revisions", []))
+            c.executemany("INSERT OR REPLACE INTO deductions VALUES (?,?,?,?,?,?,?,?,?,?,?)", rows["deductions"])
+            c.executemany("INSERT OR REPLACE INTO results VALUES (?,?,?,?,?,?,?)", rows["results"])
+
+    def save_voyage(self, result: dict, voyage_id: Optional[str] = None) -> str:
+        voyage_id = voyage_id or uuid.uuid4().hex
+        self.write_rows(voyage_rows(result, voyage_id))
+        return voyage_id
+
+    def save_voyage_async(self, result: dict, voyage_id: Optional[str] = None) -> str:
+        """Snapshot now, insert on the background writer. Returns the voyage id immediately."""
+        voyage_id = voyage_id or uuid.uuid4().hex
+        self._queue.put(voyage_rows(result, voyage_id))
+        self._ensure_writer()
+        return voyage_id
+
+    def _ensure_writer(self):
+        with self._lock:
+            if self._writer is None or not self._writer.is_alive():
+                self._writer = threading.Thread(target=self._write_loop, name="voyage-store-writer", daemon=True)
+                self._writer.start()
+
+    def _write_loop(self):
+        while True:
+            rows = self._queue.get()
+            try:
+                if rows is None:
+                    return
+                self.write_rows(rows)
+            except sqlite3.Error as e:
+                print(f"❌ Failed to persist voyage {rows['voyage'][0]}: {e}")
+            finally:
+                self._queue.task_done()
+
+    def flush(self):
+        """Block until queued writes are on disk."""
+        if self._writer is not None:
+            self._queue.join()
+
+    # ---------- Queries ----------
+    def find_voyages(self, vessel: str = None, port: str = None, charterer: str = None,
+                     since: datetime = None, until: datetime = None, limit: int = 100) -> list[dict]:
+        """Voyages matching the given filters (exact match on names), newest laytime first."""
+        where, args = [], []
+        for col, val in (("vessel", vessel), ("port", port), ("charterer", charterer)):
+            if val is not None:
+                where.append(f"{col} = ?")
+                args.append(val)
+        if since is not None:
+            where.append("laytime_start >= ?")
+            args.append(to_minutes(since))
+        if until is not None:
+            where.append("laytime_start < ?")
+            args.append(to_minutes(until))
+        sql = "SELECT v.*, r.total_hours, r.deduction_hours, r.net_hours, r.allowed_days, r.expiry, r.demurrage_hours " \
+              "FROM voyages v LEFT JOIN results r ON r.voyage_id = v.id"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += " ORDER BY laytime_start DESC LIMIT ?"
+        args.append(limit)
+        return [dict(r) for r in self.conn().execute(sql, args)]
+
+    def get_voyage(self, voyage_id: str) -> Optional[dict]:
+        rows = self.conn().execute("SELECT * FROM voyages WHERE id = ?", (voyage_id,)).fetchall()
+        return dict(rows[0]) if rows else None
+
+    def events(self, voyage_id: str) -> Timeline:
+        """The final (gap-filled) timeline of a voyage."""
+        return self._timeline("events", voyage_id)
+
+    def input_events(self, voyage_id: str) -> Timeline:
+        """The events that went into gap filling for a voyage."""
+        return self._timeline("input_events", voyage_id)
+
+    def _timeline(self, table: str, voyage_id: str) -> Timeline:
+        rows = self.conn().execute(
+            f"SELECT start_min, end_min, reason, phase, source FROM {table} WHERE voyage_id = ? ORDER BY seq",
+            (voyage_id,),
+        ).fetchall()
+        return Timeline(
+            [r[0] for r in rows],
+            np.array([MISSING if r[1] is None else r[1] for r in rows], dtype=np.int64),
+            [r[2] or "" for r in rows],
+            [r[3] or "" for r in rows],
+            [r[4] or "" for r in rows],
+        )
+
+    def deductions(self, voyage_id: str) -> list[dict]:
+        return [dict(r) for r in self.conn().execute(
+            "SELECT * FROM deductions WHERE voyage_id = ? ORDER BY seq", (voyage_id,)
+        )]
+
+    def training_deductions(self, after_rowid: int = 0, limit: int = 100_000) -> list[dict]:
+        """Stored decisions (with their origin) added after `after_rowid`, the learned classifier's watermark; oldest first."""
+        self.flush()
+        return [dict(r) for r in self.conn().execute(
+            "SELECT rowid AS row_id, start_min, end_min, remark, clause, deduct, confidence, reason, origin "
+            "FROM deductions WHERE rowid > ? ORDER BY rowid LIMIT ?",
+            (after_rowid, limit),
+        )]
+
+    def deductions_since(self, after_rowid: int = 0) -> int:
+        """How many decisions were stored after `after_rowid`."""
+        self.flush()
+        return self.conn().execute("SELECT COUNT(*) FROM deductions WHERE rowid > ?", (after_rowid,)).fetchone()[0]
+
+    def search_deductions(self, remark: str = None, deduct: bool = None, vessel: str = None,
+                          port: str = None, charterer: str = None, limit: int = 500) -> list[dict]:
+        """Historical deduction decisions, e.g. every 'rain' remark at a port."""
+        where, args = [], []
+        if remark is not None:
+            where.append("d.remark LIKE ?")
+            args.append(f"%{remark}%")
+        if deduct is not None:
+            where.append("d.deduct = ?")
+            args.append(int(deduct))
+        for col, val in (("v.vessel", vessel), ("v.port", port), ("v.charterer", charterer)):
+            if val is not None:
+                where.append(f"{col} = ?")
+                args.append(val)
+        sql = "SELECT d.*, v.vessel, v.port, v.charterer FROM deductions d JOIN voyages v ON v.id = d.voyage_id"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += " ORDER BY d.start_min DESC LIMIT ?"
+        args.append(limit)
+        return [dict(r) for r in self.conn().execute(sql, args)]
+
+    def previous_voyage(self, vessel: str, port: str, first_event: Optional[int] = None,
+                        nor_tendered=None) -> Optional[str]:
+        """
+        The stored voyage a run revises: the most recent one with the same
+        vessel and port (ignoring case), the same NOR tendered time when both
+        have one, and gap-fill input starting within REVISION_WINDOW_HOURS of
+        `first_event` (epoch minutes). A shared document is not enough, since
+        many voyages run under the same charter-party file.
+        """
+        vessel, port = _identity(vessel), _identity(port)
+        if not vessel or not port:
+            return None
+        self.flush()
+        rows = self.conn().execute(
+            "SELECT v.id, v.metadata, (SELECT MIN(ie.start_min) FROM input_events ie WHERE ie.voyage_id = v.id) "
+            "FROM voyages v WHERE lower(trim(v.vessel)) = ? AND lower(trim(v.port)) = ? "
+            "ORDER BY v.created_at DESC, v.rowid DESC LIMIT 50",
+            (vessel, port),
+        ).fetchall()
+        nor = _minutes_or_none(nor_tendered)
+        for voyage_id, md, first in rows:
+            if first is None:
+                continue
+            if first_event is not None and abs(first - first_event) > REVISION_WINDOW_HOURS * 60:
+                continue
+            stored_nor = _minutes_or_none((json.loads(md or "{}") or {}).get("NOR TENDERED"))
+            if nor is not None and stored_nor is not None and nor != stored_nor:
+                continue
+            return voyage_id
+        return None
+
+    def has_input_events(self, voyage_id: str) -> bool:
+        self.flush()
+        return self.conn().execute(
+            "SELECT 1 FROM input_events WHERE voyage_id = ? LIMIT 1", (voyage_id,)
+        ).fetchone() is not None
+
+    def document(self, doc_hash: str) -> Optional[dict]:
+        """Previously extracted JSON for a file hash, if any."""
+        row = self.conn().execute("SELECT data FROM documents WHERE hash = ?", (doc_hash,)).fetchone()
+        return json.loads(row[0]) if row else None
@@ -0,0 +1,194 @@
+# template_cache.py
+
+import re
+import json
+import zlib
+import hashlib
+from datetime import datetime
+from typing import Optional
+
+import numpy as np
+
+# ---------- CONFIG ----------
+SHINGLE_SIZE = 5            # words per shingle
+NUM_PERM = 64               # MinHash signature length
+BANDS = 16                  # LSH bands (NUM_PERM / BANDS rows each)
+MATCH_THRESHOLD = 0.9       # estimated Jaccard needed to call two contracts the same form
+CACHE_MIN_CONFIDENCE = 0.8  # only reuse deduction decisions the model was sure about
+MIN_TEXT_WORDS = 200        # a text layer shorter than this (a watermark, a stamp) can't identify a form
+
+_PRIME = (1 << 31) - 1
+_rng = np.random.default_rng(20240501)
+_A = _rng.integers(1, _PRIME, NUM_PERM, dtype=np.uint64)
+_B = _rng.integers(0, _PRIME, NUM_PERM, dtype=np.uint64)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS templates (
+    id            TEXT PRIMARY KEY,
+    clause_sig    BLOB NOT NULL,
+    text_sig      BLOB,
+    contract      TEXT,              -- extracted contract JSON of the first voyage seen
+    clause_texts  TEXT,              -- flattened clause list as JSON
+    hits          INTEGER DEFAULT 0,
+    created_at    TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS template_bands (
+    band_key     TEXT NOT NULL,
+    template_id  TEXT NOT NULL,
+    PRIMARY KEY (band_key, template_id)
+);
+CREATE TABLE IF NOT EXISTS template_deductions (
+    template_id  TEXT NOT NULL,
+    remark_key   TEXT NOT NULL,
+    day_kind     TEXT NOT NULL,
+    decision     TEXT NOT NULL,      -- cached analyze_event_against_clauses() result
+    PRIMARY KEY (template_id, remark_key, day_kind)
+);
+"""
+
+
+# ---------- Fingerprinting ----------
+def normalize_text(text: str) -> str:
+    """Lowercase, digits → '#', punctuation and whitespace collapsed, so only the wording counts."""
+    text = re.sub(r"\d+", "#", str(text).lower())
+    text = re.sub(r"[^a-z#]+", " ", text)
+    return text.strip()
+
+
+def shingle_hashes(text: str) -> np.ndarray:
+    words = normalize_text(text).split()
+    if len(words) < SHINGLE_SIZE:
+        words = words + [""] * (SHINGLE_SIZE - len(words))
+    shingles = {" ".join(words[i:i + SHINGLE_SIZE]) for i in range(len(words) - SHINGLE_SIZE + 1)}
+    return np.fromiter((zlib.crc32(s.encode()) % _PRIME for s in shingles), dtype=np.uint64, count=len(shingles))
+
+
+def minhash(text: str) -> np.ndarray:
+    """MinHash signature over word shingles of the normalized text."""
+    h = shingle_hashes(text)
+    return ((_A[:, None] * h[None, :] + _B[:, None]) % _PRIME).min(axis=1).astype(np.uint32)
+
+
+def has_enough_text(text: str) -> bool:
+    """True when a PDF text layer is long enough to fingerprint; short ones match each other by accident."""
+    return len(normalize_text(text or "").split()) >= MIN_TEXT_WORDS
+
+
+def similarity(sig_a: np.ndarray, sig_b: np.ndarray) -> float:
+    """Estimated Jaccard similarity of the two shingle sets."""
+    return float(np.mean(sig_a == sig_b))
+
+
+def band_keys(sig: np.ndarray, kind: str) -> list[str]:
+    rows = NUM_PERM // BANDS
+    return [
+        f"{kind}:{b}:{hashlib.blake2b(sig[b * rows:(b + 1) * rows].tobytes(), digest_size=8).hexdigest()}"
+        for b in range(BANDS)
+    ]
+
+
+def remark_key(remark: str) -> str:
+    return normalize_text(remark)
+
+
+def day_kind(day: str, reason: str = "") -> str:
+    if re.search(r"holiday", reason or "", re.IGNORECASE):
+        return "holiday"
+    return "sunday" if str(day).strip().lower() == "sunday" else "weekday"
+
+
+class TemplateRegistry:
+    """
+    Known charter-party forms, recognised by MinHash over their clause text
+    and looked up through an LSH band index in the voyage store. A match
+    gives back the clause list and the deduction decisions already made
+    under that form.
+    """
+
+    def __init__(self, store):
+        self.store = store
+        self.store.conn().executescript(SCHEMA)
+
+    # ---------- Lookup ----------
+    def match(self, sig: np.ndarray, kind: str = "clause") -> Optional[dict]:
+        """Best known template with estimated similarity ≥ MATCH_THRESHOLD."""
+        c = self.store.conn()
+        keys = band_keys(sig, kind)
+        marks = ",".join("?" * len(keys))
+        candidates = [r[0] for r in c.execute(
+            f"SELECT DISTINCT template_id FROM template_bands WHERE band_key IN ({marks})", keys
+        )]
+        best, best_sim = None, MATCH_THRESHOLD
+        col = "clause_sig" if kind == "clause" else "text_sig"
+        for tid in candidates:
+            row = c.execute(f"SELECT id, {col}, contract, clause_texts FROM templates WHERE id = ?", (tid,)).fetchone()
+            if row is None or row[1] is None:
+                continue
+            sim = similarity(sig, np.frombuffer(row[1], dtype=np.uint32))
+            if sim >= best_sim:
+                best, best_sim = row, sim
+        if best is None:
+            return None
+        with c:
+            c.execute("UPDATE templates SET hits = hits + 1 WHERE id = ?", (best[0],))
+        return {
+            "id": best[0],
+            "similarity": best_sim,
+            "contract": json.loads(best[2]) if best[2] else {},
+            "clause_texts": json.loads(best[3]) if best[3] else [],
+        }
+
+    def match_text(self, contract_text: str) -> Optional[dict]:
+        """Match on the PDF's own text layer, before any extraction (None when it is too short to tell)."""
+        if not has_enough_text(contract_text):
+            return None
+        return self.match(minhash(contract_text), "text")
+
+    def match_clauses(self, clause_texts: list[str]) -> Optional[dict]:
+        return self.match(minhash("\n".join(clause_texts)), "clause")
+
+    # ---------- Registration ----------
+    def register(self, clause_texts: list[str], contract: dict, contract_text: str = "") -> str:
+        """Record a newly extracted contract form; returns the template id."""
+        existing = self.match_clauses(clause_texts)
+        if existing is not None:
+            return existing["id"]
+
+        clause_sig = minhash("\n".join(clause_texts))
+        text_sig = minhash(contract_text) if has_enough_text(contract_text) else None
+        tid = hashlib.blake2b(clause_sig.tobytes(), digest_size=12).hexdigest()
+        keys = band_keys(clause_sig, "clause") + (band_keys(text_sig, "text") if text_sig is not None else [])
+
+        c = self.store.conn()
+        with c:
+            c.execute(
+                "INSERT OR REPLACE INTO templates (id, clause_sig, text_sig, contract, clause_texts, created_at) "
+                "VALUES (?,?,?,?,?,?)",
+                (tid, clause_sig.tobytes(), text_sig.tobytes() if text_sig is not None else None,
+                 json.dumps(contract, default=str), json.dumps(clause_texts), datetime.now().isoformat(timespec="seconds")),
+            )
+            c.executemany("INSERT OR IGNORE INTO template_bands VALUES (?,?)", [(k, tid) for k in keys])
+        return tid
+
+    # ---------- Deduction cache ----------
+    def cached_deduction(self, template_id: str, event: dict) -> Optional[dict]:
+        row = self.store.conn().execute(
+            "SELECT decision FROM template_deductions WHERE template_id = ? AND remark_key = ? AND day_kind = ?",
+            (template_id, remark_key(event.get("reason")), day_kind(event.get("day"), event.get("reason"))),
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def remember_deduction(self, template_id: str, event: dict, decision: dict):
+        try:
+            confidence = float(decision.get("confidence_score", 0.0))
+        except (TypeError, ValueError):
+            confidence = 0.0
+        if "error" in decision or confidence < CACHE_MIN_CONFIDENCE:
+            return
+        c = self.store.conn()
+        with c:
+            c.execute(
+                "INSERT OR REPLACE INTO template_deductions VALUES (?,?,?,?)",
+                (template_id, remark_key(event.get("reason")), day_kind(event.get("day"), event.get("reason")),
+                 json.dumps(decision, default=str)),
+            )
@@ -0,0 +1,99 @@
+# upload_spool.py
+
+import os
+import time
+import uuid
+import atexit
+import shutil
+import tempfile
+
+# ---------- CONFIG ----------
+SCRATCH_ROOT = os.getenv("LAYTIME_SCRATCH", os.path.join(tempfile.gettempdir(), "laytime_scratch"))
+CHUNK_SIZE = 1 << 20                 # 1 MiB per read, so copies never hold a whole PDF
+STALE_AFTER_SECONDS = 6 * 3600       # scratch dirs older than this are swept regardless of owner
+
+_live_dirs = set()
+
+
+def _pid_alive(pid: int) -> bool:
+    if os.name == "nt":
+        # os.kill(pid, 0) would terminate the process on Windows; rely on age instead
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def sweep_stale(root: str = SCRATCH_ROOT, max_age: float = STALE_AFTER_SECONDS) -> int:
+    """
+    Remove scratch dirs left behind by crashed or killed servers: any dir whose
+    owning process is gone, or that hasn't been touched in `max_age` seconds.
+    Returns the number of dirs removed.
+    """
+    if not os.path.isdir(root):
+        return 0
+    removed = 0
+    now = time.time()
+    for name in os.listdir(root):
+        path = os.path.join(root, name)
+        if not os.path.isdir(path) or path in _live_dirs:
+            continue
+        pid_part = name.split("-", 1)[0]
+        owner_gone = pid_part.isdigit() and int(pid_part) != os.getpid() and not _pid_alive(int(pid_part))
+        try:
+            too_old = now - os.path.getmtime(path) > max_age
+        except OSError:
+            continue
+        if owner_gone or too_old:
+            shutil.rmtree(path, ignore_errors=True)
+            removed += 1
+    return removed
+
+
+class SessionScratch:
+    """
+    Per-session scratch directory for uploads and generated files. Use it as
+    a context manager: everything under it is removed when the run ends,
+    when the process exits, or by sweep_stale() after a crash.
+    """
+
+    def __init__(self, session_id: str = None, root: str = SCRATCH_ROOT):
+        # "<pid>-<session>" lets sweep_stale() tell which server owned it
+        self.path = os.path.join(root, f"{os.getpid()}-{session_id or uuid.uuid4().hex}")
+        os.makedirs(self.path, exist_ok=True)
+        _live_dirs.add(self.path)
+
+    def spool(self, src, name: str) -> str:
+        """Stream an upload (any object with .read(n)) into the scratch dir in chunks."""
+        base = os.path.basename(name) or "upload"
+        dest = os.path.join(self.path, f"{uuid.uuid4().hex[:8]}_{base}")
+        if hasattr(src, "seek"):
+            src.seek(0)
+        with open(dest, "wb") as out:
+            shutil.copyfileobj(src, out, CHUNK_SIZE)
+        return dest
+
+    def file(self, suffix: str = "") -> str:
+        """Path for a new file inside the scratch dir."""
+        return os.path.join(self.path, f"{uuid.uuid4().hex}{suffix}")
+
+    def cleanup(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+        _live_dirs.discard(self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.cleanup()
+
+
+@atexit.register
+def _cleanup_live_dirs():
+    for path in list(_live_dirs):
+        shutil.rmtree(path, ignore_errors=True)
+    _live_dirs.clear()